@@ -0,0 +1,154 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Benchmarks of the registration phases and resampling on synthetic volumes with a known transform.
+
+The wall time, the peak resident memory and the registration error in pixels are recorded by the `time_`, `peakmem_`
+and `track_` benchmarks for each volume size.
+"""
+
+import SimpleITK as sitk
+
+from sitkibex import registration, resample
+from sitkibex.image_utilities import fft_initialization
+from sitkibex.registration import register_3d, register_as_2d_affine
+
+from .synthetic import known_transform, make_cycle, make_tissue, registration_error
+
+sizes = [(512, 512, 20), (1024, 1024, 30), (2048, 2048, 40), (4096, 4096, 60)]
+
+
+class _SyntheticPanels:
+    """Generate a fixed and a moving cycle for each size once, shared by the benchmark classes."""
+
+    params = [sizes]
+    param_names = ["size"]
+    timeout = 3600
+    number = 1
+    repeat = (1, 3, 600.0)
+
+    def setup_cache(self):
+        filenames = {}
+        for size in sizes:
+            name = "x".join(str(s) for s in size)
+            filenames[size] = ("fixed_{}.mha".format(name), "moving_{}.mha".format(name))
+
+            tissue = make_tissue(size)
+            sitk.WriteImage(make_cycle(tissue, seed=1), filenames[size][0])
+            sitk.WriteImage(make_cycle(tissue, known_transform(size), seed=2), filenames[size][1])
+        return filenames
+
+    def setup(self, filenames, size, pixel_type=sitk.sitkFloat32):
+        fixed_filename, moving_filename = filenames[size]
+        self.fixed = sitk.ReadImage(fixed_filename, pixel_type)
+        self.moving = sitk.ReadImage(moving_filename, pixel_type)
+        self.expected_tx = known_transform(size)
+
+        # The translation of the center of the fixed image, as estimated by the FFT initialization
+        center = self.fixed.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2.0 for s in size])
+        self.initial_translation = [m - c for m, c in zip(self.expected_tx.TransformPoint(center), center)]
+
+
+class FFTInitialization(_SyntheticPanels):
+    def _run(self):
+        return fft_initialization(self.moving, self.fixed, bin_shrink=8, projection=False)
+
+    def time_fft_initialization(self, filenames, size):
+        self._run()
+
+    def peakmem_fft_initialization(self, filenames, size):
+        self._run()
+
+    def track_fft_initialization_error(self, filenames, size):
+        return registration_error(
+            sitk.TranslationTransform(3, self._run()),
+            sitk.TranslationTransform(3, self.initial_translation),
+            self.fixed,
+        )
+
+    track_fft_initialization_error.unit = "pixels"
+
+
+class RegisterAs2DAffine(_SyntheticPanels):
+    def _run(self):
+        return register_as_2d_affine(self.fixed, self.moving, initial_translation=self.initial_translation[:2])
+
+    def time_register_as_2d_affine(self, filenames, size):
+        self._run()
+
+    def peakmem_register_as_2d_affine(self, filenames, size):
+        self._run()
+
+    def track_register_as_2d_affine_error(self, filenames, size):
+        # The 2D registration of the z-projections does not estimate the z-translation
+        return registration_error(self._run(), self.expected_tx, self.fixed, dimension=2)
+
+    track_register_as_2d_affine_error.unit = "pixels"
+
+
+class Register3D(_SyntheticPanels):
+    def _run(self):
+        initial_tx = sitk.CenteredTransformInitializer(
+            self.fixed, self.moving, sitk.AffineTransform(3), sitk.CenteredTransformInitializerFilter.GEOMETRY
+        )
+        initial_tx = sitk.AffineTransform(initial_tx)
+        initial_tx.SetTranslation(self.initial_translation)
+        return register_3d(self.fixed, self.moving, initial_transform=initial_tx)
+
+    def time_register_3d(self, filenames, size):
+        self._run()
+
+    def peakmem_register_3d(self, filenames, size):
+        self._run()
+
+    def track_register_3d_error(self, filenames, size):
+        return registration_error(self._run(), self.expected_tx, self.fixed)
+
+    track_register_3d_error.unit = "pixels"
+
+
+class LowMemoryRegistration(_SyntheticPanels):
+    """The registration with automatic masks, with and without the low memory mode."""
+
+    params = [sizes, [False, True]]
+    param_names = ["size", "low_memory"]
+
+    def setup(self, filenames, size, low_memory):
+        super().setup(filenames, size)
+
+    def _run(self, low_memory):
+        return registration(self.fixed, self.moving, auto_mask=True, low_memory=low_memory, return_telemetry=True)
+
+    def peakmem_registration(self, filenames, size, low_memory):
+        self._run(low_memory)
+
+    def track_peak_allocation_per_pixel(self, filenames, size, low_memory):
+        _, telemetry = self._run(low_memory)
+        peak_allocation = max(record["peak_allocation_bytes"] for record in telemetry.phases)
+        return peak_allocation / self.fixed.GetNumberOfPixels()
+
+    track_peak_allocation_per_pixel.unit = "bytes"
+
+
+class Resample(_SyntheticPanels):
+    def setup(self, filenames, size):
+        super().setup(filenames, size, pixel_type=sitk.sitkUInt16)
+
+    def time_resample(self, filenames, size):
+        resample(self.fixed, self.moving, self.expected_tx)
+
+    def peakmem_resample(self, filenames, size):
+        resample(self.fixed, self.moving, self.expected_tx)
@@ -0,0 +1,113 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""Synthetic IBEX-like multi-cycle volumes with known transforms between the cycles."""
+
+import itertools
+
+import numpy as np
+import SimpleITK as sitk
+
+# Anisotropic confocal spacing, with the magnitude near 1 as after the spacing normalization done by registration
+spacing = (0.6, 0.6, 2.0)
+
+
+def make_tissue(size, nuclei_density=1.0 / 2000, seed=0):
+    """
+    Generate a volume of randomly placed Gaussian blobs, like labeled nuclei, shared by all the cycles of a panel.
+
+    The nuclei are modulated by a smooth random tissue envelope, which provides the large scale structures used by the
+    coarse levels of the registration.
+
+    :param size: The XYZ size of the volume.
+    :param nuclei_density: The number of nuclei per pixel.
+    :param seed: The seed of the random number generator.
+    :return: A Float32 SimpleITK Image with values in [0, 1.25].
+    """
+
+    rng = np.random.default_rng(seed)
+    number_of_nuclei = int(np.prod(size) * nuclei_density)
+
+    arr = np.zeros(size[::-1], dtype=np.float32)
+    arr[tuple(rng.integers(0, s, number_of_nuclei) for s in size[::-1])] = rng.uniform(0.5, 1.0, number_of_nuclei)
+    img = sitk.GetImageFromArray(arr)
+    del arr
+    img.SetSpacing(spacing)
+    img = sitk.SmoothingRecursiveGaussian(img, [2.5 * spacing[0], 2.5 * spacing[1], spacing[2]])
+    img = sitk.RescaleIntensity(img, 0.0, 1.0)
+
+    # The envelope is generated on a coarse grid of a fixed number of pixels in XY, then linearly interpolated
+    coarse = sitk.GetImageFromArray(rng.uniform(size=(size[2], 64, 64)).astype(np.float32))
+    coarse.SetSpacing([size[0] * spacing[0] / 64, size[1] * spacing[1] / 64, spacing[2]])
+    coarse.SetOrigin([(sp * (s / 64.0 - 1)) / 2.0 for s, sp in zip(size[:2], spacing[:2])] + [0.0])
+    coarse = sitk.SmoothingRecursiveGaussian(coarse, [4.0 * coarse.GetSpacing()[0]] * 2 + [4.0 * spacing[2]])
+    envelope = sitk.Resample(sitk.RescaleIntensity(coarse, 0.0, 1.0), img, sitk.Transform(), sitk.sitkLinear)
+
+    return img * envelope + 0.25 * envelope
+
+
+def known_transform(size):
+    """
+    The affine transform, mapping points from the first cycle to a later cycle, of an acquisition with a small stage
+    offset, rotation and magnification change.
+
+    :param size: The XYZ size of the volume.
+    :return: A SimpleITK AffineTransform centered on the volume.
+    """
+
+    tx = sitk.AffineTransform(3)
+    tx.SetCenter([(s - 1) * sp / 2.0 for s, sp in zip(size, spacing)])
+    tx.Scale([1.01, 1.01, 1.0])
+    tx.Rotate(0, 1, np.deg2rad(0.75))
+    tx.SetTranslation([0.03 * size[0] * spacing[0], -0.02 * size[1] * spacing[1], 1.5 * spacing[2]])
+    return tx
+
+
+def make_cycle(tissue, transform=None, seed=0, max_value=4000.0, background=100.0, noise=0.01):
+    """
+    Generate the repeated marker channel of one cycle from the tissue volume.
+
+    :param tissue: The result of make_tissue.
+    :param transform: (optional) A transform mapping points from the tissue to the cycle.
+    :param seed: The seed of the additive noise, different for each cycle.
+    :param max_value: The intensity scale of the tissue.
+    :param background: The intensity of the background.
+    :param noise: The standard deviation of the Gaussian noise relative to max_value.
+    :return: A UInt16 SimpleITK Image.
+    """
+
+    if transform is not None:
+        tissue = sitk.Resample(tissue, tissue, transform.GetInverse(), sitk.sitkLinear, 0.0)
+
+    img = sitk.AdditiveGaussianNoise(tissue, standardDeviation=noise, seed=seed)
+    return sitk.Clamp(img * max_value + background, sitk.sitkUInt16, 0, 2**16 - 1)
+
+
+def registration_error(transform, expected_transform, image, dimension=3, points_per_axis=5):
+    """
+    The mean distance in pixels between the points mapped by transform and by expected_transform, over a lattice of
+    points covering the image.
+
+    :param dimension: Only the first `dimension` coordinates are compared, 2 for transforms estimated in XY.
+    :param points_per_axis: The number of points of the lattice along each axis.
+    """
+
+    axes_points = [np.linspace(0, s - 1, points_per_axis) for s in image.GetSize()]
+    distances = []
+    for idx in itertools.product(*axes_points):
+        pt = image.TransformContinuousIndexToPhysicalPoint(idx)
+        diff = np.subtract(transform.TransformPoint(pt), expected_transform.TransformPoint(pt))
+        distances.append(np.linalg.norm((diff / image.GetSpacing())[:dimension]))
+    return float(np.mean(distances))
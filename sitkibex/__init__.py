@@ -13,8 +13,15 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-from .registration import registration
-from .resample import resample
+from .registration import (
+    registration,
+    registration_batch,
+    registration_pipeline,
+    registration_tiled,
+    PreparedFixedImage,
+)
+from .resample import collapse_transform, resample, resample_tiled
+from .profiles import RegistrationProfile
 
 try:
     from ._version import version as __version__
@@ -23,4 +30,14 @@ except ImportError:
 
 __author__ = ["Bradley Lowekamp"]
 
-__all__ = ["registration", "resample"]
+__all__ = [
+    "registration",
+    "registration_batch",
+    "registration_pipeline",
+    "registration_tiled",
+    "PreparedFixedImage",
+    "RegistrationProfile",
+    "resample",
+    "resample_tiled",
+    "collapse_transform",
+]
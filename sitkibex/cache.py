@@ -0,0 +1,153 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+""" A content addressed cache of registration results on disk."""
+
+import SimpleITK as sitk
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from .registration_utilities import RegistrationTelemetry
+
+_logger = logging.getLogger(__name__)
+
+
+def _file_identity(filename):
+    """The identity of a file, or of all the files in a directory such as a Zarr store, from the path, the size and
+    the modification time."""
+
+    path = Path(filename).resolve()
+    if not path.is_dir():
+        stat = path.stat()
+        return [str(path), stat.st_size, stat.st_mtime_ns]
+
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            stat = os.stat(os.path.join(dirpath, name))
+            files.append([os.path.relpath(os.path.join(dirpath, name), path), stat.st_size, stat.st_mtime_ns])
+    return [str(path), sorted(files)]
+
+
+def _entry_size(entry):
+    return sum(f.stat().st_size for f in entry.iterdir())
+
+
+class TransformCache:
+    """
+    A directory of registration results keyed by the identity of the input files and the registration parameters.
+
+    Each entry is a sub-directory named by the SHA-256 key, with the "transform.txt" and the "telemetry.json" of the
+    registration. An entry is written into a temporary directory which is then renamed, so concurrent processes never
+    read a partial entry. The modification time of an entry is updated when it is read, and the least recently used
+    entries are removed when the total size of the entries exceeds max_size.
+
+    :param directory: The directory of the cache, created if it does not exist.
+    :param max_size: The maximum total size in bytes of the entries.
+    """
+
+    transform_filename = "transform.txt"
+    telemetry_filename = "telemetry.json"
+
+    def __init__(self, directory, max_size=2**30):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(inputs, **parameters) -> str:
+        """
+        The key of a registration result.
+
+        :param inputs: A sequence of pairs of an input filename and the channel selected.
+        :param parameters: The parameters of the registration, with JSON serializable values.
+        :return: A hexadecimal SHA-256 digest of the identities of the input files, the channels, the parameters, and
+         the versions of sitkibex and SimpleITK.
+        """
+        from . import __version__
+
+        description = {
+            "inputs": [[_file_identity(filename), channel] for filename, channel in inputs],
+            "parameters": parameters,
+            "versions": [__version__, sitk.Version.VersionString()],
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Read the result of a registration from the cache.
+
+        :param key: The key of the registration result.
+        :return: A pair of the transform and the RegistrationTelemetry, which is None if it was not recorded. None when
+         the key is not in the cache.
+        """
+
+        entry = self.directory / key
+        try:
+            transform = sitk.ReadTransform(str(entry / self.transform_filename))
+            telemetry = None
+            if (entry / self.telemetry_filename).exists():
+                telemetry = RegistrationTelemetry()
+                with open(entry / self.telemetry_filename) as fp:
+                    telemetry.phases = json.load(fp)
+            os.utime(entry)
+        except (OSError, RuntimeError, ValueError) as e:
+            if entry.exists():
+                _logger.warning("Ignoring the unreadable cache entry {}: {}".format(entry, e))
+            return None
+
+        _logger.info("Using the cached registration {}.".format(key))
+        return transform, telemetry
+
+    def put(self, key, transform, telemetry=None):
+        """
+        Write the result of a registration into the cache, then evict the least recently used entries.
+
+        :param key: The key of the registration result.
+        :param transform: The SimpleITK Transform result of the registration.
+        :param telemetry: (optional) The RegistrationTelemetry of the registration.
+        """
+
+        tmp_entry = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.directory))
+        try:
+            sitk.WriteTransform(transform, str(tmp_entry / self.transform_filename))
+            if telemetry is not None:
+                with open(tmp_entry / self.telemetry_filename, "w") as fp:
+                    json.dump(telemetry.phases, fp)
+            os.rename(tmp_entry, self.directory / key)
+        except OSError:
+            # The entry was written concurrently by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            if not (self.directory / key).exists():
+                raise
+
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        entries = [e for e in self.directory.iterdir() if e.is_dir() and not e.name.startswith(".tmp-")]
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+
+        total_size = 0
+        for entry in entries:
+            size = _entry_size(entry)
+            if total_size + size > self.max_size and entry.name != keep:
+                _logger.debug("Evicting the cache entry {}.".format(entry.name))
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                total_size += size
@@ -23,7 +23,10 @@ import SimpleITK as sitk
 import click
 import logging
 import re
-from .io import im_read_channel
+from functools import partial
+from .io import ImageRegionReader, im_read_channel, im_read_channels, im_read_geometry, im_write_zarr
+from .cache import TransformCache
+from .profiles import get_profile
 import sitkibex.registration_utilities as utils
 
 
@@ -47,6 +50,8 @@ class ImagePathChannel(click.Path):
     If the channel suffix  is an integer ( or with  "Ch" ), then an integer type is returned for a 1-based channel
     index.
 
+    With multiple_channels, several channels separated by commas can be selected e.g. `@CD3,CD4,DAPI`, and a list of
+    the channels is returned.
 
     The converted output returned is a pair of the filename followed by the channel name or integer channel index.
 
@@ -54,8 +59,21 @@ class ImagePathChannel(click.Path):
 
     name = "image_file[@channel]"
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, multiple_channels=False, **kwargs):
         super().__init__(*args, **kwargs)
+        self.multiple_channels = multiple_channels
+        if multiple_channels:
+            self.name = "image_file[@channel[,channel...]]"
+
+    @staticmethod
+    def _convert_channel(channel_part):
+        m = re.match(r"(Ch)?(\d)", channel_part, re.IGNORECASE)
+        if m:
+            channel_part = int(m.groups()[1])
+            # if "Ch" prefix it it 1 based index, so convert
+            if m.groups()[0] is not None:
+                channel_part -= 1
+        return channel_part
 
     def convert(self, value, param, ctx):
 
@@ -66,12 +84,10 @@ class ImagePathChannel(click.Path):
             value = m.groups()[0]
             channel_part = m.groups()[1]
 
-            m = re.match(r"(Ch)?(\d)", channel_part, re.IGNORECASE)
-            if m:
-                channel_part = int(m.groups()[1])
-                # if "Ch" prefix it it 1 based index, so convert
-                if m.groups()[0] is not None:
-                    channel_part -= 1
+            if self.multiple_channels and "," in channel_part:
+                channel_part = [self._convert_channel(c) for c in channel_part.split(",")]
+            else:
+                channel_part = self._convert_channel(channel_part)
 
         return super().convert(value, param, ctx), channel_part
 
@@ -95,10 +111,18 @@ class ImagePathChannel(click.Path):
     flag_value=logging.WARNING,
     help="Minimal verbosity with only warning logging enabled.",
 )
+@click.option(
+    "--channel-index-sidecar",
+    is_flag=True,
+    help='Cache the channel names parsed from the header of an input file in a "<filename>.sitkibex.json" file next '
+    "to it, for later commands.",
+)
 def cli(**kwargs):
 
     args = _Bunch(kwargs)
 
+    sitkibex.globals.channel_index_sidecar = args.channel_index_sidecar
+
     # single app logger:
     log = sitkibex.globals.logger
     log.setLevel(args.logging_level)
@@ -120,7 +144,420 @@ def cli(**kwargs):
         os.environ["SITK_SHOW_EXTENSION"] = ".nrrd"
 
 
+def _check_profile(ctx, param, value):
+    """Check the registration profile option names an existing profile."""
+    try:
+        get_profile(value)
+    except (OSError, ValueError, TypeError) as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+def _registration_options(func):
+    """A decorator adding the command line options common to the registration commands."""
+
+    options = [
+        click.option(
+            "-b",
+            "--bin",
+            default=1,
+            type=int,
+            show_default=True,
+            help="Reduce the resolution of the input images in X and Y by this factor",
+        ),
+        click.option("-s", "--sigma", default=1.0, type=float, show_default=True),
+        click.option("--affine/--no-affine", default=False, help="Do affine registration in a second step."),
+        click.option(
+            "--log-polar/--no-log-polar",
+            default=False,
+            show_default=True,
+            help="Correct a rotation about Z with a 2D registration of the Z-projections, initialized by the rotation "
+            "and translation estimated from the log-polar phase correlation.",
+        ),
+        click.option(
+            "--adaptive/--no-adaptive",
+            default=False,
+            show_default=True,
+            help="Adapt the iterations of each level of the affine registration, skipping the full resolution when the "
+            "coarser levels have converged.",
+        ),
+        click.option(
+            "--automask/--no-automask",
+            default=False,
+            show_default=True,
+            help="Automatically compute a mask for the non-zero pixels of the input images",
+        ),
+        click.option(
+            "--low-memory/--no-low-memory",
+            default=False,
+            show_default=True,
+            help="Reduce the peak memory of the registration by computing the masks at a reduced resolution.",
+        ),
+        click.option(
+            "--ignore-spacing/--no-ignore-spacing",
+            default=True,
+            show_default=True,
+            help="Ignore the magnitude of spacing, but preserve relative ratio.",
+        ),
+        click.option(
+            "--random/--no-random",
+            default=False,
+            show_default=True,
+            help="Use wall-clock instead of a fixed seed for random initialization.",
+        ),
+        click.option(
+            "--profile",
+            default="balanced",
+            show_default=True,
+            callback=_check_profile,
+            help='The speed and accuracy tradeoff of the registration, the "fast", "balanced" or "accurate" preset, '
+            "the name of a profile written by the tune command, or the path of a profile file.",
+        ),
+        click.option(
+            "--samples-per-parameter",
+            default=None,
+            type=click.IntRange(min=1),
+            help="The number of image samples per transform parameter at full resolution, by default from the profile.",
+        ),
+        click.option(
+            "--fft-candidates",
+            default=1,
+            type=click.IntRange(min=1),
+            show_default=True,
+            help="Number of FFT correlation peaks refined concurrently to select the initial translation.",
+        ),
+        click.option(
+            "--telemetry",
+            default=None,
+            type=click.Path(exists=False, resolve_path=True),
+            help="Write the durations, iterations and metric values of the registration phases to this file.",
+        ),
+        click.option(
+            "--telemetry-format",
+            default="jsonl",
+            type=click.Choice(["jsonl", "openmetrics"]),
+            show_default=True,
+            help="Write the telemetry as JSON lines, one object per phase, or as OpenMetrics text.",
+        ),
+        click.option(
+            "--cache-directory",
+            default=None,
+            type=click.Path(file_okay=False, resolve_path=True),
+            help="Reuse the transform and telemetry of a previous registration of the same input files with the same "
+            "options, kept in this directory.",
+        ),
+        click.option(
+            "--cache-size",
+            default=1024,
+            type=click.IntRange(min=1),
+            show_default=True,
+            help="Maximum size of the cache directory in MB, the least recently used results are removed.",
+        ),
+    ]
+
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _registration_kwargs(args):
+    """Convert the parsed command line options into keyword arguments for registration."""
+    return dict(
+        sigma=args.sigma,
+        do_affine2d=args.log_polar,
+        do_affine3d=args.affine,
+        log_polar_initialization=args.log_polar,
+        adaptive=args.adaptive,
+        number_of_fft_candidates=args.fft_candidates,
+        auto_mask=args.automask,
+        low_memory=args.low_memory,
+        ignore_spacing=args.ignore_spacing,
+        samples_per_parameter=args.samples_per_parameter,
+        profile=args.profile,
+        return_telemetry=args.telemetry is not None,
+    )
+
+
+def _registration_cache(args, fixed_image, moving_images, **parameters):
+    """The TransformCache and the keys of the registrations of the moving images, or None when not caching.
+
+    The registration is not reproducible with a random seed, so its results are not cached. The parameters of the
+    command not passed to registration are added to the keys.
+    """
+
+    if args.cache_directory is None or args.random:
+        return None, [None] * len(moving_images)
+
+    cache = TransformCache(args.cache_directory, max_size=args.cache_size * 2**20)
+    kwargs = _registration_kwargs(args)
+    del kwargs["return_telemetry"]
+    # A named profile file may be tuned again, so the settings are in the key
+    kwargs["profile"] = get_profile(args.profile).to_dict()
+    kwargs.update(parameters, bin=args.bin, random_seed=sitkibex.globals.default_random_seed)
+    return cache, [cache.key([fixed_image, m], **kwargs) for m in moving_images]
+
+
+def _write_telemetry(args, telemetry_labels):
+    """Write the telemetry of registrations, as pairs of a RegistrationTelemetry and labels, to the telemetry file."""
+
+    _logger.info('Writing telemetry "{}".'.format(args.telemetry))
+    with open(args.telemetry, "w") as fp:
+        if args.telemetry_format == "openmetrics":
+            fp.write(utils.telemetry_to_openmetrics(telemetry_labels))
+        else:
+            for telemetry, labels in telemetry_labels:
+                fp.write(telemetry.to_json_lines(**labels))
+
+
+def _bin_shrink_factors(bin_xy):
+    """The shrink factors for im_read_channel to bin X and Y by bin_xy while reading."""
+    if bin_xy != 1:
+        return [bin_xy, bin_xy, 1]
+    return None
+
+
+def _read_registration_image(filename, channel_name, bin_xy, low_memory=False):
+    """Read a channel of an image file as a Float32 image for registration, optionally binned in X and Y.
+
+    With low_memory, the image is binned in its pixel type and then cast, so no Float32 image of the full resolution is
+    allocated. Binned integer pixels are rounded.
+    """
+    if low_memory:
+        return sitk.Cast(
+            im_read_channel(filename, channel_name, shrink_factors=_bin_shrink_factors(bin_xy)), sitk.sitkFloat32
+        )
+    return im_read_channel(
+        filename, channel_name, shrink_factors=_bin_shrink_factors(bin_xy), output_pixel_type=sitk.sitkFloat32
+    )
+
+
+def _register(args, fixed_image, moving_image):
+    """Register the moving image to the fixed image, refined by the tiled registration with a tile size, returning the
+    transform and the RegistrationTelemetry, or None when neither the telemetry nor the cache is enabled."""
+    from sitkibex.registration import registration, registration_tiled
+
+    kwargs = _registration_kwargs(args)
+    kwargs["return_telemetry"] = kwargs["return_telemetry"] or args.cache_directory is not None
+
+    if args.tile_size is None:
+        # The images are passed without keeping references, so registration does not duplicate them
+        result = registration(
+            _read_registration_image(*fixed_image, args.bin, args.low_memory),
+            _read_registration_image(*moving_image, args.bin, args.low_memory),
+            **kwargs,
+        )
+        return result if kwargs["return_telemetry"] else (result, None)
+
+    # The images are also used by the tiled registration, so registration makes its own copies
+    fixed_img = _read_registration_image(*fixed_image, args.bin, args.low_memory)
+    moving_img = _read_registration_image(*moving_image, args.bin, args.low_memory)
+    result = registration(fixed_img, moving_img, **kwargs)
+    tx, telemetry = result if kwargs["return_telemetry"] else (result, None)
+
+    tx = registration_tiled(
+        fixed_img,
+        moving_img,
+        tx,
+        tile_size=args.tile_size,
+        number_of_control_points=args.tile_control_points,
+        sigma=args.sigma,
+        samples_per_parameter=args.samples_per_parameter or get_profile(args.profile).samples_per_parameter,
+        telemetry=telemetry,
+    )
+    return tx, telemetry
+
+
 @cli.command(name="registration")
+@_registration_options
+@click.option(
+    "--tile-size",
+    default=None,
+    type=click.IntRange(min=16),
+    help="Refine the registration with a smooth deformation fitted to the translations of overlapping tiles of this "
+    "size in X and Y, registered in parallel.",
+)
+@click.option(
+    "--tile-control-points",
+    default=4,
+    type=click.IntRange(min=4),
+    show_default=True,
+    help="Number of control points along each axis of the B-spline deformation of the tiled registration, fewer are "
+    "smoother.",
+)
+@click.argument("fixed_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
+@click.argument("moving_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
+@click.argument("output_transform", type=click.Path(exists=False, resolve_path=True))
+def reg_cli(fixed_image, moving_image, output_transform, **kwargs):
+    """Perform registration to solve for an OUTPUT_TRANSFORM mapping points from the FIXED_IMAGE to the MOVING_IMAGE.
+
+    With a tile size, the non-linear OUTPUT_TRANSFORM should be written to a ".h5" file, which is faster to read and
+    write than text.
+    """
+
+    args = _Bunch(kwargs)
+
+    if args.random:
+        sitkibex.globals.default_random_seed = sitk.sitkWallClock
+
+    # Without tiles, the key is the same as the key of register-batch
+    tile_parameters = {}
+    if args.tile_size is not None:
+        tile_parameters = dict(tile_size=args.tile_size, tile_control_points=args.tile_control_points)
+    cache, (cache_key,) = _registration_cache(args, fixed_image, [moving_image], **tile_parameters)
+    cached = cache.get(cache_key) if cache else None
+
+    if cached:
+        tx, telemetry = cached
+    else:
+        tx, telemetry = _register(args, fixed_image, moving_image)
+        if cache:
+            cache.put(cache_key, tx, telemetry)
+
+    if args.telemetry:
+        _write_telemetry(args, [(telemetry, {"fixed": basename(fixed_image[0]), "moving": basename(moving_image[0])})])
+
+    sitk.WriteTransform(tx, output_transform)
+
+
+def _register_batch(args, fixed_image, fixed_channel_name, moving_images):
+    """Register the moving images to the fixed image concurrently, returning pairs of the transform and the
+    RegistrationTelemetry, or None when neither the telemetry nor the cache is enabled."""
+    from sitkibex.registration import PreparedFixedImage, registration_batch, registration_pipeline
+
+    # The fixed image is prepared without keeping a reference to the image read, so it is not duplicated
+    fixed_img = PreparedFixedImage(
+        _read_registration_image(fixed_image, fixed_channel_name, args.bin, args.low_memory),
+        ignore_spacing=args.ignore_spacing,
+        auto_mask=args.automask,
+        low_memory=args.low_memory,
+    )
+
+    # The moving images are read in the worker processes
+    moving_readers = [
+        partial(_read_registration_image, m, channel_name, args.bin, args.low_memory)
+        for m, channel_name in moving_images
+    ]
+
+    kwargs = _registration_kwargs(args)
+    kwargs["return_telemetry"] = kwargs["return_telemetry"] or args.cache_directory is not None
+    if args.pipeline:
+        results = registration_pipeline(fixed_img, moving_readers, **kwargs)
+    else:
+        results = registration_batch(
+            fixed_img,
+            moving_readers,
+            max_workers=args.workers,
+            number_of_threads=args.threads_per_worker,
+            **kwargs,
+        )
+    return results if kwargs["return_telemetry"] else [(tx, None) for tx in results]
+
+
+@cli.command(name="register-batch")
+@_registration_options
+@click.option(
+    "-j",
+    "--workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Number of registrations performed concurrently. By default up to the number of CPUs.",
+)
+@click.option(
+    "--pipeline/--no-pipeline",
+    default=False,
+    show_default=True,
+    help="Register the moving images one at a time with all the threads, reading the next moving image in the "
+    "background. This uses less memory than concurrent workers.",
+)
+@click.option(
+    "--threads-per-worker",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Number of threads used by each worker. By default the CPUs are divided evenly between the workers.",
+)
+@click.option(
+    "-d",
+    "--output-directory",
+    default=".",
+    show_default=True,
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    help="Directory where the output transforms are written.",
+)
+@click.option(
+    "--output-pattern",
+    default="tx_{fixed}_to_{moving}.txt",
+    show_default=True,
+    help="Filename pattern of the output transforms, formatted with the fixed and moving file name stems.",
+)
+@click.argument("fixed_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
+@click.argument(
+    "moving_images", nargs=-1, required=True, type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True)
+)
+def reg_batch_cli(fixed_image, moving_images, **kwargs):
+    """Register each of the MOVING_IMAGES to the FIXED_IMAGE and write one transform per moving image.
+
+    The FIXED_IMAGE is read once, and the registrations are performed concurrently. With a cache directory, only the
+    moving images without a cached result are registered. For example:
+
+    >>> sitkibex register-batch --affine -j 4 panel1.nrrd@CD4 panel2.nrrd@CD4 panel3.nrrd@CD4 panel4.nrrd@CD4
+
+    Writes the transforms "tx_panel1_to_panel2.txt", "tx_panel1_to_panel3.txt" and "tx_panel1_to_panel4.txt".
+    """
+    args = _Bunch(kwargs)
+
+    fixed_image, fixed_channel_name = fixed_image
+
+    if args.random:
+        sitkibex.globals.default_random_seed = sitk.sitkWallClock
+
+    def stem(filename):
+        return os.path.splitext(basename(filename))[0]
+
+    output_transforms = [
+        os.path.join(args.output_directory, args.output_pattern.format(fixed=stem(fixed_image), moving=stem(m)))
+        for m, _ in moving_images
+    ]
+    if len(set(output_transforms)) != len(output_transforms):
+        raise click.BadParameter(
+            "The output pattern does not produce unique filenames for the moving images.", param_hint="--output-pattern"
+        )
+
+    cache, cache_keys = _registration_cache(args, (fixed_image, fixed_channel_name), moving_images)
+    results = [cache.get(key) if cache else None for key in cache_keys]
+    uncached = [i for i, result in enumerate(results) if result is None]
+
+    if uncached:
+        registered = _register_batch(args, fixed_image, fixed_channel_name, [moving_images[i] for i in uncached])
+        for i, result in zip(uncached, registered):
+            results[i] = result
+            if cache:
+                cache.put(cache_keys[i], *result)
+
+    transforms, telemetries = zip(*results)
+
+    if args.telemetry:
+        _write_telemetry(
+            args,
+            [
+                (telemetry, {"fixed": basename(fixed_image), "moving": basename(m)})
+                for telemetry, (m, _) in zip(telemetries, moving_images)
+            ],
+        )
+
+    for tx, output_transform in zip(transforms, output_transforms):
+        _logger.info('Writing transform "{}".'.format(output_transform))
+        sitk.WriteTransform(tx, output_transform)
+
+
+def _parse_shrink_factors(ctx, param, value):
+    """Convert the comma separated shrink factors of a multiple option into tuples of integers."""
+    try:
+        return [tuple(int(f) for f in v.split(",")) for v in value]
+    except ValueError:
+        raise click.BadParameter("The shrink factors must be comma separated integers, e.g. 8,4,2.")
+
+
+@cli.command(name="tune")
 @click.option(
     "-b",
     "--bin",
@@ -130,7 +567,12 @@ def cli(**kwargs):
     help="Reduce the resolution of the input images in X and Y by this factor",
 )
 @click.option("-s", "--sigma", default=1.0, type=float, show_default=True)
-@click.option("--affine/--no-affine", default=False, help="Do affine registration in a second step.")
+@click.option(
+    "--log-polar/--no-log-polar",
+    default=False,
+    show_default=True,
+    help="Also perform the 2D registration of the Z-projections initialized by the log-polar phase correlation.",
+)
 @click.option(
     "--automask/--no-automask",
     default=False,
@@ -138,54 +580,96 @@ def cli(**kwargs):
     help="Automatically compute a mask for the non-zero pixels of the input images",
 )
 @click.option(
-    "--ignore-spacing/--no-ignore-spacing",
-    default=True,
+    "--samples-per-parameter",
+    "samples_per_parameter_grid",
+    multiple=True,
+    type=click.IntRange(min=1),
+    default=[1000, 2500, 5000, 10000],
     show_default=True,
-    help="Ignore the magnitude of spacing, but preserve relative ratio.",
+    help="A number of samples per transform parameter evaluated, may be repeated.",
 )
 @click.option(
-    "--random/--no-random",
-    default=False,
+    "--shrink-factors",
+    "shrink_factors_3d_grid",
+    multiple=True,
+    callback=_parse_shrink_factors,
+    default=["8,4", "8,4,2", "4,2", "4,2,1", "8,4,2,1"],
     show_default=True,
-    help="Use wall-clock instead of a fixed seed for random initialization.",
+    help="Comma separated shrink factors of the levels of the affine registration evaluated, may be repeated.",
+)
+@click.option(
+    "--tolerance",
+    default=0.5,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    help="The maximum disagreement in pixels with the high effort reference registration.",
+)
+@click.option(
+    "--name",
+    default=None,
+    help="Write the recommended profile into the profile directory with this name, which registration loads by name.",
+)
+@click.option(
+    "-o",
+    "--output",
+    default=None,
+    type=click.Path(exists=False, dir_okay=False, resolve_path=True),
+    help="Write the recommended profile to this JSON file.",
 )
-@click.option("--samples-per-parameter", default=5000, type=int, show_default=True)
 @click.argument("fixed_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
 @click.argument("moving_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
-@click.argument("output_transform", type=click.Path(exists=False, resolve_path=True))
-def reg_cli(fixed_image, moving_image, output_transform, **kwargs):
-    """Perform registration to solve for an OUTPUT_TRANSFORM mapping points from the FIXED_IMAGE to the MOVING_IMAGE."""
-    from sitkibex.registration import registration
+def tune_cli(fixed_image, moving_image, **kwargs):
+    """Find the fastest registration profile of the FIXED_IMAGE and the MOVING_IMAGE agreeing with a high effort
+    registration.
 
-    args = _Bunch(kwargs)
+    The affine registration is performed with each combination of the numbers of samples per parameter and of the
+    shrink factors. The recommended profile is the fastest within the tolerance of the reference registration. For
+    example:
 
-    fixed_image, fixed_channel_name = fixed_image
-    moving_image, moving_channel_name = moving_image
+    >>> sitkibex tune --name spleen panel1.nrrd@CD4 panel2.nrrd@CD4
 
-    if args.random:
-        sitkibex.globals.default_random_seed = sitk.sitkWallClock
+    writes the "spleen" profile, used by registration with the "spleen" profile name.
+    """
+    from .profiles import profile_directory, tune_profile
 
-    def r(img, channel_name, bin_xy):
-        img = im_read_channel(img, channel_name)
-        img = sitk.Cast(img, sitk.sitkFloat32)
-        if bin != 1:
-            img = sitk.BinShrink(img, [bin_xy, bin_xy, 1])
-        return img
+    args = _Bunch(kwargs)
 
-    fixed_image = r(fixed_image, fixed_channel_name, args.bin)
-    moving_image = r(moving_image, moving_channel_name, args.bin)
+    if not args.name and not args.output:
+        raise click.UsageError("A profile --name or an --output file is required.")
 
-    tx = registration(
-        fixed_image,
-        moving_image,
+    profile, results = tune_profile(
+        _read_registration_image(*fixed_image, args.bin),
+        _read_registration_image(*moving_image, args.bin),
+        samples_per_parameter_grid=args.samples_per_parameter_grid,
+        shrink_factors_3d_grid=args.shrink_factors_3d_grid,
+        tolerance=args.tolerance,
         sigma=args.sigma,
-        do_affine3d=args.affine,
+        do_affine2d=args.log_polar,
+        log_polar_initialization=args.log_polar,
         auto_mask=args.automask,
-        ignore_spacing=args.ignore_spacing,
-        samples_per_parameter=args.samples_per_parameter,
     )
 
-    sitk.WriteTransform(tx, output_transform)
+    _logger.info("samples_per_parameter shrink_factors_3d duration disagreement")
+    for result in results:
+        _logger.info(
+            "{samples_per_parameter:21} {shrink_factors_3d!s:17} {duration:8.3f} {disagreement:12.3f}".format(**result)
+        )
+    _logger.info("Recommended profile: {}".format(profile))
+
+    output_filenames = [args.output] if args.output else []
+    if args.name:
+        profile_directory().mkdir(parents=True, exist_ok=True)
+        output_filenames.append(profile_directory() / "{}.json".format(args.name))
+    for filename in output_filenames:
+        _logger.info('Writing profile "{}".'.format(filename))
+        profile.save(filename)
+
+
+def _read_moving_image(filename, channel_name, bin_xy):
+    """Read the channel of the moving image to resample, several channels are read at once as a 4D XYZC image."""
+    if isinstance(channel_name, list):
+        return sitk.JoinSeries(im_read_channels(filename, channel_name, shrink_factors=_bin_shrink_factors(bin_xy)))
+    return im_read_channel(filename, channel_name, shrink_factors=_bin_shrink_factors(bin_xy))
 
 
 @cli.command(name="resample")
@@ -205,6 +689,13 @@ def reg_cli(fixed_image, moving_image, output_transform, **kwargs):
     help="Combine fixed and moving images into multi-component",
 )
 @click.option("--invert/--no-invert", default=False, show_default=True, help="invert the transform")
+@click.option(
+    "--collapse/--no-collapse",
+    default=False,
+    show_default=True,
+    help="Collapse a linear transform into one affine transform, or sample a non-linear transform into a displacement "
+    "field on a 4 times coarser grid, evaluated once for all the channels.",
+)
 @click.option(
     "--projection/--no-projection",
     default=False,
@@ -215,13 +706,29 @@ def reg_cli(fixed_image, moving_image, output_transform, **kwargs):
     "-o",
     "--output",
     default=None,
-    help="filename for output image, if not provided the SimpleITK Show method is called",
+    help="filename for output image, if not provided the SimpleITK Show method is called. A '.zarr' output is written "
+    "as OME-Zarr with a multiscale pyramid.",
     type=click.Path(exists=False, resolve_path=True),
 )
+@click.option(
+    "--block-size",
+    default=None,
+    type=(int, int, int),
+    help="Resample the output in blocks of this XYZ size, written to an uncompressed '.mha' or a '.zarr' output.",
+)
+@click.option(
+    "-j",
+    "--workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Number of blocks resampled concurrently. By default the number of CPUs.",
+)
 @click.argument("fixed_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
-@click.argument("moving_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True))
+@click.argument(
+    "moving_image", type=ImagePathChannel(exists=True, dir_okay=True, resolve_path=True, multiple_channels=True)
+)
 @click.argument("transform", required=False, type=click.Path(exists=True, dir_okay=False, resolve_path=True))
-def resample_cli(fixed_image, moving_image, transform, **kwargs):
+def resample_cli(fixed_image, moving_image, transform, **kwargs):  # noqa: C901
     """Create new image by transforming the MOVING_IMAGE onto the FIXED_IMAGE.
 
     Apply the TRANSFORM results from registration to resample the MOVING_IMAGE onto the coordinate space defined by the
@@ -235,25 +742,70 @@ def resample_cli(fixed_image, moving_image, transform, **kwargs):
 
     >>> sitkibex resample --bin 10 --fusion --projection -o preview.png fixed.nrrd moving.nrrd out.txt
 
-    If the moving image has more than 3 dimensions each sub-3d volume will be iteratively resampled.
+    If the moving image has 4 dimensions, each channel is resampled as a 3D image, and the channels are resampled
+    together when the transform is non-linear. With more dimensions, or with the fusion or combine options, each
+    sub-3d volume will be iteratively resampled.
+
+    Several channels of the moving image are read from the file at once with a comma separated list:
+
+    >>> sitkibex resample -o fixed_onto_moving.zarr fixed.nrrd moving.tif@CD3,CD4,DAPI out.txt
+
+    Large images can be resampled in blocks by multiple workers, writing each block into the output file as it is
+    completed, so the output image is never entirely in memory:
+
+    >>> sitkibex resample --block-size 1024 1024 64 -j 8 -o fixed_onto_moving.mha fixed.nrrd moving.nrrd@CD4 out.txt
 
     """
 
-    from .resample import resample
+    from .resample import resample, resample_tiled
 
     args = _Bunch(kwargs)
 
-    @utils.sub_volume_execute()
-    def binner(image):
-        if args.bin != 1:
-            return sitk.BinShrink(image, [args.bin, args.bin, 1])
-        else:
-            return image
+    if args.block_size:
+        if not args.output:
+            raise click.UsageError("An output file is required with the --block-size option.")
+        if args.fusion or args.combine or args.projection:
+            raise click.UsageError("The --block-size option can not be used with fusion, combine or projection.")
 
     moving_image, moving_channel_name = moving_image
     fixed_image, fixed_channel_name = fixed_image
 
-    moving_img = binner(im_read_channel(moving_image, moving_channel_name))
+    tx = None
+    if transform:
+        tx = sitk.ReadTransform(transform)
+
+    channel_names = None
+    if isinstance(moving_channel_name, str):
+        channel_names = [moving_channel_name]
+    elif isinstance(moving_channel_name, list):
+        channel_names = [str(c) for c in moving_channel_name]
+
+    if args.block_size:
+        # Only the geometry of the fixed image is needed, and the blocks of the moving image are read as needed
+        fixed_geometry = im_read_geometry(fixed_image, shrink_factors=_bin_shrink_factors(args.bin))
+        moving_img = ImageRegionReader(moving_image, moving_channel_name, shrink_factors=_bin_shrink_factors(args.bin))
+        if not moving_img.streaming:
+            # Reading a region of the file reads the whole file, so it is read once
+            moving_img = _read_moving_image(moving_image, moving_channel_name, args.bin)
+        moving_dimension = (
+            moving_img.dimension if isinstance(moving_img, ImageRegionReader) else moving_img.GetDimension()
+        )
+        if moving_dimension > 4:
+            raise click.UsageError("The --block-size option requires a 3D or 4D moving image, select a channel.")
+        resample_tiled(
+            fixed_geometry,
+            moving_img,
+            tx,
+            output_filename=args.output,
+            invert=args.invert,
+            block_size=args.block_size,
+            max_workers=args.workers,
+            channel_names=channel_names,
+            collapse=args.collapse,
+        )
+        return
+
+    moving_img = _read_moving_image(moving_image, moving_channel_name, args.bin)
 
     if fixed_channel_name is None and os.path.isfile(fixed_image):
         reader = sitk.ImageFileReader()
@@ -264,12 +816,7 @@ def resample_cli(fixed_image, moving_image, transform, **kwargs):
                 _logger.warning("Automatically selecting first channel with fusion enabled.")
             fixed_channel_name = 0
 
-    fixed_img = im_read_channel(fixed_image, fixed_channel_name)
-    fixed_img = binner(fixed_img)
-
-    tx = None
-    if transform:
-        tx = sitk.ReadTransform(transform)
+    fixed_img = im_read_channel(fixed_image, fixed_channel_name, shrink_factors=_bin_shrink_factors(args.bin))
 
     @utils.sub_volume_execute(inplace=False)
     def resample_sub_volume(mv_img):
@@ -281,11 +828,24 @@ def resample_cli(fixed_image, moving_image, transform, **kwargs):
             combine=args.combine,
             invert=args.invert,
             projection=args.projection,
+            collapse=args.collapse,
         )
 
-    result = resample_sub_volume(moving_img)
+    if moving_img.GetDimension() == 4 and not (args.fusion or args.combine):
+        result = resample(
+            fixed_img, moving_img, tx, invert=args.invert, projection=args.projection, collapse=args.collapse
+        )
+    else:
+        result = resample_sub_volume(moving_img)
 
-    if args.output:
+    if args.output and os.path.splitext(args.output)[1].lower() == ".zarr":
+        number_of_channels = (
+            result.GetSize()[3] if result.GetDimension() == 4 else result.GetNumberOfComponentsPerPixel()
+        )
+        if result.GetDimension() > 4 or channel_names is None or len(channel_names) != number_of_channels:
+            channel_names = None
+        im_write_zarr(result, args.output, channel_names=channel_names)
+    elif args.output:
         sitk.WriteImage(result, args.output)
     else:
         sitk.Show(result, title="Resampling of {}".format(basename(fixed_image)))
@@ -20,8 +20,21 @@ default_random_seed = 100
 """Random seed used for each registration called for reproducible results. If it is set to 0 the time will be used to
 initialized a seed."""
 
+channel_index_sidecar = False
+"""If the channel index of an image file, parsed from its header by `sitkibex.io.im_channel_index`, is also cached in a
+"<filename>.sitkibex.json" sidecar file next to the image file, so later processes do not parse the header again."""
+
+zarr_read_workers = None
+"""The number of threads reading and decompressing the chunks of a Zarr array concurrently. If None, the default of
+`concurrent.futures.ThreadPoolExecutor` for the number of CPUs is used."""
+
+zarr_read_ahead = 64
+"""The maximum number of chunks of a Zarr array read from the store ahead of their decompression, by a pool of
+`zarr_read_workers` threads. The compressed chunks read ahead are held in memory. If 0, the chunks are read when
+decompressed."""
+
 logger = logging.getLogger(__name__).parent
 """The parent `logger` object for all sub-loggers. It can be used to control the level of output and how the
  warning, info, and debug messages are handled."""
 
-__all__ = ["default_random_seed", "logger"]
+__all__ = ["default_random_seed", "channel_index_sidecar", "zarr_read_workers", "zarr_read_ahead", "logger"]
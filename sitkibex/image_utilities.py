@@ -14,6 +14,8 @@
 #  limitations under the License.
 #
 import SimpleITK as sitk
+import numpy as np
+import itertools
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -50,46 +52,161 @@ def project(image_3d, projection_func=sitk.MeanProjection):
     )
 
 
-def make_auto_mask(feature_image):
+def make_auto_mask(feature_image, shrink_factors=None):
     """
     :param feature_image: a gray scale image
+    :param shrink_factors: (optional) integer factors the feature image is binned by to compute a reduced resolution \
+    mask. A binned pixel is in the mask when any of its pixels is non-zero.
     :return: a binary ( 1's and 0's ) representing a mask of the none-zero pixels in the feature image.
     """
+    if shrink_factors is not None:
+        feature_image = sitk.BinShrink(feature_image, shrink_factors)
     return sitk.BinaryFillhole(feature_image != 0)
 
 
-def fft_initialization(moving, fixed, bin_shrink=8, projection=True):
+def _same_physical_space(image1, image2, tolerance=1e-6):
+    """Whether two images have the same size and the same origin, spacing and direction within the tolerance used by
+    SimpleITK filters, checked without allocating a pixel buffer."""
+
+    coordinate_tolerance = tolerance * image1.GetSpacing()[0]
+    return (
+        image1.GetSize() == image2.GetSize()
+        and np.allclose(image1.GetOrigin(), image2.GetOrigin(), rtol=0, atol=coordinate_tolerance)
+        and np.allclose(image1.GetSpacing(), image2.GetSpacing(), rtol=0, atol=coordinate_tolerance)
+        and np.allclose(image1.GetDirection(), image2.GetDirection(), rtol=0, atol=tolerance)
+    )
+
+
+def fft_operand(image, bin_shrink=8, projection=True):
     """
+    Compute the binned and smoothed image correlated by fft_initialization.
 
-    :param moving:
-    :param fixed:
-    :return:
+    :param image: A 3D SimpleITK Image, or a 2D image when already projected
+    :param bin_shrink: The factor the image is binned by in X and Y
+    :param projection: Project a 3D image along the z-dimension to 2D
+    :return: A SimpleITK Image of Float32 pixels
+    """
+
+    if projection and image.GetDimension() == 3:
+        image = project(image)
+
+    sigma = bin_shrink * image.GetSpacing()[0]
+    bin_shrink_list = [bin_shrink] * 2
+    if image.GetDimension() == 3:
+        bin_shrink_list += [1]
+
+    return sitk.Cast(sitk.SmoothingRecursiveGaussian(sitk.BinShrink(image, bin_shrink_list), sigma), sitk.sitkFloat32)
+
+
+def _local_maxima(arr):
+    """The flat indices of the pixels greater or equal to all their neighbors, compared with a shifted view per
+    neighbor offset."""
+
+    padded = np.pad(arr, 1, mode="constant", constant_values=arr.min())
+    is_maximum = np.ones(arr.shape, dtype=bool)
+    comparison = np.empty(arr.shape, dtype=bool)
+    center = (1,) * arr.ndim
+    for offset in itertools.product(range(3), repeat=arr.ndim):
+        if offset == center:
+            continue
+        neighbor = padded[tuple(slice(o, o + n) for o, n in zip(offset, arr.shape))]
+        np.greater_equal(arr, neighbor, out=comparison)
+        is_maximum &= comparison
+    return np.flatnonzero(is_maximum)
+
+
+def _refine_peak(arr, idx, tolerance):
+    """The sub-pixel position of the peak at idx from the parabola through the neighbors along each axis. Offsets
+    smaller than tolerance come from a nearly symmetric fit, and the integer index is kept."""
+
+    position = []
+    for axis, i in enumerate(idx):
+        offset = 0.0
+        if 0 < i < arr.shape[axis] - 1:
+            before, after = list(idx), list(idx)
+            before[axis] -= 1
+            after[axis] += 1
+            v_before, v, v_after = float(arr[tuple(before)]), float(arr[idx]), float(arr[tuple(after)])
+            curvature = v_before - 2.0 * v + v_after
+            if curvature < 0:
+                offset = min(max(0.5 * (v_before - v_after) / curvature, -0.5), 0.5)
+                if abs(offset) < tolerance:
+                    offset = 0.0
+        position.append(float(i + offset))
+    return position
+
+
+def find_peaks(image, number_of_peaks=1, min_distance=3.0, refinement_tolerance=0.05):
+    """
+    Find the highest local maxima of an image, with sub-pixel positions.
+
+    The pixels are accessed through a NumPy view of the image without copying. The local maxima are found by comparing
+    the image to its shifted neighbors, then only the maxima are sorted by value. The highest remaining maximum is a
+    peak, and the maxima closer than min_distance to it are removed, until number_of_peaks are found or no maxima
+    remain. The position of each peak is refined by a parabola fit along each axis.
+
+    :param image: A scalar SimpleITK Image
+    :param number_of_peaks: The maximum number of peaks returned
+    :param min_distance: The minimum distance in pixels between peaks
+    :param refinement_tolerance: Sub-pixel offsets smaller than this fraction of a pixel are not applied, so a peak
+     centered on a pixel is at the exact index.
+    :return: A list of pairs of the continuous index and the value of the peaks, in decreasing order of value.
+    """
+
+    arr = sitk.GetArrayViewFromImage(image)
+    values = arr.reshape(-1)
+
+    maxima = _local_maxima(arr)
+    maxima = maxima[np.argsort(-values[maxima], kind="stable")]
+    maxima_idx = np.stack(np.unravel_index(maxima, arr.shape), axis=-1)
+
+    peaks = []
+    while len(maxima_idx) and len(peaks) < number_of_peaks:
+        peak_idx = tuple(int(i) for i in maxima_idx[0])
+        peaks.append(peak_idx)
+        distance = np.linalg.norm(maxima_idx - maxima_idx[0], axis=-1)
+        maxima_idx = maxima_idx[distance >= min_distance]
+
+    return [(_refine_peak(arr, idx, refinement_tolerance)[::-1], float(arr[idx])) for idx in peaks]
+
+
+def fft_candidates(moving, fixed, bin_shrink=8, projection=True, fixed_operand=None, number_of_candidates=5):
+    """
+    Estimate candidate translations between two images from the peaks of the FFT based normalized cross correlation.
+
+    :param moving: A 3D SimpleITK Image
+    :param fixed: A 3D SimpleITK Image, or a 2D image when already projected
+    :param bin_shrink: The factor the images are binned by in X and Y before correlation
+    :param projection: Correlate the z-projections of the images
+    :param fixed_operand: (optional) The result of fft_operand for the fixed image computed with the same bin_shrink
+     and projection, which is reused when registering to the same fixed image repeatedly.
+    :param number_of_candidates: The maximum number of peaks of the correlation returned
+    :return: A list of pairs of a translation mapping points from the fixed to the moving image and its correlation,
+     in decreasing order of correlation.
     """
 
     if projection:
         moving = project(moving)
-        fixed = project(fixed)
-
-    try:
-        moving + fixed
-    except RuntimeError:
-        # The addition operator will throw an exception of the images don't occupy the same space like the
-        # MaskedFFTNormalizedCorrelation filter. If an exception is thrown resample onto the fixed image with the
-        # identity transform. With the 3d->2d projection already making the direction matrix identity, only the origin,
-        # spacing will be considered. Additionally, moth images will be the same number of pixels as required.
+        if fixed.GetDimension() == 3:
+            fixed = project(fixed)
+
+    if not _same_physical_space(moving, fixed):
+        # The MaskedFFTNormalizedCorrelation filter requires the images to occupy the same space, otherwise resample
+        # onto the fixed image with the identity transform. With the 3d->2d projection already making the direction
+        # matrix identity, only the origin, spacing will be considered. Additionally, both images will be the same
+        # number of pixels as required.
         resampler = sitk.ResampleImageFilter()
         resampler.SetReferenceImage(fixed)
         moving = resampler.Execute(moving)
 
     fraction_overlap = 0.5
-    sigma = bin_shrink * fixed.GetSpacing()[0]
     pixel_type = sitk.sitkFloat32
-    bin_shrink_list = [bin_shrink] * 2
-    if moving.GetDimension() == 3:
-        bin_shrink_list += [1]
 
-    fft_moving = sitk.Cast(sitk.SmoothingRecursiveGaussian(sitk.BinShrink(moving, bin_shrink_list), sigma), pixel_type)
-    fft_fixed = sitk.Cast(sitk.SmoothingRecursiveGaussian(sitk.BinShrink(fixed, bin_shrink_list), sigma), pixel_type)
+    fft_moving = fft_operand(moving, bin_shrink, projection=False)
+    if fixed_operand is not None:
+        fft_fixed = fixed_operand
+    else:
+        fft_fixed = fft_operand(fixed, bin_shrink, projection=False)
 
     _logger.info("FFT Correlation...")
     out = sitk.MaskedFFTNormalizedCorrelation(
@@ -102,24 +219,155 @@ def fft_initialization(moving, fixed, bin_shrink=8, projection=True):
 
     _logger.info("Smoothing...")
     out = sitk.SmoothingRecursiveGaussian(out)
-    _logger.info("Detecting peak...")
-    _logger.info("\tConnected components and maxima...")
-    cc = sitk.ConnectedComponent(sitk.RegionalMaxima(out, fullyConnected=True))
-    _logger.info("\tLabel statistics...")
-    stats = sitk.LabelStatisticsImageFilter()
-    stats.Execute(out, cc)
-    labels = sorted(stats.GetLabels(), key=lambda l_id: stats.GetMean(l_id))
-
-    peak_idx = stats.GetBoundingBox(labels[-1])[::2]
-    peak_idx = [i + 0.5 for i in peak_idx]
-    peak_pt = out.TransformContinuousIndexToPhysicalPoint(peak_idx)
-    peak_value = stats.GetMean(labels[-1])
-
+    _logger.info("Detecting peaks...")
     center_pt = out.TransformContinuousIndexToPhysicalPoint([p / 2.0 for p in out.GetSize()])
 
-    translation = [c - p for c, p in zip(center_pt, peak_pt)]
-    translation += [0] * (moving.GetDimension() - len(translation))
+    candidates = []
+    for peak_idx, peak_value in find_peaks(out, number_of_candidates):
+        # The zero translation is between the two center pixels of the correlation
+        peak_pt = out.TransformContinuousIndexToPhysicalPoint([i + 0.5 for i in peak_idx])
+        translation = [c - p for c, p in zip(center_pt, peak_pt)]
+        translation += [0] * (moving.GetDimension() - len(translation))
+        candidates.append((translation, peak_value))
+
+        _logger.info("FFT peak correlation of {0} at translation of {1}".format(peak_value, translation))
 
-    _logger.info("FFT peak correlation of {0} at translation of {1}".format(peak_value, translation))
+    return candidates
 
-    return translation
+
+def fft_initialization(moving, fixed, bin_shrink=8, projection=True, fixed_operand=None):
+    """
+    Estimate the translation between two images from the peak of the FFT based normalized cross correlation.
+
+    :param moving: A 3D SimpleITK Image
+    :param fixed: A 3D SimpleITK Image, or a 2D image when already projected
+    :param bin_shrink: The factor the images are binned by in X and Y before correlation
+    :param projection: Correlate the z-projections of the images
+    :param fixed_operand: (optional) The result of fft_operand for the fixed image computed with the same bin_shrink
+     and projection, which is reused when registering to the same fixed image repeatedly.
+    :return: The translation mapping points from the fixed to the moving image.
+    """
+
+    candidates = fft_candidates(
+        moving, fixed, bin_shrink=bin_shrink, projection=projection, fixed_operand=fixed_operand, number_of_candidates=1
+    )
+    return candidates[0][0]
+
+
+def _bilinear(arr, y, x):
+    """Sample arr at the continuous indices y and x with bilinear interpolation."""
+
+    y0 = np.clip(np.floor(y).astype(int), 0, arr.shape[0] - 2)
+    x0 = np.clip(np.floor(x).astype(int), 0, arr.shape[1] - 2)
+    wy, wx = y - y0, x - x0
+    return (
+        arr[y0, x0] * (1 - wy) * (1 - wx)
+        + arr[y0 + 1, x0] * wy * (1 - wx)
+        + arr[y0, x0 + 1] * (1 - wy) * wx
+        + arr[y0 + 1, x0 + 1] * wy * wx
+    )
+
+
+def _log_polar_spectrum(arr, number_of_angles, number_of_radii):
+    """The high-pass filtered magnitude of the Fourier transform of arr on a log-polar grid of angles in [0, pi).
+
+    The magnitude does not depend on a translation of arr, and a rotation of arr is a shift along the angle axis.
+    """
+
+    h, w = arr.shape
+    window = np.outer(np.hanning(h), np.hanning(w))
+    magnitude = np.fft.fftshift(np.abs(np.fft.fft2((arr - arr.mean()) * window)))
+
+    # Emphasize the high frequencies, as the low frequencies are dominated by the window
+    fy, fx = np.meshgrid(np.fft.fftshift(np.fft.fftfreq(h)), np.fft.fftshift(np.fft.fftfreq(w)), indexing="ij")
+    x = np.cos(np.pi * fy) * np.cos(np.pi * fx)
+    magnitude *= (1.0 - x) * (2.0 - x)
+
+    angles = np.arange(number_of_angles) * np.pi / number_of_angles
+    radii = np.exp(np.linspace(0.0, np.log(min(h, w) / 2.0 - 1.0), number_of_radii))
+    return _bilinear(
+        magnitude,
+        h // 2 + np.outer(np.sin(angles), radii),
+        w // 2 + np.outer(np.cos(angles), radii),
+    )
+
+
+def _phase_correlation(arr1, arr2):
+    """The phase correlation of two arrays, with a peak at the circular shift of arr2 onto arr1."""
+
+    cross_power = np.fft.fft2(arr1) * np.conj(np.fft.fft2(arr2))
+    return np.real(np.fft.ifft2(cross_power / (np.abs(cross_power) + 1e-12)))
+
+
+def log_polar_rotation(moving, fixed, bin_shrink=8, number_of_angles=360, number_of_candidates=3):
+    """
+    Estimate the rigid transform between two 2D images in closed form with the Fourier-Mellin method.
+
+    The images are smoothed and resampled onto a common isotropic grid, binned by bin_shrink. A rotation is a shift
+    along the angle axis of the log-polar magnitude spectra, which do not depend on the translation, and the highest
+    peaks of their phase correlation are candidate angles. The magnitude spectrum cannot distinguish a rotation from
+    the rotation by 180 degrees, so the moving image is rotated by each candidate angle and its opposite, and the
+    rotation and translation with the highest FFT normalized cross correlation are kept.
+
+    :param moving: A 2D SimpleITK Image, such as a z-projection
+    :param fixed: A 2D SimpleITK Image, such as a z-projection
+    :param bin_shrink: The factor of the spacing of the common grid to the largest spacing of the fixed image
+    :param number_of_angles: The number of angles sampled in 180 degrees
+    :param number_of_candidates: The number of peaks of the phase correlation verified
+    :return: A pair of a SimpleITK Euler2DTransform mapping points from the fixed image to the moving image and the
+     correlation of the translation. The identity rotation with a correlation of 0 when no peak is found, e.g. for a
+     blank or fully masked image.
+    """
+
+    spacing = max(fixed.GetSpacing()) * bin_shrink
+    size = [max(2, int(sz * sp / spacing)) for sz, sp in zip(fixed.GetSize(), fixed.GetSpacing())]
+    reference = sitk.Image(size, sitk.sitkFloat32)
+    reference.SetSpacing([spacing] * 2)
+    reference.SetOrigin(fixed.GetOrigin())
+    reference.SetDirection(fixed.GetDirection())
+    center = reference.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2.0 for s in size])
+
+    def to_grid(image, transform=sitk.Transform()):
+        return sitk.Resample(image, reference, transform, sitk.sitkLinear, 0.0, sitk.sitkFloat32)
+
+    fixed_grid = to_grid(sitk.SmoothingRecursiveGaussian(sitk.Cast(fixed, sitk.sitkFloat32), spacing / 2.0))
+    moving = sitk.SmoothingRecursiveGaussian(sitk.Cast(moving, sitk.sitkFloat32), spacing / 2.0)
+    moving_grid = to_grid(moving)
+    number_of_radii = max(size)
+    correlation = _phase_correlation(
+        _log_polar_spectrum(sitk.GetArrayViewFromImage(moving_grid), number_of_angles, number_of_radii),
+        _log_polar_spectrum(sitk.GetArrayViewFromImage(fixed_grid), number_of_angles, number_of_radii),
+    )
+    # A rigid transform does not change the scale, so only the shifts along the angle axis are considered. The few
+    # highest peaks are verified, as the axes of the pixel grid and the borders of the images add spurious peaks.
+    profile = correlation[:, 0]
+    maxima = np.flatnonzero((profile >= np.roll(profile, 1)) & (profile >= np.roll(profile, -1)))
+    maxima = maxima[np.argsort(-profile[maxima], kind="stable")[:number_of_candidates]]
+
+    fixed_operand = fft_operand(fixed_grid, bin_shrink=1, projection=False)
+    best = None
+    for angle in [a * np.pi / number_of_angles + half_turn for a in maxima for half_turn in (0.0, np.pi)]:
+        rotation = sitk.Euler2DTransform(center, angle)
+        candidates = fft_candidates(
+            to_grid(moving, rotation),
+            fixed_grid,
+            bin_shrink=1,
+            projection=False,
+            fixed_operand=fixed_operand,
+            number_of_candidates=1,
+        )
+        if candidates and (best is None or candidates[0][1] > best[2]):
+            best = (rotation, candidates[0][0], candidates[0][1])
+
+    if best is None:
+        _logger.warning("No peak of the log-polar correlation was found, using the identity rotation.")
+        return sitk.Euler2DTransform(center, 0.0), 0.0
+
+    rotation, translation, peak_value = best
+    # The rotated moving image is translated by the FFT translation before the rotation
+    matrix = np.array(rotation.GetMatrix()).reshape(2, 2)
+    rotation.SetTranslation((matrix @ np.array(translation[:2])).tolist())
+    _logger.info(
+        "Log-polar rotation of {0} and translation of {1}".format(rotation.GetAngle(), rotation.GetTranslation())
+    )
+    return rotation, peak_value
@@ -16,8 +16,18 @@
 import SimpleITK as sitk
 
 import os.path
+import itertools
+import json
 import logging
+import math
+import threading
+import time
+import sitkibex.globals
 from .xml_info import XMLInfo, OMEInfo
+from .registration_utilities import sub_volume_execute
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from pathlib import Path
 import numpy as np
 
@@ -43,33 +53,487 @@ _vector_to_scalar = {
 }
 
 
-def _zarr_read_channel(filename: Path, channel=None) -> sitk.Image:
+_numpy_to_metaimage_type = {
+    np.dtype(np.uint8): "MET_UCHAR",
+    np.dtype(np.int8): "MET_CHAR",
+    np.dtype(np.uint16): "MET_USHORT",
+    np.dtype(np.int16): "MET_SHORT",
+    np.dtype(np.uint32): "MET_UINT",
+    np.dtype(np.int32): "MET_INT",
+    np.dtype(np.uint64): "MET_ULONG_LONG",
+    np.dtype(np.int64): "MET_LONG_LONG",
+    np.dtype(np.float32): "MET_FLOAT",
+    np.dtype(np.float64): "MET_DOUBLE",
+}
+
+
+def _shrink_factors_xyz(shrink_factors):
+    """Convert an integer bin factor for X and Y, or a sequence of XYZ factors, into a list of XYZ factors."""
+    if shrink_factors is None:
+        return None
+    if isinstance(shrink_factors, int):
+        shrink_factors = [shrink_factors, shrink_factors, 1]
+    shrink_factors = [int(f) for f in shrink_factors]
+    if len(shrink_factors) != 3 or any(f < 1 for f in shrink_factors):
+        raise ValueError("Shrink factors must be 3 positive integers, not {}.".format(shrink_factors))
+    return shrink_factors
+
+
+def _apply_region(extract_index, extract_size, region):
+    """Restrict the XYZ extent of the extraction index and size, in-place, to the region."""
+    if region is None:
+        return
+
+    region_index, region_size = region
+    if len(region_index) != 3 or len(region_size) != 3:
+        raise ValueError("The region must be an index and size in XYZ, not {}.".format(region))
+
+    for d in range(3):
+        if region_index[d] < 0 or region_size[d] < 1 or region_index[d] + region_size[d] > extract_size[d]:
+            raise ValueError("The region {} is outside the image size {}.".format(region, extract_size[:3]))
+        extract_index[d] += region_index[d]
+        extract_size[d] = region_size[d]
+
+
+# The ImageIOs reading only the requested region of a file, instead of the whole file for each read
+_streaming_image_ios = {"MetaImageIO"}
+
+# The maximum number of pixels in a slab read by _read_binned
+_binned_read_slab_pixels = 2**26
+
+
+@sub_volume_execute(inplace=False)
+def _bin_shrink(image, shrink_factors):
+    return sitk.BinShrink(image, shrink_factors)
+
+
+@sub_volume_execute(inplace=False)
+def _cast(image, pixel_id):
+    return sitk.Cast(image, pixel_id)
+
+
+def _read_binned(reader, extract_index, extract_size, shrink_factors, slab_func=None, streaming=True):
+    """
+    Read the extraction region with the reader, binning as the image is read.
+
+    When the ImageIO of the reader supports streaming, the region is read in slabs of z-slices, a multiple of the z
+    shrink factor thick, so the memory used is bounded by the size of one slab and the binned output. Otherwise, each
+    read would load the whole file, so the region is read at once and then binned.
+    """
+
+    z_shrink = shrink_factors[2]
+    number_of_binned_slices = extract_size[2] // z_shrink
+    if number_of_binned_slices == 0 or any(s != 0 and s < f for s, f in zip(extract_size, shrink_factors)):
+        raise ValueError(
+            "The region size {} is smaller than the shrink factors {}.".format(extract_size, shrink_factors)
+        )
+
+    if not streaming:
+        reader.SetExtractIndex(extract_index)
+        reader.SetExtractSize(extract_size)
+        img = reader.Execute()
+        if slab_func is not None:
+            img = slab_func(img)
+        return _bin_shrink(img, shrink_factors)
+
+    # The slabs are as thick as possible within the number of pixels, to limit the overhead of each read
+    slice_pixels = int(np.prod([s for d, s in enumerate(extract_size) if s != 0 and d != 2]))
+    binned_slices_per_slab = max(1, _binned_read_slab_pixels // (slice_pixels * z_shrink))
+
+    slab_index = list(extract_index)
+    slab_size = list(extract_size)
+
+    output_arr = None
+    for binned_start in range(0, number_of_binned_slices, binned_slices_per_slab):
+        binned_stop = min(binned_start + binned_slices_per_slab, number_of_binned_slices)
+        slab_index[2] = extract_index[2] + binned_start * z_shrink
+        slab_size[2] = (binned_stop - binned_start) * z_shrink
+        reader.SetExtractIndex(slab_index)
+        reader.SetExtractSize(slab_size)
+        img = reader.Execute()
+        if slab_func is not None:
+            img = slab_func(img)
+        img = _bin_shrink(img, shrink_factors)
+
+        # The z-axis of the array is after the axes of the higher dimensions
+        z_axis = img.GetDimension() - 3
+        slab_arr = sitk.GetArrayViewFromImage(img)
+        if output_arr is None:
+            output_shape = list(slab_arr.shape)
+            output_shape[z_axis] = number_of_binned_slices
+            output_arr = np.empty(output_shape, dtype=slab_arr.dtype)
+            first_slab = img
+
+        output_arr[(slice(None),) * z_axis + (slice(binned_start, binned_stop),)] = slab_arr
+
+    output = sitk.GetImageFromArray(output_arr, isVector=first_slab.GetNumberOfComponentsPerPixel() > 1)
+    del output_arr
+    output.SetOrigin(first_slab.GetOrigin())
+    output.SetSpacing(first_slab.GetSpacing())
+    output.SetDirection(first_slab.GetDirection())
+    return output
+
+
+def _zarr_coordinate_transformations(attrs, number_of_axes):
+    """Return the scale and translation from the "coordinateTransformations" of the multiscales or dataset attrs."""
+    scale = [1.0] * number_of_axes
+    translation = [0.0] * number_of_axes
+    for transformation in attrs.get("coordinateTransformations", []):
+        if transformation["type"] == "scale":
+            scale = transformation["scale"]
+        elif transformation["type"] == "translation":
+            translation = transformation["translation"]
+    return scale, translation
+
+
+def _zarr_levels(multiscale):
+    """
+    The pyramid levels of an OME-Zarr multiscale.
+
+    :return: A list of the dataset path, scale and translation for each level. The scale and translation are in the
+    order of the axes, and include the transformations of the multiscale.
+    """
+
+    number_of_axes = len(multiscale["axes"])
+    ms_scale, ms_translation = _zarr_coordinate_transformations(multiscale, number_of_axes)
+
+    levels = []
+    for ds_attr in multiscale["datasets"]:
+        ds_scale, ds_translation = _zarr_coordinate_transformations(ds_attr, number_of_axes)
+        scale = [s * ms_s for s, ms_s in zip(ds_scale, ms_scale)]
+        translation = [t * ms_s + ms_t for t, ms_s, ms_t in zip(ds_translation, ms_scale, ms_translation)]
+        levels.append((ds_attr["path"], scale, translation))
+    return levels
+
+
+def _zarr_select_level(levels, shrink_factors):
+    """
+    Select the coarsest pyramid level with XYZ down-sampling factors which divide the shrink factors.
+
+    :return: The index of the selected level and its XYZ down-sampling factors relative to the first level.
+    """
+
+    selected_level, selected_factors = 0, [1, 1, 1]
+    if shrink_factors is None:
+        return selected_level, selected_factors
+
+    base_scale = levels[0][1]
+    for level, (_, scale, _) in enumerate(levels[1:], start=1):
+        # the TCZYX scale to XYZ factors
+        factors = [s / b for s, b in zip(scale[:1:-1], base_scale[:1:-1])]
+        if any(abs(f - round(f)) > 1e-3 * f for f in factors):
+            continue
+        factors = [int(round(f)) for f in factors]
+        if all(sf % f == 0 for sf, f in zip(shrink_factors, factors)):
+            if np.prod(factors) > np.prod(selected_factors):
+                selected_level, selected_factors = level, factors
+
+    return selected_level, selected_factors
+
+
+def _zarr_read_blocks(
+    arr, leading_index, extract_index, extract_size, shrink_factors, max_workers=None, read_ahead=None
+):
+    """
+    Read the XYZ region of a zarr array by blocks of whole chunks, decompressed concurrently by a pool of threads.
+
+    The chunks are read from the store by another pool of threads ahead of their decompression, and the throughput
+    of the read is logged.
+
+    The blocks span the region in X, and are whole chunks and whole bins in Y and Z, so each block is binned as it is
+    read by BinShrink without a bin crossing blocks. Only the output array and the blocks being read are in memory, and
+    the pixels are only converted when the byte order is not native.
+
+    :param arr: A zarr array with TCZYX axes.
+    :param leading_index: The index of the time point and the channel, or a slice of the channels of a vector image.
+    :param extract_index: The XYZ index of the region in the array.
+    :param extract_size: The XYZ size of the region.
+    :param shrink_factors: The XYZ factors to bin the region by, or None.
+    :param max_workers: The number of threads of each pool, by default `sitkibex.globals.zarr_read_workers`.
+    :param read_ahead: The maximum number of chunks read ahead, by default `sitkibex.globals.zarr_read_ahead`.
+    :return: A ZYX numpy array, or ZYXC when the channels are selected with a slice, of the binned region.
+    """
+
+    factors = shrink_factors or [1, 1, 1]
+    binned_size = [s // f for s, f in zip(extract_size, factors)]
+    if any(s == 0 for s in binned_size):
+        raise ValueError("The region size {} is smaller than the shrink factors {}.".format(extract_size, factors))
+
+    is_vector = isinstance(leading_index[-1], slice)
+    number_of_channels = len(range(arr.shape[1])[leading_index[-1]]) if is_vector else 1
+
+    # The XYZ ranges of the blocks in the pixels of the region
+    chunks_xyz = arr.chunks[:1:-1]
+    block_ranges = [[(0, binned_size[0] * factors[0])]] + [
+        _zarr_block_ranges(i, b * f, c, f)
+        for i, b, c, f in zip(extract_index[1:], binned_size[1:], chunks_xyz[1:], factors[1:])
+    ]
+
+    output = np.empty(
+        binned_size[::-1] + ([number_of_channels] if is_vector else []), dtype=arr.dtype.newbyteorder("=")
+    )
+
+    def block_selection(block):
+        """The selection of the block of XYZ ranges in the array."""
+        return tuple(leading_index) + tuple(slice(e_i + i, e_i + e) for e_i, (i, e) in zip(extract_index, block))[::-1]
+
+    def read_block(block):
+        block_arr = read_ahead_arr[block_selection(block)]
+        if is_vector:
+            block_arr = np.moveaxis(block_arr, 0, -1)
+        if shrink_factors is not None:
+            img = sitk.BinShrink(
+                sitk.GetImageFromArray(block_arr.astype(output.dtype, copy=False), isVector=is_vector), shrink_factors
+            )
+            block_arr = sitk.GetArrayViewFromImage(img)
+        output[tuple(slice(i // f, e // f) for (i, e), f in zip(block, factors))[::-1]] = block_arr
+
+    blocks = [(x, y, z) for z in block_ranges[2] for y in block_ranges[1] for x in block_ranges[0]]
+
+    if max_workers is None:
+        max_workers = sitkibex.globals.zarr_read_workers
+    if read_ahead is None:
+        read_ahead = sitkibex.globals.zarr_read_ahead
+
+    # The chunks are read from the files ahead of the blocks, in the order the blocks decompress them
+    keys = _zarr_chunk_keys(arr, [block_selection(block) for block in blocks])
+    chunk_read_ahead = _ChunkReadAhead(arr.chunk_store, keys, read_ahead, max_workers=max_workers)
+    read_ahead_arr = zarr.Array(
+        arr.store, path=arr.path, read_only=True, chunk_store=_read_ahead_store_class()(chunk_read_ahead)
+    )
+
+    start_time = time.perf_counter()
+    with chunk_read_ahead, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results to raise the exceptions of the blocks
+        for _ in executor.map(read_block, blocks):
+            pass
+    duration = max(time.perf_counter() - start_time, 1e-9)
+
+    _logger.info(
+        "Read {0} chunks of {1:.1f} MB in {2:.2f} s: {3:.1f} MB/s, {4:.1f} chunks/s, {5:.1f} MB/s decompressed.".format(
+            chunk_read_ahead.number_of_chunks,
+            chunk_read_ahead.number_of_bytes / 2**20,
+            duration,
+            chunk_read_ahead.number_of_bytes / 2**20 / duration,
+            chunk_read_ahead.number_of_chunks / duration,
+            output.nbytes * np.prod(factors) / 2**20 / duration,
+        )
+    )
+
+    return output
+
+
+def _zarr_block_ranges(start, size, chunk, factor):
+    """
+    The ranges of the blocks of one dimension of a region of a chunked array, relative to the start of the region.
+
+    The blocks are whole bins of the factor, and the least common multiple of the chunk size and the factor long. The
+    boundaries of the blocks are on the boundaries of the chunks, so each chunk is in one block, unless the start of
+    the region is not aligned with the chunks modulo the factor.
+    """
+
+    step = math.lcm(chunk, factor)
+    # the first chunk boundary after the start, which is also a bin boundary
+    first = next(
+        (
+            p - start
+            for p in range((start // chunk + 1) * chunk, start + step + chunk, chunk)
+            if (p - start) % factor == 0
+        ),
+        step,
+    )
+    boundaries = [0] + list(range(first, size, step)) + [size]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _zarr_chunk_keys(arr, selections):
+    """
+    The keys of the chunks of a zarr array intersecting the selections of integers and slices, in the order read.
+
+    The keys are made from the path, the chunks and the dimension separator of the metadata of the array in the store.
+    """
+
+    metadata = json.loads(arr.store[(arr.path + "/" if arr.path else "") + ".zarray"])
+    separator = metadata.get("dimension_separator") or "."
+    prefix = arr.path + "/" if arr.path else ""
+
+    keys = []
+    for selection in selections:
+        ranges = []
+        for s, c, n in zip(selection, arr.chunks, arr.shape):
+            start, stop = (s, s + 1) if isinstance(s, int) else (s.start or 0, n if s.stop is None else s.stop)
+            ranges.append(range(start // c, (stop - 1) // c + 1))
+        keys.extend(prefix + separator.join(map(str, coords)) for coords in itertools.product(*ranges))
+    return keys
+
+
+class _ChunkReadAhead:
+    """
+    Read the chunks of a zarr store ahead of their use, by a pool of threads.
+
+    The chunks are read in the order of the keys, at most read_ahead chunks ahead, so reading the files overlaps the
+    decompression of the chunks already read. The chunks and the bytes read are counted in `number_of_chunks` and
+    `number_of_bytes`.
+
+    :param store: The mapping of the keys to the compressed chunks.
+    :param keys: The keys of the chunks, in the order they are used.
+    :param read_ahead: The maximum number of chunks read ahead, 0 to read the chunks when they are used.
+    :param max_workers: The number of threads reading the chunks.
+    """
+
+    def __init__(self, store, keys, read_ahead, max_workers=None):
+        self.store = store
+        self._keys = list(keys)
+        self._remaining = Counter(self._keys)
+        self._position = 0
+        self._futures = {}
+        self._read_ahead = read_ahead
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if read_ahead > 0 else None
+        self.number_of_chunks = 0
+        self.number_of_bytes = 0
+        self._prefetch()
+
+    def _read(self, key):
+        value = self.store[key]
+        with self._lock:
+            self.number_of_chunks += 1
+            self.number_of_bytes += len(value)
+        return value
+
+    def _prefetch(self):
+        if self._executor is None:
+            return
+        with self._lock:
+            while len(self._futures) < self._read_ahead and self._position < len(self._keys):
+                key = self._keys[self._position]
+                self._position += 1
+                # a key is only read once at a time, and not when it was read without the read-ahead
+                if self._remaining[key] > 0 and key not in self._futures:
+                    self._remaining[key] -= 1
+                    self._futures[key] = self._executor.submit(self._read, key)
+
+    def get(self, keys):
+        """The dictionary of the chunks of the keys, without the missing chunks."""
+
+        values = {}
+        for key in keys:
+            with self._lock:
+                future = self._futures.pop(key, None)
+                if future is None and self._remaining[key] > 0:
+                    self._remaining[key] -= 1
+            try:
+                values[key] = self._read(key) if future is None else future.result()
+            except KeyError:
+                # a missing chunk has the fill value
+                pass
+            self._prefetch()
+        return values
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+            self._futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@lru_cache(maxsize=None)
+def _read_ahead_store_class():
+    """
+    The class of a read-only zarr store of the chunks of a _ChunkReadAhead, defined when zarr is used.
+
+    zarr 2 reads the chunks of a selection with the `getitems` method of the store, which is hooked to the read-ahead.
+    """
+
+    class _ReadAheadStore(zarr.storage.Store):
+        _readable = True
+        _writeable = False
+        _erasable = False
+        _listable = True
+
+        def __init__(self, read_ahead):
+            self._read_ahead = read_ahead
+
+        def getitems(self, keys, *, contexts):
+            return self._read_ahead.get(keys)
+
+        def __getitem__(self, key):
+            return self._read_ahead.store[key]
+
+        def __contains__(self, key):
+            return key in self._read_ahead.store
+
+        def __iter__(self):
+            return iter(self._read_ahead.store)
+
+        def __len__(self):
+            return len(self._read_ahead.store)
+
+        def __setitem__(self, key, value):
+            raise zarr.errors.ReadOnlyError()
+
+        def __delitem__(self, key):
+            raise zarr.errors.ReadOnlyError()
+
+        def listdir(self, path=None):
+            return self._read_ahead.store.listdir(path)
+
+    return _ReadAheadStore
+
+
+def _zarr_read_channel(filename: Path, channel=None, region=None, shrink_factors=None) -> sitk.Image:
     """
     Read a channel from a zarr file.
+
+    Only the chunks of the zarr array intersecting the region are read. With shrink factors, the coarsest level of the
+    multiscale pyramid whose down-sampling divides the shrink factors is read, and then binned by the remaining factors.
+    The region is in the pixel coordinates of the full resolution level. The chunks are read concurrently in blocks
+    binned as they are read by `_zarr_read_blocks`.
     """
 
     store = zarr.DirectoryStore(filename)
     zarr_group = zarr.open_group(store=store, mode="r")
 
-    axes = zarr_group.attrs["multiscales"][0]["axes"]
-    ds_attr = zarr_group.attrs["multiscales"][0]["datasets"][0]
-
-    arr = zarr_group[ds_attr["path"]]
-    _logger.debug(arr)
-
-    spacing = ds_attr["coordinateTransformations"][0]["scale"]
+    multiscale = zarr_group.attrs["multiscales"][0]
+    axes = multiscale["axes"]
 
     axes_names = [ax["name"].upper() for ax in axes]
 
     if axes_names != list("TCZYX"):
         raise ValueError(f"Only TCZYX axes are supported, not {axes_names}.")
 
+    levels = _zarr_levels(multiscale)
+    level, level_factors = _zarr_select_level(levels, shrink_factors)
+    path, scale, translation = levels[level]
+
+    # the region in full resolution XYZ pixels
+    extract_index = [0, 0, 0]
+    extract_size = list(zarr_group[levels[0][0]].shape[:1:-1])
+    _apply_region(extract_index, extract_size, region)
+
+    arr = zarr_group[path]
+    _logger.debug(arr)
+
+    if level != 0:
+        _logger.info("Reading multiscale level {} down-sampled by {}.".format(path, level_factors))
+        extract_end = [
+            min((i + s) // f, a) for i, s, f, a in zip(extract_index, extract_size, level_factors, arr.shape[:1:-1])
+        ]
+        extract_index = [i // f for i, f in zip(extract_index, level_factors)]
+        extract_size = [e - i for e, i in zip(extract_end, extract_index)]
+        shrink_factors = [sf // f for sf, f in zip(shrink_factors, level_factors)]
+
     if arr.shape[0] > 1:
         raise ValueError("Only single time point is supported.")
 
     if channel is None:
-        arr = np.moveaxis(arr[0, ...], 0, -1)
-        img = sitk.GetImageFromArray(arr.astype(arr.dtype.newbyteorder("=")), isVector=True)
+        leading_index = (0, slice(None))
     else:
 
         if isinstance(channel, int):
@@ -87,141 +551,996 @@ def _zarr_read_channel(filename: Path, channel=None) -> sitk.Image:
         if channel_number >= arr.shape[1] or channel_number < 0:
             raise ValueError("Channel number is out of range.")
 
-        arr = arr[0, channel_number, ...]
-        img = sitk.GetImageFromArray(arr.astype(arr.dtype.newbyteorder("=")), isVector=False)
+        leading_index = (0, channel_number)
+
+    if shrink_factors is not None and all(f == 1 for f in shrink_factors):
+        shrink_factors = None
+
+    output = _zarr_read_blocks(arr, leading_index, extract_index, extract_size, shrink_factors)
+    img = sitk.GetImageFromArray(output, isVector=channel is None)
+    del output
 
     # Select XYZ spacing from input TCZYX
-    img.SetSpacing(spacing[:1:-1])
+    spacing = scale[:1:-1]
+    origin = [t + i * s for t, i, s in zip(translation[:1:-1], extract_index, spacing)]
+    _, spacing, origin, _ = _binned_geometry(extract_size, spacing, origin, np.identity(3).flatten(), shrink_factors)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
 
     return img
 
 
-def im_read_channel(filename, channel=None):  # noqa: C901
+class ChannelIndex:
+    """
+    The channel names and the geometry of an image file, parsed once from its header.
+
+    The OME-XML "ImageDescription" or the "imaris_channels_information" metadata of a file can be several MB, so the
+    channel names are parsed into this compact record which is cached by `im_channel_index`.
+
+    :param channel_names: The names of the channels, or None when the file has no channel metadata.
+    :param dimension: The dimension of the image in the file.
+    :param size: The size of the image in the file.
+    :param spacing: The spacing of the image in the file.
+    :param origin: The origin of the image in the file.
+    :param direction: The direction cosine matrix of the image in the file, as a flat row-major list.
+    :param number_of_components: The number of components per pixel of the image in the file.
+    :param pixel_id: The SimpleITK pixel type of the image in the file.
+    :param image_io: The name of the SimpleITK ImageIO reading the file.
+    """
+
+    def __init__(
+        self, channel_names, dimension, size, spacing, origin, direction, number_of_components, pixel_id, image_io
+    ):
+        self.channel_names = None if channel_names is None else list(channel_names)
+        self.dimension = int(dimension)
+        self.size = [int(s) for s in size]
+        self.spacing = [float(s) for s in spacing]
+        self.origin = [float(o) for o in origin]
+        self.direction = [float(d) for d in direction]
+        self.number_of_components = int(number_of_components)
+        self.pixel_id = int(pixel_id)
+        self.image_io = image_io
+
+    def to_dict(self) -> dict:
+        """The attributes of the record."""
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def channel_number(self, channel, filename=""):
+        """
+        The index of a channel.
+
+        :param channel: An integer for the channel index or string for the name of the channel.
+        :param filename: The name of the file, used in the error messages.
+        """
+
+        if isinstance(channel, int):
+            return channel
+
+        if self.channel_names is None:
+            raise Exception(
+                "No metadata information for channel names in file: {},"
+                "reference channel by number not name.".format(filename)
+            )
+        if channel not in self.channel_names:
+            raise Exception(
+                'Channel name "{0}" is not in filename marker list: {1}'.format(channel, self.channel_names)
+            )
+        channel_number = self.channel_names.index(channel)
+        _logger.debug('Channel name "{}" is channel number {}.'.format(channel, channel_number))
+        return channel_number
+
+
+def _read_channel_index(filename) -> ChannelIndex:
+    """Read the header of an image file with SimpleITK, and parse the channel names from its metadata."""
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(filename))
+    image_io = reader.GetImageIOFromFileName(str(filename))
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in [".tif", ".tiff"]:
+        # OME TIFF files might be reader by the SCIFIOIMageIO, but that IO does not
+        # share the OME XML in the meta data
+        reader.SetImageIO("TIFFImageIO")
+
+    reader.ReadImageInformation()
+
+    _logger.debug(reader)
+
+    IMAGE_DESCRIPTION = "ImageDescription"
+    IMARIS_CHANNEL_INFORMATION = "imaris_channels_information"
+
+    channel_names = None
+    if IMAGE_DESCRIPTION in reader.GetMetaDataKeys():
+        _logger.info('Found "{}" metadata field in {}.'.format(IMAGE_DESCRIPTION, filename))
+        channel_names = OMEInfo(reader.GetMetaData(IMAGE_DESCRIPTION)).channel_names
+
+    elif IMARIS_CHANNEL_INFORMATION in reader.GetMetaDataKeys():
+        _logger.info('Found "{}" metadata field in {}.'.format(IMARIS_CHANNEL_INFORMATION, filename))
+        channel_names = XMLInfo(reader.GetMetaData(IMARIS_CHANNEL_INFORMATION)).channel_names
+
+    return ChannelIndex(
+        channel_names,
+        reader.GetDimension(),
+        reader.GetSize(),
+        reader.GetSpacing(),
+        reader.GetOrigin(),
+        reader.GetDirection(),
+        reader.GetNumberOfComponents(),
+        reader.GetPixelID(),
+        image_io,
+    )
+
+
+def _channel_index_sidecar(filename) -> Path:
+    """The path of the sidecar file of the channel index of an image file."""
+    return Path("{}.sitkibex.json".format(filename))
+
+
+@lru_cache(maxsize=256)
+def _cached_channel_index(filename, mtime_ns, file_size, sidecar) -> ChannelIndex:
+    """The channel index of a file, cached for the modification time and the size of the file."""
+
+    sidecar_filename = _channel_index_sidecar(filename)
+    if sidecar:
+        try:
+            with open(sidecar_filename) as fp:
+                values = json.load(fp)
+            if values["mtime_ns"] == mtime_ns and values["size"] == file_size:
+                _logger.debug('Using the channel index "{}".'.format(sidecar_filename))
+                return ChannelIndex.from_dict(values["index"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    index = _read_channel_index(filename)
+
+    if sidecar:
+        try:
+            with open(sidecar_filename, "w") as fp:
+                json.dump({"mtime_ns": mtime_ns, "size": file_size, "index": index.to_dict()}, fp)
+        except OSError as e:
+            _logger.debug('Unable to write the channel index "{}": {}'.format(sidecar_filename, e))
+
+    return index
+
+
+def im_channel_index(filename, *, sidecar=None) -> ChannelIndex:
+    """
+    The channel names and the geometry of an image file, from its header.
+
+    The header of a file is only read and parsed once, the result is cached in the process until the file is modified.
+    With a sidecar, the result is also written next to the file into "<filename>.sitkibex.json", which is used by
+    later processes while the modification time and the size of the file are unchanged.
+
+    :param filename: The path to an image file readable by SimpleITK.
+    :param sidecar: (optional) If the sidecar file is used, by default `sitkibex.globals.channel_index_sidecar`.
+    :return: A ChannelIndex.
+    """
+
+    if sidecar is None:
+        sidecar = sitkibex.globals.channel_index_sidecar
+
+    filename = Path(filename).resolve()
+    stat = filename.stat()
+    return _cached_channel_index(str(filename), stat.st_mtime_ns, stat.st_size, bool(sidecar))
+
+
+# The NRRD kinds of the domain axes, the axes of the other kinds are the components of the pixels
+_nrrd_domain_kinds = {"domain", "space", "time", "???", "none"}
+
+
+def _nrrd_header_fields(filename):
+    """The lower case fields of the header of a NRRD file and the offset after the header, or None if not NRRD."""
+
+    fields = {}
+    with open(filename, "rb") as fp:
+        magic = fp.readline()
+        if not magic.startswith(b"NRRD"):
+            return None
+        offset = len(magic)
+        for line in fp:
+            offset += len(line)
+            line = line.rstrip(b"\r\n")
+            if not line:
+                break
+            if line.startswith(b"#") or b":=" in line:
+                continue
+            key, sep, value = line.decode("latin-1").partition(":")
+            if sep:
+                fields[key.strip().lower()] = value.strip()
+    return fields, offset
+
+
+def _nrrd_data_layout(filename):
+    """
+    The data file, offset and byte order of the pixels of a NRRD file, or None if not raw encoded or if the axis of the
+    components is not the first axis.
+    """
+
+    header = _nrrd_header_fields(filename)
+    if header is None:
+        return None
+    fields, offset = header
+
+    if fields.get("encoding") != "raw" or fields.get("line skip", "0") != "0" or fields.get("byte skip", "0") != "0":
+        return None
+
+    # The pixels are mapped with the components interleaved, SimpleITK reorders the axes of the other layouts
+    kinds = fields.get("kinds", "").split()
+    if kinds:
+        if len(kinds) != len(fields.get("sizes", "").split()):
+            return None
+        if any(kind.lower() not in _nrrd_domain_kinds for kind in kinds[1:]):
+            return None
+
+    data_file = fields.get("data file", fields.get("datafile"))
+    if data_file is not None:
+        if " " in data_file or data_file.startswith("LIST"):
+            return None
+        filename, offset = os.path.join(os.path.dirname(filename), data_file), 0
+
+    return filename, offset, ">" if fields.get("endian") == "big" else "<"
+
+
+def _metaimage_data_layout(filename):
+    """The data file, offset and byte order of the pixels of a MetaImage file, or None if compressed."""
+
+    fields = {}
+    offset = 0
+    with open(filename, "rb") as fp:
+        for line in fp:
+            offset += len(line)
+            key, sep, value = line.decode("latin-1").partition("=")
+            if not sep:
+                return None
+            fields[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+        else:
+            return None
+
+    if fields.get("CompressedData", "False").lower() == "true" or fields.get("BinaryData", "True").lower() != "true":
+        return None
+
+    data_file = fields["ElementDataFile"]
+    if data_file != "LOCAL":
+        if " " in data_file or "%" in data_file or data_file.startswith("LIST"):
+            return None
+        filename, offset = os.path.join(os.path.dirname(filename), data_file), int(fields.get("HeaderSize", 0))
+        if offset < 0:
+            return None
+
+    msb = fields.get("BinaryDataByteOrderMSB", fields.get("ElementByteOrderMSB", "False")).lower() == "true"
+    return filename, offset, ">" if msb else "<"
+
+
+@lru_cache(maxsize=256)
+def _cached_raw_data_layout(filename, mtime_ns, file_size):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in [".nrrd", ".nhdr"]:
+        return _nrrd_data_layout(filename)
+    if ext in [".mha", ".mhd"]:
+        return _metaimage_data_layout(filename)
+    return None
+
+
+def _raw_data_layout(filename):
+    """
+    The layout of the pixels of an uncompressed NRRD or MetaImage file, parsed from the header once per modification.
+
+    :return: A tuple of the path of the file of the pixel data, the offset of the pixels in the file, and the numpy
+    byte order character. None when the pixels are not uncompressed in one file, or when the components of the pixels
+    are not interleaved.
+    """
+
+    filename = Path(filename).resolve()
+    stat = filename.stat()
+    return _cached_raw_data_layout(str(filename), stat.st_mtime_ns, stat.st_size)
+
+
+class MappedImage:
+    """
+    The pixels of an uncompressed NRRD or MetaImage file, memory mapped without reading them.
+
+    The `array` is a read-only numpy memmap of the pixels with the axes in the reverse order of the dimensions of the
+    image, then the components of a vector image. A channel or a strided sub-sample of the array is a view, so only
+    the pages of the file accessed are read, and only `read` copies pixels into a SimpleITK Image.
+
+    :param filename: The path to an uncompressed NRRD or MetaImage file.
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.index = im_channel_index(self.filename)
+
+        layout = _raw_data_layout(self.filename)
+        if layout is None:
+            raise ValueError('The pixels of "{}" are not uncompressed in one file.'.format(self.filename))
+        data_filename, offset, byte_order = layout
+
+        shape = tuple(self.index.size[::-1])
+        if self.index.number_of_components > 1:
+            shape += (self.index.number_of_components,)
+        dtype = _pixel_id_to_dtype(self.index.pixel_id).newbyteorder(byte_order)
+        self.array = np.memmap(data_filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def _region(self, extract_index, extract_size):
+        """The view of the array of the extraction region, without the axes of the collapsed dimensions."""
+        return self.array[
+            tuple(i if s == 0 else slice(i, i + s) for i, s in zip(extract_index[::-1], extract_size[::-1]))
+        ]
+
+    def channel(self, channel, step=None) -> np.ndarray:
+        """
+        The ZYX array of a channel, a view of the mapped pixels.
+
+        :param channel: An integer for the channel index or string for the name of the channel.
+        :param step: (optional) Integer XYZ steps of a strided sub-sample of the channel.
+        """
+
+        channel_number = self.index.channel_number(channel, self.filename)
+        arr = self._region(*_channel_extraction(self.index, channel_number, self.filename))
+        if self.index.number_of_components > 1:
+            arr = arr[..., channel_number]
+        if step is not None:
+            arr = arr[:: step[2], :: step[1], :: step[0]]
+        return arr
+
+    def read(self, extract_index, extract_size) -> sitk.Image:
+        """Copy the region with the extraction index and size of an ImageFileReader into a SimpleITK Image."""
+
+        arr = self._region(extract_index, extract_size)
+        img = sitk.GetImageFromArray(
+            arr.astype(arr.dtype.newbyteorder("="), copy=False), isVector=self.index.number_of_components > 1
+        )
+
+        dimension = self.index.dimension
+        reference = sitk.Image([1] * dimension, sitk.sitkUInt8)
+        reference.SetSpacing(self.index.spacing)
+        reference.SetOrigin(self.index.origin)
+        reference.SetDirection(self.index.direction)
+
+        dims = [d for d, s in enumerate(extract_size) if s != 0]
+        origin = reference.TransformIndexToPhysicalPoint(extract_index)
+        direction = np.array(self.index.direction).reshape(dimension, dimension)[np.ix_(dims, dims)]
+        img.SetSpacing([self.index.spacing[d] for d in dims])
+        img.SetOrigin([origin[d] for d in dims])
+        img.SetDirection(direction.flatten().tolist())
+        return img
+
+
+class _MappedImageReader:
+    """The extraction methods of an ImageFileReader, reading the region from a MappedImage."""
+
+    def __init__(self, mapped_image):
+        self._mapped_image = mapped_image
+        self._extract_index = None
+        self._extract_size = None
+
+    def SetExtractIndex(self, extract_index):
+        self._extract_index = list(extract_index)
+
+    def SetExtractSize(self, extract_size):
+        self._extract_size = list(extract_size)
+
+    def Execute(self):
+        return self._mapped_image.read(self._extract_index, self._extract_size)
+
+
+def _region_reader(filename, index):
+    """
+    The reader of the regions of an image file, and if it streams. Uncompressed NRRD and MetaImage files are memory
+    mapped, so a region or a channel is read without reading the whole file.
+    """
+
+    if _raw_data_layout(filename) is not None:
+        try:
+            return _MappedImageReader(MappedImage(filename)), True
+        except (OSError, ValueError) as e:
+            _logger.debug('Unable to memory map "{}": {}'.format(filename, e))
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(filename))
+    return reader, index.image_io in _streaming_image_ios
+
+
+def im_read_channel(filename, channel=None, *, region=None, shrink_factors=None, output_pixel_type=None):
     """
     Read a channel from an image file.
 
     SimpleITK is used to read a channel from the file. Channel names can be used if the image file contains meta-data
-    which can be parsed and provides names for the channels. Otherwise channel index should be used.
+    which can be parsed and provides names for the channels. Otherwise channel index should be used. The meta-data is
+    parsed once per file by `im_channel_index`.
+
+    A region and shrink factors can be provided to read a reduced image. When the file format supports streaming,
+    only the region is read from the file, and with shrink factors the region is read and binned in slabs of
+    z-slices. The peak memory is then proportional to the size of the output image and not the input file.
 
     :param filename: The path to an image file.
     :param channel: An integer for the channel index or string for the name of the channel. If None then all channel are
     read.
+    :param region: (optional) A pair of the index and the size in XYZ of the region to read.
+    :param shrink_factors: (optional) Integer factors in XYZ to bin the image by while reading, or an integer to bin
+    only X and Y.
+    :param output_pixel_type: (optional) A SimpleITK pixel type the image is cast to before binning.
 
     :return: A SimpleITK Image.
 
     """
 
     filename = Path(filename)
-    if filename.is_dir() and (filename / ".zattrs").exists():
+    shrink_factors = _shrink_factors_xyz(shrink_factors)
+
+    if _is_zarr(filename):
         if _has_zarr:
-            return _zarr_read_channel(filename, channel)
+            img = _zarr_read_channel(filename, channel, region=region, shrink_factors=shrink_factors)
+            if output_pixel_type is not None:
+                img = sitk.Cast(img, output_pixel_type)
+            return img
         else:
             raise ImportError("zarr is not installed.")
 
-    reader = sitk.ImageFileReader()
-    reader.SetFileName(str(filename))
-
-    if channel is None:
+    if channel is None and region is None and shrink_factors is None:
         _logger.info('Reading whole "{}" image file.'.format(filename))
-        return reader.Execute()
+        img = sitk.ReadImage(str(filename))
+        if output_pixel_type is not None:
+            img = sitk.Cast(img, output_pixel_type)
+        return img
 
-    ext = os.path.splitext(filename)[1].lower()
-    if ext in [".tif", ".tiff"]:
-        # OME TIFF files might be reader by the SCIFIOIMageIO, but that IO does not
-        # share the OME XML in the meta data
-        reader.SetImageIO("TIFFImageIO")
+    index = im_channel_index(filename)
+    channel_number = None if channel is None else index.channel_number(channel, filename)
+    reader, streaming = _region_reader(filename, index)
 
-    reader.ReadImageInformation()
+    extract_index, extract_size = _channel_extraction(index, channel_number, filename)
+    _apply_region(extract_index, extract_size, region)
 
-    _logger.debug(reader)
+    def select_and_cast(img):
+        if img.GetNumberOfComponentsPerPixel() > 1 and channel_number is not None:
+            img = sitk.VectorIndexSelectionCast(img, channel_number)
+        if output_pixel_type is not None:
+            img = sitk.Cast(img, output_pixel_type)
+        return img
 
-    if isinstance(channel, int):
-        channel_number = channel
+    if shrink_factors is not None:
+        _logger.info('Reading "{}" binned by {}.'.format(filename, shrink_factors))
+        return _read_binned(
+            reader,
+            extract_index,
+            extract_size,
+            shrink_factors,
+            slab_func=select_and_cast,
+            streaming=streaming,
+        )
 
-    else:
-        IMAGE_DESCRIPTION = "ImageDescription"
-        IMARIS_CHANNEL_INFORMATION = "imaris_channels_information"
+    reader.SetExtractSize(extract_size)
+    reader.SetExtractIndex(extract_index)
+    return select_and_cast(reader.Execute())
 
-        if IMAGE_DESCRIPTION in reader.GetMetaDataKeys():
-            _logger.info('Found "{}" metadata field in {}.'.format(IMAGE_DESCRIPTION, filename))
 
-            image_description = reader.GetMetaData(IMAGE_DESCRIPTION)
-            _logger.debug(image_description)
-            ome_info = OMEInfo(image_description)
-            channel_names = ome_info.channel_names
+def im_read_channels(
+    filename, channels, *, region=None, shrink_factors=None, output_pixel_type=None, output_vector=False
+):
+    """
+    Read several channels from an image file at once.
 
-        elif IMARIS_CHANNEL_INFORMATION in reader.GetMetaDataKeys():
-            _logger.info('Found "{}" metadata field in {}.'.format(IMARIS_CHANNEL_INFORMATION, filename))
-            imaris_data = reader.GetMetaData(IMARIS_CHANNEL_INFORMATION)
-            _logger.debug(imaris_data)
-            imaris_info = XMLInfo(imaris_data)
+    The file is decoded once for all the channels, instead of once per channel by `im_read_channel`. The channels of
+    a file with the channels as the 4th dimension are read as the one range of channels from the first to the last
+    channel selected, and the channels of a vector image are selected from its components. The channels of an
+    OME-Zarr directory are in separate chunks, so they are read one by one.
 
-            channel_names = imaris_info.channel_names
-        else:
-            raise Exception(
-                "No metadata information for channel names in file: {},"
-                "reference channel by number not name.".format(filename)
-            )
+    :param filename: The path to an image file.
+    :param channels: A sequence of integers for the channel indexes or strings for the names of the channels.
+    :param region: (optional) A pair of the index and the size in XYZ of the region to read.
+    :param shrink_factors: (optional) Integer factors in XYZ to bin the image by while reading, or an integer to bin
+    only X and Y.
+    :param output_pixel_type: (optional) A SimpleITK scalar pixel type the channels are cast to before binning.
+    :param output_vector: If the channels are returned as the components of one vector image.
 
-        if channel not in channel_names:
-            raise Exception('Channel name "{0}" is not in filename marker list: {1}'.format(channel, channel_names))
-        channel_number = channel_names.index(channel)
-        _logger.debug('Channel name "{}" is channel number {}.'.format(channel, channel_number))
+    :return: A list of a SimpleITK Image for each channel, or a vector Image when output_vector is True.
+
+    """
+
+    filename = Path(filename)
+    kwargs = dict(region=region, shrink_factors=shrink_factors, output_pixel_type=output_pixel_type)
+
+    if len(channels) == 1 or _is_zarr(filename):
+        images = [im_read_channel(filename, c, **kwargs) for c in channels]
+        return sitk.Compose(images) if output_vector else images
+
+    shrink_factors = _shrink_factors_xyz(shrink_factors)
+    index = im_channel_index(filename)
+    channel_numbers = [index.channel_number(c, filename) for c in channels]
+    first_channel = min(channel_numbers)
+
+    extract_index, extract_size = _channel_extraction(
+        index, first_channel, filename, number_of_channels=max(channel_numbers) - first_channel + 1
+    )
+    _apply_region(extract_index, extract_size, region)
+
+    def cast(img):
+        if output_pixel_type is None:
+            return img
+        if img.GetNumberOfComponentsPerPixel() > 1:
+            vector_pixel_type = {v: k for k, v in _vector_to_scalar.items()}[output_pixel_type]
+            return sitk.Cast(img, vector_pixel_type)
+        return _cast(img, output_pixel_type)
 
-    if reader.GetImageIO() != "":
-        reader.SetImageIO("")
+    reader, streaming = _region_reader(filename, index)
 
-    if reader.GetDimension() == 3:
+    _logger.info('Reading channels {} of "{}" at once.'.format(channel_numbers, filename))
+    if shrink_factors is not None:
+        img = _read_binned(reader, extract_index, extract_size, shrink_factors, slab_func=cast, streaming=streaming)
+    else:
+        reader.SetExtractSize(extract_size)
+        reader.SetExtractIndex(extract_index)
+        img = cast(reader.Execute())
+
+    if img.GetNumberOfComponentsPerPixel() > 1:
+        images = [sitk.VectorIndexSelectionCast(img, c) for c in channel_numbers]
+    else:
+        size = list(img.GetSize()[:3]) + [0]
+        images = [sitk.Extract(img, size, [0, 0, 0, c - first_channel]) for c in channel_numbers]
+
+    return sitk.Compose(images) if output_vector else images
+
+
+def _channel_extraction(index, channel_number, filename, number_of_channels=1):
+    """
+    The extraction index and size of the reader selecting the channel from the dimensions of the file. With more than
+    one channel, the channel dimension is not collapsed and has the number_of_channels channels from channel_number.
+    """
+
+    if index.dimension == 3:
         dimension_order = "XYZ"
-    elif reader.GetDimension() == 4:
+    elif index.dimension == 4:
         dimension_order = "XYZC"
-    elif reader.GetDimension() == 5:
+    elif index.dimension == 5:
         dimension_order = "XYZTC"
     else:
-        raise Exception('File "{}" has unsupported dimension {}.'.format(filename, reader.GetDimension()))
+        raise Exception('File "{}" has unsupported dimension {}.'.format(filename, index.dimension))
 
-    _logger.debug("dimension order: {} {}".format(dimension_order, reader.GetSize()))
+    _logger.debug("dimension order: {} {}".format(dimension_order, index.size))
 
-    if reader.GetDimension() > 3 and reader.GetNumberOfComponents() > 1:
+    if index.dimension > 3 and index.number_of_components > 1:
         _logger.warning(
             'File "{}" has {} dimensions and {} components. '
-            "Ambiguous which contains the channels.".format(
-                filename, reader.GetDimension(), reader.GetNumberOfComponents()
-            )
+            "Ambiguous which contains the channels.".format(filename, index.dimension, index.number_of_components)
         )
 
     # reduce dimensions
-    extract_size = list(reader.GetSize())
+    extract_size = list(index.size)
     extract_index = [0] * len(extract_size)
-    if reader.GetNumberOfComponents() == 1 and channel_number is not None:
+    if index.number_of_components == 1 and channel_number is not None:
         c_idx = dimension_order.upper().index("C")
         extract_index[c_idx] = channel_number
 
-        if extract_index[c_idx] >= extract_size[c_idx]:
+        if extract_index[c_idx] + number_of_channels > extract_size[c_idx]:
             raise Exception(
-                "Channel index {} is dimension {} size {}.".format(channel_number, reader.GetDimension(), extract_size)
+                "Channel index {} is dimension {} size {}.".format(
+                    channel_number + number_of_channels - 1, index.dimension, extract_size
+                )
             )
-        extract_size[c_idx] = 0
+        extract_size[c_idx] = 0 if number_of_channels == 1 else number_of_channels
 
     # collapse time dimension
-    if "T" in dimension_order:
+    if "T" in dimension_order and channel_number is not None:
         t_idx = dimension_order.upper().index("T")
         _logger.debug(
             'Dimension "T" ({}) has size {}, is being collapsed one first image.'.format(t_idx, extract_index[t_idx])
         )
         extract_size[t_idx] = 0
 
-    reader.SetExtractSize(extract_size)
-    reader.SetExtractIndex(extract_index)
-    img = reader.Execute()
-
-    if reader.GetNumberOfComponents() > 1 and channel_number is not None:
-        if channel_number >= reader.GetNumberOfComponents():
+    if index.number_of_components > 1 and channel_number is not None:
+        if channel_number + number_of_channels > index.number_of_components:
             raise Exception(
                 "Channel index {} is beyond the number of components {}".format(
-                    channel_number, reader.GetNumberOfComponents()
+                    channel_number + number_of_channels - 1, index.number_of_components
                 )
             )
-        img = sitk.VectorIndexSelectionCast(img, channel_number)
 
-    return img
+    return extract_index, extract_size
+
+
+def _is_zarr(filename):
+    return filename.is_dir() and (filename / ".zattrs").exists()
+
+
+def _binned_geometry(size, spacing, origin, direction, shrink_factors):
+    """The XYZ size, spacing, origin and direction of an image binned by BinShrink with the shrink factors."""
+    if shrink_factors is None:
+        return size, spacing, origin, direction
+    # The first bin is centered between the pixels it averages
+    offset = np.array(direction).reshape(3, 3) @ [s * (f - 1) / 2.0 for s, f in zip(spacing, shrink_factors)]
+    return (
+        [s // f for s, f in zip(size, shrink_factors)],
+        [s * f for s, f in zip(spacing, shrink_factors)],
+        [o + d for o, d in zip(origin, offset)],
+        direction,
+    )
+
+
+class ImageGeometry:
+    """
+    The size, spacing, origin and direction of a 3D image without its pixels.
+
+    The methods have the names of the SimpleITK Image methods, so an ImageGeometry can be the reference image of a
+    block writer, or the fixed image of tiled resampling, for images too large to be in memory.
+    """
+
+    def __init__(self, size, spacing, origin, direction):
+        self._size = tuple(int(s) for s in size)
+        # The index to physical point mapping does not depend on the size, and is done by a one pixel image
+        self._image = sitk.Image([1] * len(self._size), sitk.sitkUInt8)
+        self._image.SetSpacing(spacing)
+        self._image.SetOrigin(origin)
+        self._image.SetDirection(direction)
+
+    def GetDimension(self):
+        return len(self._size)
+
+    def GetSize(self):
+        return self._size
+
+    def GetSpacing(self):
+        return self._image.GetSpacing()
+
+    def GetOrigin(self):
+        return self._image.GetOrigin()
+
+    def GetDirection(self):
+        return self._image.GetDirection()
+
+    def TransformIndexToPhysicalPoint(self, index):
+        return self._image.TransformIndexToPhysicalPoint(index)
+
+    def TransformContinuousIndexToPhysicalPoint(self, index):
+        return self._image.TransformContinuousIndexToPhysicalPoint(index)
+
+
+def im_read_geometry(filename, *, shrink_factors=None) -> ImageGeometry:
+    """
+    Read the XYZ geometry of an image file from its header, without reading the pixels.
+
+    :param filename: The path to an image file or an OME-Zarr directory.
+    :param shrink_factors: (optional) Integer factors in XYZ, or an integer for only X and Y, the geometry is of the
+    image binned by these factors as read by im_read_channel.
+    :return: An ImageGeometry.
+    """
+
+    filename = Path(filename)
+    shrink_factors = _shrink_factors_xyz(shrink_factors)
+
+    if _is_zarr(filename):
+        if not _has_zarr:
+            raise ImportError("zarr is not installed.")
+        zarr_group = zarr.open_group(store=zarr.DirectoryStore(filename), mode="r")
+        path, scale, translation = _zarr_levels(zarr_group.attrs["multiscales"][0])[0]
+        size = zarr_group[path].shape[:1:-1]
+        spacing, origin, direction = scale[:1:-1], translation[:1:-1], np.identity(3).flatten().tolist()
+    else:
+        index = im_channel_index(filename)
+        size, spacing, origin = index.size[:3], index.spacing[:3], index.origin[:3]
+        direction = np.array(index.direction).reshape(index.dimension, index.dimension)[:3, :3].flatten().tolist()
+
+    return ImageGeometry(*_binned_geometry(size, spacing, origin, direction, shrink_factors))
+
+
+class ImageRegionReader:
+    """
+    Read regions of a channel of an image file on demand.
+
+    The geometry is read from the header of the file, and the pixel type from a single binned pixel when first used, so
+    the pixels of the image are only read by `read`. When `streaming` is False, the file format does not support
+    reading a region without reading the whole file.
+
+    :param filename: The path to an image file or an OME-Zarr directory.
+    :param channel: An integer for the channel index or string for the name of the channel. If None then all channel are
+    read. A list of channels is read by `im_read_channels` as a 4D image with the channels as the 4th dimension.
+    :param shrink_factors: (optional) Integer factors in XYZ to bin the image by while reading, or an integer to bin
+    only X and Y.
+    """
+
+    def __init__(self, filename, channel=None, *, shrink_factors=None):
+        self.filename = Path(filename)
+        self.channel = channel
+        self.shrink_factors = _shrink_factors_xyz(shrink_factors)
+        self.geometry = im_read_geometry(self.filename, shrink_factors=self.shrink_factors)
+
+        if _is_zarr(self.filename):
+            self.streaming = True
+        else:
+            self.streaming = _region_reader(self.filename, im_channel_index(self.filename))[1]
+
+    @cached_property
+    def _pixel(self):
+        return self.read([0, 0, 0], [1, 1, 1])
+
+    @property
+    def dimension(self):
+        """The dimension of the images read, 4 when the channels are the 4th dimension."""
+        return self._pixel.GetDimension()
+
+    @property
+    def pixel_id(self):
+        """The SimpleITK pixel type of the images read."""
+        return self._pixel.GetPixelID()
+
+    @property
+    def number_of_components(self):
+        """The number of channels of the images read, as pixel components or as the 4th dimension."""
+        if self.dimension == 4 and self._pixel.GetNumberOfComponentsPerPixel() == 1:
+            return self._pixel.GetSize()[3]
+        return self._pixel.GetNumberOfComponentsPerPixel()
+
+    def read(self, index, size) -> sitk.Image:
+        """Read the region of the binned image with the XYZ index and size."""
+        factors = self.shrink_factors or [1, 1, 1]
+        region = ([i * f for i, f in zip(index, factors)], [s * f for s, f in zip(size, factors)])
+        if isinstance(self.channel, (list, tuple)):
+            return sitk.JoinSeries(
+                im_read_channels(self.filename, self.channel, region=region, shrink_factors=self.shrink_factors)
+            )
+        return im_read_channel(self.filename, self.channel, region=region, shrink_factors=self.shrink_factors)
+
+
+def _pixel_id_to_dtype(pixel_id):
+    """The numpy dtype of the pixel components of a SimpleITK pixel type."""
+    return sitk.GetArrayViewFromImage(sitk.Image([1] * 3, pixel_id)).dtype
+
+
+class _MetaImageBlockWriter:
+    """
+    Writes an image block by block into an uncompressed MetaImage file.
+
+    The header is written first, then the pixel data of the file is memory mapped and each block is copied into it.
+    """
+
+    # The required multiple of the block indexes
+    block_alignment = [1, 1, 1]
+
+    def __init__(self, filename, reference_image, pixel_id, number_of_components=1):
+        dtype = _pixel_id_to_dtype(pixel_id)
+        dimension = reference_image.GetDimension()
+        size = reference_image.GetSize()
+
+        def _str(values):
+            return " ".join(str(v) for v in values)
+
+        # MetaImage stores the direction matrix in column-major order
+        direction = np.array(reference_image.GetDirection()).reshape(dimension, dimension).T.flatten()
+
+        header = [
+            "ObjectType = Image",
+            "NDims = {}".format(dimension),
+            "BinaryData = True",
+            "BinaryDataByteOrderMSB = {}".format(dtype.byteorder == ">"),
+            "CompressedData = False",
+            "TransformMatrix = {}".format(_str(direction)),
+            "Offset = {}".format(_str(reference_image.GetOrigin())),
+            "ElementSpacing = {}".format(_str(reference_image.GetSpacing())),
+            "DimSize = {}".format(_str(size)),
+        ]
+        if number_of_components > 1:
+            header.append("ElementNumberOfChannels = {}".format(number_of_components))
+        header += ["ElementType = {}".format(_numpy_to_metaimage_type[dtype]), "ElementDataFile = LOCAL", ""]
+        header = "\n".join(header).encode("ascii")
+
+        shape = tuple(size[::-1])
+        if number_of_components > 1:
+            shape += (number_of_components,)
+
+        with open(filename, "wb") as fp:
+            fp.write(header)
+            # Extend the file to the size of the pixel data, without writing the zero pixels
+            fp.truncate(len(header) + int(np.prod(shape)) * dtype.itemsize)
+
+        self._arr = np.memmap(filename, dtype=dtype, mode="r+", offset=len(header), shape=shape)
+
+    def write(self, image, index):
+        """Copy the pixels of image into the output with the first pixel at index."""
+        region = tuple(slice(i, i + s) for i, s in zip(index[::-1], image.GetSize()[::-1]))
+        self._arr[region] = sitk.GetArrayViewFromImage(image)
+
+    def close(self):
+        if self._arr is not None:
+            self._arr.flush()
+            self._arr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _OMEZarrBlockWriter:
+    """
+    Writes an image block by block into an OME-Zarr multiscale pyramid.
+
+    Each block is written to the full resolution level, and binned in X and Y by powers of 2 into the down-sampled
+    levels, so the pyramid is generated in the same pass. The blocks must start at multiples of `block_alignment`.
+    The `omero` metadata is written on close with the channel labels and the range of the written pixel values.
+    """
+
+    def __init__(
+        self, filename, reference_image, pixel_id, number_of_components=1, channel_names=None, number_of_levels=None
+    ):
+        self.filename = str(filename)
+        self._dtype = _pixel_id_to_dtype(pixel_id)
+
+        # A 4D image is XYZC, with the channels in the 4th dimension
+        size = reference_image.GetSize()[:3]
+        self._size = size
+        spacing = reference_image.GetSpacing()[:3]
+        origin = reference_image.GetOrigin()[:3]
+        if reference_image.GetDimension() == 4:
+            number_of_components = reference_image.GetSize()[3]
+
+        direction = np.array(reference_image.GetDirection()).reshape([reference_image.GetDimension()] * 2)
+        if not np.allclose(direction[:3, :3], np.identity(3)):
+            _logger.warning("The direction cosine matrix is not written to OME-Zarr.")
+
+        chunks = (1, 1, min(size[2], 16), 256, 256)
+
+        if number_of_levels is None:
+            # Down-sample until the largest XY dimension fits into one chunk
+            number_of_levels = 1
+            while max(size[:2]) // 2 ** (number_of_levels - 1) > chunks[-1] and number_of_levels < 8:
+                number_of_levels += 1
+        self.number_of_levels = number_of_levels
+        self.block_alignment = [2 ** (number_of_levels - 1)] * 2 + [1]
+
+        if channel_names is None:
+            channel_names = ["Channel {}".format(c) for c in range(number_of_components)]
+        if len(channel_names) != number_of_components:
+            raise ValueError("The number of channel names does not match the {} channels.".format(number_of_components))
+        self._channel_names = list(channel_names)
+        self._channel_min = np.full(number_of_components, np.inf)
+        self._channel_max = np.full(number_of_components, -np.inf)
+
+        self._group = zarr.open_group(self.filename, mode="w")
+        self._levels = []
+        datasets = []
+        for level in range(number_of_levels):
+            f = 2**level
+            shape = (1, number_of_components, size[2], size[1] // f, size[0] // f)
+            self._levels.append(
+                self._group.create_dataset(str(level), shape=shape, chunks=chunks, dtype=self._dtype, fill_value=0)
+            )
+            scale = [1.0, 1.0, spacing[2], spacing[1] * f, spacing[0] * f]
+            # The origin of the bins, as computed by BinShrink
+            translation = [0.0, 0.0, origin[2]] + [o + s * (f - 1) / 2.0 for o, s in zip(origin[1::-1], spacing[1::-1])]
+            datasets.append(
+                {
+                    "path": str(level),
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": scale},
+                        {"type": "translation", "translation": translation},
+                    ],
+                }
+            )
+
+        axes = [
+            {"name": "t", "type": "time"},
+            {"name": "c", "type": "channel"},
+            {"name": "z", "type": "space"},
+            {"name": "y", "type": "space"},
+            {"name": "x", "type": "space"},
+        ]
+        self._group.attrs["multiscales"] = [{"version": "0.4", "axes": axes, "datasets": datasets}]
+
+    @staticmethod
+    def _czyx_array(image):
+        """The pixels of a 3D scalar, 3D vector or 4D XYZC image as an array with CZYX axes."""
+        arr = sitk.GetArrayViewFromImage(image)
+        if image.GetNumberOfComponentsPerPixel() > 1:
+            return np.moveaxis(arr, -1, 0)
+        if image.GetDimension() == 3:
+            return arr[np.newaxis]
+        return arr
+
+    def write(self, image, index):
+        """Write the pixels of image into all the levels with the first pixel at the full resolution index."""
+
+        end = [i + s for i, s in zip(index, image.GetSize())]
+        if any(i % a or (e % a and e != s) for i, e, a, s in zip(index, end, self.block_alignment, self._size)):
+            raise ValueError(
+                "The block from {} to {} is not aligned to multiples of {}.".format(index, end, self.block_alignment)
+            )
+
+        arr = self._czyx_array(image)
+        self._channel_min = np.minimum(self._channel_min, arr.min(axis=(1, 2, 3)))
+        self._channel_max = np.maximum(self._channel_max, arr.max(axis=(1, 2, 3)))
+
+        for level, level_arr in enumerate(self._levels):
+            f = 2**level
+            if level:
+                # Bin X and Y by the level factor, dropping the incomplete bins like BinShrink
+                c, z, y, x = arr.shape
+                binned = arr[:, :, : y // f * f, : x // f * f].reshape(c, z, y // f, f, x // f, f).mean(axis=(3, 5))
+                if np.issubdtype(self._dtype, np.integer):
+                    binned = np.rint(binned)
+                block = binned.astype(self._dtype)
+            else:
+                block = arr
+            region = tuple(slice(i // d, i // d + s) for i, d, s in zip(index[::-1], [1, f, f], block.shape[1:]))
+            level_arr[(0, slice(None)) + region] = block
+
+    def close(self):
+        if self._group is None:
+            return
+
+        channels = []
+        for name, c_min, c_max in zip(self._channel_names, self._channel_min, self._channel_max):
+            if c_min > c_max:
+                c_min, c_max = 0.0, 0.0
+            channels.append(
+                {
+                    "label": name,
+                    "active": True,
+                    "color": "FFFFFF",
+                    "window": {"start": float(c_min), "end": float(c_max), "min": float(c_min), "max": float(c_max)},
+                }
+            )
+        self._group.attrs["omero"] = {"channels": channels}
+        self._group = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def im_block_writer(filename, reference_image, pixel_id, number_of_components=1, *, channel_names=None):
+    """
+    Create a writer of an image file written block by block.
+
+    The writer is used as a context manager, its `write(image, index)` method copies a block image into the output
+    with its first pixel at the index. The whole output image is never in memory. Uncompressed MetaImage ".mha" files
+    and OME-Zarr ".zarr" directories with a multiscale pyramid are supported. The blocks must start at a multiple of
+    the `block_alignment` attribute of the writer.
+
+    :param filename: The path to the output file.
+    :param reference_image: A SimpleITK Image defining the size, spacing, origin and direction of the output.
+    :param pixel_id: The SimpleITK pixel type of the output.
+    :param number_of_components: The number of components per pixel of the output.
+    :param channel_names: (optional) The names of the channels written to the OME-Zarr "omero" metadata.
+    :return: A block writer object.
+    """
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".mha":
+        return _MetaImageBlockWriter(filename, reference_image, pixel_id, number_of_components)
+    if ext == ".zarr":
+        if not _has_zarr:
+            raise ImportError("zarr is not installed.")
+        return _OMEZarrBlockWriter(
+            filename, reference_image, pixel_id, number_of_components, channel_names=channel_names
+        )
+    raise ValueError('Block writing of "{}" files is not supported, use ".mha" or ".zarr".'.format(ext))
+
+
+def im_write_zarr(image, filename, channel_names=None):
+    """
+    Write an image as OME-Zarr with a multiscale pyramid.
+
+    The levels of the pyramid are binned by powers of 2 in X and Y. The channels are the components of a vector image
+    or the 4th dimension of a 4D image.
+
+    :param image: A 3D SimpleITK Image, or a 4D image of XYZC.
+    :param filename: The path of the output ".zarr" directory.
+    :param channel_names: (optional) The names of the channels written to the "omero" metadata.
+    """
+
+    if not _has_zarr:
+        raise ImportError("zarr is not installed.")
+
+    with _OMEZarrBlockWriter(
+        filename, image, image.GetPixelID(), image.GetNumberOfComponentsPerPixel(), channel_names=channel_names
+    ) as writer:
+        writer.write(image, [0, 0, 0])
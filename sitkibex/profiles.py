@@ -0,0 +1,274 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+""" Named settings of the speed and accuracy tradeoff of registration, and their tuning on a pair of images."""
+
+import SimpleITK as sitk
+import numpy as np
+import copy
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+
+_default_optimizer_3d = dict(
+    learningRate=1.0,
+    numberOfIterations=400,
+    convergenceMinimumValue=1e-7,
+    convergenceWindowSize=10,
+    lineSearchLowerLimit=0,
+    lineSearchUpperLimit=1.0,
+    lineSearchMaximumIterations=5,
+    maximumStepSizeInPhysicalUnits=1.0,
+)
+
+_default_optimizer_rigid_2d = dict(
+    learningRate=1.0,
+    numberOfIterations=500,
+    convergenceMinimumValue=1e-6,
+    convergenceWindowSize=10,
+    maximumStepSizeInPhysicalUnits=2.0,
+)
+
+_default_optimizer_affine_2d = dict(
+    learningRate=1.0,
+    numberOfIterations=100,
+    convergenceMinimumValue=1e-6,
+    convergenceWindowSize=10,
+    lineSearchLowerLimit=0,
+    lineSearchUpperLimit=2.0,
+    lineSearchMaximumIterations=5,
+    maximumStepSizeInPhysicalUnits=2.0,
+)
+
+
+class RegistrationProfile:
+    """
+    The settings of `registration` which trade speed for accuracy.
+
+    The optimizer settings are the keyword arguments of the SimpleITK ImageRegistrationMethod methods setting the
+    optimizer of a stage, the arguments not given have the values of the "balanced" profile. A profile is written to and
+    read from a JSON file of its attributes. The profiles written into the `profile_directory` are loaded by
+    `registration` from their name.
+
+    :param samples_per_parameter: the number of image samples used per transform parameter at full resolution
+    :param max_sampling_percentage: the maximum fraction of the pixels of a level sampled by the metric
+    :param shrink_factors_3d: the shrink factors of the levels of the 3D affine registration
+    :param shrink_factors_rigid_2d: the factors of the smoothing of the levels of the 2D rigid registration
+    :param shrink_factors_affine_2d: the shrink factors of the levels of the 2D affine registration
+    :param optimizer_3d: the arguments of SetOptimizerAsGradientDescentLineSearch of the 3D affine registration
+    :param optimizer_rigid_2d: the arguments of SetOptimizerAsGradientDescent of the 2D rigid registration
+    :param optimizer_affine_2d: the arguments of SetOptimizerAsGradientDescentLineSearch of the 2D affine registration
+    """
+
+    def __init__(
+        self,
+        *,
+        samples_per_parameter=5000,
+        max_sampling_percentage=0.10,
+        shrink_factors_3d=(4, 2, 1),
+        shrink_factors_rigid_2d=(16, 8, 4),
+        shrink_factors_affine_2d=(8, 4, 2),
+        optimizer_3d=None,
+        optimizer_rigid_2d=None,
+        optimizer_affine_2d=None,
+    ):
+        self.samples_per_parameter = samples_per_parameter
+        self.max_sampling_percentage = max_sampling_percentage
+        self.shrink_factors_3d = list(shrink_factors_3d)
+        self.shrink_factors_rigid_2d = list(shrink_factors_rigid_2d)
+        self.shrink_factors_affine_2d = list(shrink_factors_affine_2d)
+        self.optimizer_3d = dict(_default_optimizer_3d, **(optimizer_3d or {}))
+        self.optimizer_rigid_2d = dict(_default_optimizer_rigid_2d, **(optimizer_rigid_2d or {}))
+        self.optimizer_affine_2d = dict(_default_optimizer_affine_2d, **(optimizer_affine_2d or {}))
+
+    def __repr__(self):
+        return "{0}({1})".format(
+            self.__class__.__name__, ", ".join("{0}={1!r}".format(k, v) for k, v in self.to_dict().items())
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, RegistrationProfile) and self.to_dict() == other.to_dict()
+
+    def to_dict(self) -> dict:
+        """The attributes of the profile."""
+        return copy.deepcopy(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        """A profile from the attributes in values, the attributes not in values have the default value."""
+        return cls(**values)
+
+    def save(self, filename):
+        """Write the profile to a JSON file."""
+        with open(filename, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a profile from a JSON file."""
+        with open(filename) as fp:
+            return cls.from_dict(json.load(fp))
+
+
+profiles = {
+    "fast": RegistrationProfile(
+        samples_per_parameter=2000,
+        shrink_factors_3d=(8, 4, 2),
+        shrink_factors_rigid_2d=(16, 8),
+        shrink_factors_affine_2d=(8, 4),
+        optimizer_3d=dict(numberOfIterations=100, convergenceMinimumValue=1e-6),
+        optimizer_rigid_2d=dict(numberOfIterations=200),
+        optimizer_affine_2d=dict(numberOfIterations=50),
+    ),
+    "balanced": RegistrationProfile(),
+    "accurate": RegistrationProfile(
+        samples_per_parameter=10000,
+        max_sampling_percentage=0.25,
+        shrink_factors_3d=(4, 2, 1),
+        shrink_factors_affine_2d=(8, 4, 2, 1),
+        optimizer_3d=dict(numberOfIterations=800, convergenceMinimumValue=1e-8, convergenceWindowSize=20),
+        optimizer_rigid_2d=dict(numberOfIterations=1000, convergenceMinimumValue=1e-7),
+        optimizer_affine_2d=dict(numberOfIterations=200, convergenceMinimumValue=1e-7),
+    ),
+}
+"""The preset profiles by name. The "balanced" profile is the default of registration."""
+
+
+def profile_directory() -> Path:
+    """
+    The directory of the named profiles, the "SITKIBEX_PROFILE_DIR" environment variable or by default
+    "~/.config/sitkibex/profiles".
+    """
+    return Path(os.environ.get("SITKIBEX_PROFILE_DIR", Path.home() / ".config" / "sitkibex" / "profiles"))
+
+
+def get_profile(profile=None) -> RegistrationProfile:
+    """
+    Resolve the profile argument of `registration`.
+
+    :param profile: None for the "balanced" profile, a RegistrationProfile, the name of a preset profile, the name of a
+     profile in the `profile_directory`, or the path of a profile JSON file.
+    :return: A RegistrationProfile
+    """
+
+    if profile is None:
+        profile = "balanced"
+    if isinstance(profile, RegistrationProfile):
+        return profile
+    if profile in profiles:
+        return RegistrationProfile.from_dict(profiles[profile].to_dict())
+
+    filename = profile_directory() / "{}.json".format(profile)
+    if not filename.exists():
+        filename = Path(profile)
+    if not filename.is_file():
+        raise ValueError('The registration profile "{}" does not exist.'.format(profile))
+    return RegistrationProfile.load(filename)
+
+
+def _transform_disagreement(transform, reference_transform, image):
+    """The maximum distance in pixels between the corners of image mapped by the transform and by the reference."""
+
+    spacing = image.GetSpacing()
+    corners = [
+        image.TransformIndexToPhysicalPoint(idx) for idx in itertools.product(*[(0, s - 1) for s in image.GetSize()])
+    ]
+    return max(
+        np.max(np.abs(np.subtract(transform.TransformPoint(pt), reference_transform.TransformPoint(pt))) / spacing)
+        for pt in corners
+    )
+
+
+def tune_profile(
+    fixed_image: sitk.Image,
+    moving_image: sitk.Image,
+    *,
+    samples_per_parameter_grid=(1000, 2500, 5000, 10000),
+    shrink_factors_3d_grid=((8, 4), (8, 4, 2), (4, 2), (4, 2, 1), (8, 4, 2, 1)),
+    reference_profile=None,
+    tolerance=0.5,
+    **kwargs,
+):
+    """
+    Find the fastest profile of the registration of a pair of images, with a result near a high effort registration.
+
+    The moving image is registered with each combination of the sampling densities and the shrink factors of the 3D
+    affine registration in the grids, then the fastest profile whose transform maps the corners of the fixed image
+    within tolerance pixels of the transform of the reference_profile is recommended.
+
+    :param fixed_image: a scalar SimpleITK 3D Image
+    :param moving_image: a scalar SimpleITK 3D Image
+    :param samples_per_parameter_grid: the numbers of samples per transform parameter evaluated
+    :param shrink_factors_3d_grid: the shrink factors of the levels of the 3D affine registration evaluated
+    :param reference_profile: (optional) the RegistrationProfile of the reference registration, by default 20000
+     samples per parameter with the shrink factors 4, 2 and 1
+    :param tolerance: the maximum disagreement in pixels with the reference registration
+    :param kwargs: additional keyword arguments passed to `registration`
+    :return: The recommended RegistrationProfile, and a list of dictionaries of the attributes, the "duration" in
+     seconds and the "disagreement" in pixels of each profile evaluated. The recommended profile is the reference
+     profile when no profile of the grid is within tolerance.
+    """
+    from .registration import _fixed_image_for_kwargs, registration
+
+    if reference_profile is None:
+        reference_profile = RegistrationProfile(samples_per_parameter=20000, shrink_factors_3d=[4, 2, 1])
+
+    kwargs = dict(kwargs, do_affine3d=True)
+    # The preprocessing of the fixed image is shared by all the registrations, and not timed
+    prepared_fixed = _fixed_image_for_kwargs(fixed_image, kwargs)
+
+    def timed_registration(profile):
+        start = time.perf_counter()
+        transform = registration(prepared_fixed, moving_image, profile=profile, **kwargs)
+        return transform, time.perf_counter() - start
+
+    _logger.info("Registering with the reference profile {}...".format(reference_profile))
+    reference_transform, reference_duration = timed_registration(reference_profile)
+
+    results = []
+    for samples_per_parameter, shrink_factors_3d in itertools.product(
+        samples_per_parameter_grid, shrink_factors_3d_grid
+    ):
+        profile = RegistrationProfile.from_dict(
+            dict(
+                reference_profile.to_dict(),
+                samples_per_parameter=samples_per_parameter,
+                shrink_factors_3d=shrink_factors_3d,
+            )
+        )
+        transform, duration = timed_registration(profile)
+        disagreement = _transform_disagreement(transform, reference_transform, fixed_image)
+        _logger.info(
+            "Profile {0}: {1:.3f} s, disagreement {2:.3f} pixels (reference {3:.3f} s)".format(
+                profile, duration, disagreement, reference_duration
+            )
+        )
+        results.append(dict(profile.to_dict(), duration=duration, disagreement=disagreement))
+
+    accepted = [r for r in results if r["disagreement"] <= tolerance]
+    if not accepted:
+        _logger.warning(
+            "No profile is within {} pixels of the reference, recommending the reference.".format(tolerance)
+        )
+        return reference_profile, results
+
+    best = min(accepted, key=lambda r: r["duration"])
+    return RegistrationProfile.from_dict({k: best[k] for k in reference_profile.to_dict()}), results
@@ -16,14 +16,155 @@
 
 import SimpleITK as sitk
 import numpy as np
-from .registration_utilities import RegistrationCallbackManager
+from .registration_utilities import RegistrationCallbackManager, RegistrationTelemetry
 from . import image_utilities as imgf
+from .profiles import get_profile
 import sitkibex.globals
+import itertools
 import logging
+import math
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Union
 
 _logger = logging.getLogger(__name__)
 
 
+def _telemetry_phase(telemetry, name, **values):
+    """The phase context manager of telemetry, or a context yielding None without telemetry."""
+    if telemetry is None:
+        return nullcontext()
+    return telemetry.phase(name, **values)
+
+
+def _transform_change(transform, points, mapped_points, spacing):
+    """The maximum distance in pixels between the points mapped by transform and their previously mapped_points."""
+    return max(
+        np.linalg.norm(np.subtract(transform.TransformPoint(pt), mapped_pt) / spacing)
+        for pt, mapped_pt in zip(points, mapped_points)
+    )
+
+
+def _adaptive_level_budget(change, shrink_factor, number_of_iterations=400, convergence_minimum_value=1e-7):
+    """
+    The number of iterations and the convergence minimum value of a level of the adaptive 3D registration.
+
+    The change of the transform at the previous level, in pixels of that level, estimates how much the next level
+    still has to refine. A previous level which barely moved the transform gives a proportionally smaller iteration
+    budget, down to 25 iterations, and a convergence threshold relaxed by up to a factor of 100.
+
+    :param change: The change in full resolution pixels of the transform at the previous level.
+    :param shrink_factor: The shrink factor of the previous level.
+    :param number_of_iterations: The number of iterations of a level which still has to refine.
+    :param convergence_minimum_value: The convergence minimum value of a level which still has to refine.
+    :return: The number of iterations and the convergence minimum value.
+    """
+
+    relative_change = min(1.0, max(change / shrink_factor, 1e-2))
+    number_of_iterations = max(25, min(number_of_iterations, math.ceil(number_of_iterations * relative_change)))
+    return number_of_iterations, convergence_minimum_value / relative_change
+
+
+def _set_3d_optimizer(reg, profile, number_of_iterations=None, convergence_minimum_value=None):
+    """Set the optimizer of the 3D registration method from the profile, optionally with another number of iterations
+    and convergence threshold."""
+
+    optimizer = dict(profile.optimizer_3d)
+    if number_of_iterations is not None:
+        optimizer.update(numberOfIterations=number_of_iterations, convergenceMinimumValue=convergence_minimum_value)
+    reg.SetOptimizerAsGradientDescentLineSearch(**optimizer)
+    reg.SetOptimizerScalesFromIndexShift()
+
+
+def _register_3d_adaptive(
+    reg,
+    fixed_image,
+    moving_image,
+    initial_transform,
+    scale_factors,
+    smoothing_sigmas,
+    sampling_percentage_per_level,
+    adaptive_tolerance,
+    telemetry_record,
+    profile,
+):
+    """Execute the levels of the configured 3D registration method one at a time, see register_3d."""
+
+    levels = []
+    transform = initial_transform
+    corners = [
+        fixed_image.TransformIndexToPhysicalPoint(idx)
+        for idx in itertools.product(*[(0, s - 1) for s in fixed_image.GetSize()])
+    ]
+    change = None
+    for level, (shrink_factor, smoothing_sigma, level_sampling_percentage) in enumerate(
+        zip(scale_factors, smoothing_sigmas, sampling_percentage_per_level)
+    ):
+        number_of_iterations = profile.optimizer_3d["numberOfIterations"]
+        convergence_minimum_value = profile.optimizer_3d["convergenceMinimumValue"]
+        if level:
+            if level == len(scale_factors) - 1 and change < adaptive_tolerance:
+                _logger.info("Skipping level {0}, the transform changed by {1:.3f} pixels.".format(level, change))
+                levels.append(
+                    {
+                        "level": level,
+                        "skipped": True,
+                        "duration": 0.0,
+                        "iterations": 0,
+                        "metric_values": [],
+                        "number_of_valid_points": [],
+                    }
+                )
+                break
+            number_of_iterations, convergence_minimum_value = _adaptive_level_budget(
+                change, scale_factors[level - 1], number_of_iterations, convergence_minimum_value
+            )
+        _logger.info(
+            "Adaptive level {0}: {1} iterations, convergence minimum value {2}".format(
+                level, number_of_iterations, convergence_minimum_value
+            )
+        )
+
+        _set_3d_optimizer(reg, profile, number_of_iterations, convergence_minimum_value)
+        reg.SetMetricSamplingPercentagePerLevel([level_sampling_percentage], sitkibex.globals.default_random_seed)
+        reg.SetShrinkFactorsPerLevel([shrink_factor])
+        reg.SetSmoothingSigmasPerLevel([smoothing_sigma])
+        reg.SetInitialTransform(transform)
+
+        mapped_corners = [transform.TransformPoint(pt) for pt in corners]
+
+        level_record = {}
+        reg.RemoveAllCommands()
+        reg_callbacks = RegistrationCallbackManager(reg, telemetry_record=level_record)
+        reg_callbacks.add_command_callbacks(print_position=True)
+
+        transform = reg.Execute(fixed_image, moving_image)
+
+        change = _transform_change(transform, corners, mapped_corners, moving_image.GetSpacing())
+        _logger.info("Level {0} changed the transform by {1:.3f} pixels.".format(level, change))
+
+        levels.append(
+            dict(
+                level_record["levels"][0],
+                level=level,
+                skipped=False,
+                iteration_budget=number_of_iterations,
+                convergence_minimum_value=convergence_minimum_value,
+                transform_change=change,
+            )
+        )
+
+    if telemetry_record is not None:
+        telemetry_record["levels"] = levels
+        telemetry_record["iterations"] = sum(level["iterations"] for level in levels)
+        telemetry_record["final_metric_value"] = reg.GetMetricValue()
+        telemetry_record["stop_condition"] = reg.GetOptimizerStopConditionDescription()
+
+    return transform
+
+
 def register_3d(
     fixed_image,
     moving_image,
@@ -32,9 +173,16 @@ def register_3d(
     fixed_image_mask=None,
     moving_image_mask=None,
     number_of_samples_per_parameter=5000,
+    telemetry=None,
+    adaptive=False,
+    adaptive_tolerance=0.5,
+    profile=None,
 ):
     """Perform multi-resolution 3D registration, with parameters tuned for affine transformation.
 
+    In the adaptive mode, each level is registered separately. The iteration budget and the convergence threshold of a
+    level are set from the change of the transform at the previous level, and the finest level is skipped when the
+    previous level changed the transform by less than adaptive_tolerance pixels.
 
     :param fixed_image: a 3D SimpleITK image
     :param moving_image: a 3D SimpleITK image
@@ -45,28 +193,23 @@ def register_3d(
     :param moving_image_mask: (optional) a binary image of non-zeros for pixels to use
     :param number_of_samples_per_parameter: Number of sample points per number of transform parameter to use for metric
      evaluation.
+    :param telemetry: (optional) a RegistrationTelemetry the "affine_3d" phase is recorded into
+    :param adaptive: adapt the number of iterations of each level, and skip the finest level when converged
+    :param adaptive_tolerance: the change in pixels of the transform at the previous level below which the finest
+     level is skipped in the adaptive mode
+    :param profile: (optional) the RegistrationProfile of the levels, sampling and optimizer
     :return:
     """
+    profile = get_profile(profile)
     use_neighborhood_correlation = False
-    scale_factors = [4, 2, 1]
+    scale_factors = profile.shrink_factors_3d
 
     reg = sitk.ImageRegistrationMethod()
 
     reg.MetricUseMovingImageGradientFilterOff()
     reg.MetricUseFixedImageGradientFilterOff()
 
-    reg.SetOptimizerAsGradientDescentLineSearch(
-        learningRate=1.0,
-        numberOfIterations=400,
-        convergenceMinimumValue=1e-7,
-        convergenceWindowSize=10,
-        lineSearchLowerLimit=0,
-        lineSearchUpperLimit=1.0,
-        lineSearchMaximumIterations=5,
-        maximumStepSizeInPhysicalUnits=1.0,
-    )
-
-    reg.SetOptimizerScalesFromIndexShift()
+    _set_3d_optimizer(reg, profile)
 
     sampling_percentage = (
         initial_transform.GetNumberOfParameters() * number_of_samples_per_parameter / fixed_image.GetNumberOfPixels()
@@ -94,15 +237,14 @@ def register_3d(
     else:
         reg.SetMetricAsCorrelation()
 
-    sampling_percentage_per_level = [min(0.10, sampling_percentage * f * f) for f in scale_factors]
+    sampling_percentage_per_level = [
+        min(profile.max_sampling_percentage, sampling_percentage * f * f) for f in scale_factors
+    ]
+    number_of_samples_per_level = [
+        p * fixed_image.GetNumberOfPixels() / (f**3) for p, f in zip(sampling_percentage_per_level, scale_factors)
+    ]
     _logger.info(
-        "Sampling Percentage Per Level: {0} #{1}".format(
-            sampling_percentage_per_level,
-            [
-                p * fixed_image.GetNumberOfPixels() / (f**3)
-                for p, f in zip(sampling_percentage_per_level, scale_factors)
-            ],
-        )
+        "Sampling Percentage Per Level: {0} #{1}".format(sampling_percentage_per_level, number_of_samples_per_level)
     )
 
     reg.SetMetricSamplingPercentagePerLevel(sampling_percentage_per_level, sitkibex.globals.default_random_seed)
@@ -123,10 +265,61 @@ def register_3d(
 
     reg.SetInitialTransform(initial_transform)
 
-    reg_callbacks = RegistrationCallbackManager(reg)
-    reg_callbacks.add_command_callbacks(print_position=True)
+    with _telemetry_phase(
+        telemetry,
+        "affine_3d",
+        shrink_factors_per_level=scale_factors,
+        smoothing_sigmas_per_level=smoothing_sigmas,
+        sampling_percentage_per_level=sampling_percentage_per_level,
+        number_of_samples_per_level=number_of_samples_per_level,
+        adaptive=adaptive,
+    ) as telemetry_record:
+        if not adaptive:
+            reg_callbacks = RegistrationCallbackManager(reg, telemetry_record=telemetry_record)
+            reg_callbacks.add_command_callbacks(print_position=True)
+
+            return reg.Execute(fixed_image, moving_image)
+
+        return _register_3d_adaptive(
+            reg,
+            fixed_image,
+            moving_image,
+            initial_transform,
+            scale_factors,
+            smoothing_sigmas,
+            sampling_percentage_per_level,
+            adaptive_tolerance,
+            telemetry_record,
+            profile,
+        )
+
 
-    return reg.Execute(fixed_image, moving_image)
+def _initial_rigid_2d(fixed_2d, moving_2d, initial_translation, log_polar_initialization, telemetry):
+    """The Euler2D transform initializing the 2D rigid registration of the projections."""
+
+    if log_polar_initialization:
+        with _telemetry_phase(telemetry, "log_polar_initialization") as telemetry_record:
+            initial_rigid, correlation = imgf.log_polar_rotation(moving_2d, fixed_2d)
+            if telemetry_record is not None:
+                telemetry_record.update(
+                    angle=initial_rigid.GetAngle(),
+                    translation=list(initial_rigid.GetTranslation()),
+                    correlation=correlation,
+                )
+        return initial_rigid
+
+    # Initialize the center of transform and align the center of the volumes.
+    # - Use Euler transform
+    #
+
+    initial_rigid = sitk.CenteredTransformInitializer(
+        fixed_2d, moving_2d, sitk.Euler2DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
+    )
+
+    if initial_translation:
+        initial_rigid = sitk.Euler2DTransform(initial_rigid)
+        initial_rigid.SetTranslation(initial_translation)
+    return initial_rigid
 
 
 def register_as_2d_affine(
@@ -137,6 +330,9 @@ def register_as_2d_affine(
     fixed_image_mask=None,
     moving_image_mask=None,
     number_of_samples_per_parameter=5000,
+    log_polar_initialization=False,
+    telemetry=None,
+    profile=None,
 ):
     """Perform 2D registration from 3D image projected in the z-direction.
 
@@ -144,27 +340,43 @@ def register_as_2d_affine(
     transform to map points from the fixed_image to the moving_image is optimized for normalized
     correlation metric. First a Euler2D transform is optimized, then a 2D Affine.
 
-    :param fixed_image: a 3D SimpleITK Image class
+    With log_polar_initialization, the rotation and translation are first estimated in closed form from the phase
+    correlation of the log-polar spectra of the projections. The Euler2D transform then starts near the optimum, so the
+    coarsest level of its optimization is skipped.
+
+    :param fixed_image: a 3D SimpleITK Image class, or a 2D image when already projected
     :param moving_image: a 3D SimpelITK Image class
     :param sigma_base: scalar to change the amount of Gaussian smoothing performed
     :param initial_translation: (optional) initial translation for fixed points to map to moving.
-    :param fixed_image_mask: (optional) a binary image of non-zeros for pixels to use
+    :param fixed_image_mask: (optional) a binary image of non-zeros for pixels to use, or a 2D image when already
+     projected
     :param moving_image_mask: (optional) a binary image of non-zeros for pixels to use
     :param number_of_samples_per_parameter: Number of sample points per number of transform parameter to use for metric
      evaluation.
+    :param log_polar_initialization: initialize the Euler2D transform with `image_utilities.log_polar_rotation`, \
+    instead of initial_translation
+    :param telemetry: (optional) a RegistrationTelemetry the "log_polar_initialization", "rigid_2d" and "affine_2d" \
+    phases are recorded into
+    :param profile: (optional) the RegistrationProfile of the levels, sampling and optimizers
     :return: a 3D SimpleITK AffineTransform mapping points from the fixed_image to the moving_image
     """
 
+    profile = get_profile(profile)
     do_affine = True
     verbose = True
 
     _logger.info("Initializing projected registration...")
     _logger.info("Sigma Base: {0}".format(sigma_base))
 
-    fixed_2d = imgf.project(fixed_image)
+    if fixed_image.GetDimension() == 2:
+        fixed_2d = fixed_image
+    else:
+        fixed_2d = imgf.project(fixed_image)
     moving_2d = imgf.project(moving_image)
 
-    if fixed_image_mask:
+    if fixed_image_mask and fixed_image_mask.GetDimension() == 2:
+        fixed_mask_2d = fixed_image_mask
+    elif fixed_image_mask:
         fixed_mask_2d = imgf.project(fixed_image_mask, projection_func=sitk.MedianProjection)
     else:
         fixed_mask_2d = None
@@ -174,17 +386,7 @@ def register_as_2d_affine(
     else:
         moving_mask_2d = None
 
-    # Initialize the center of transform and align the center of the volumes.
-    # - Use Euler transform
-    #
-
-    initial_rigid = sitk.CenteredTransformInitializer(
-        fixed_2d, moving_2d, sitk.Euler2DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
-    )
-
-    if initial_translation:
-        initial_rigid = sitk.Euler2DTransform(initial_rigid)
-        initial_rigid.SetTranslation(initial_translation)
+    initial_rigid = _initial_rigid_2d(fixed_2d, moving_2d, initial_translation, log_polar_initialization, telemetry)
 
     #
     # Setup Multi-scale 2D Multi-scale registration
@@ -198,28 +400,26 @@ def register_as_2d_affine(
     R.MetricUseMovingImageGradientFilterOff()
     R.MetricUseFixedImageGradientFilterOff()
 
-    R.SetOptimizerAsGradientDescent(
-        learningRate=1.0,
-        numberOfIterations=500,
-        convergenceMinimumValue=1e-6,
-        convergenceWindowSize=10,
-        maximumStepSizeInPhysicalUnits=2.0,
-    )
+    R.SetOptimizerAsGradientDescent(**profile.optimizer_rigid_2d)
 
     R.SetOptimizerScalesFromIndexShift()
 
-    scale_factors = [16, 8, 4]
+    scale_factors = profile.shrink_factors_rigid_2d
+    if log_polar_initialization:
+        scale_factors = scale_factors[1:]
     # We don't need more samples for larger image, so base the number of samples on the number of parameters
     sampling_percentage = (
         len(initial_rigid.GetParameters()) * number_of_samples_per_parameter / fixed_2d.GetNumberOfPixels()
     )
-    R.SetMetricSamplingPercentagePerLevel(
-        [min(0.10, sampling_percentage) for f in scale_factors], sitkibex.globals.default_random_seed
-    )
+    rigid_sampling_percentage_per_level = [
+        min(profile.max_sampling_percentage, sampling_percentage) for f in scale_factors
+    ]
+    R.SetMetricSamplingPercentagePerLevel(rigid_sampling_percentage_per_level, sitkibex.globals.default_random_seed)
     R.SetMetricSamplingStrategy(R.REGULAR)
     R.SetShrinkFactorsPerLevel([1 for f in scale_factors])
     R.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-    R.SetSmoothingSigmasPerLevel([4.0 * sigma_base * f * fixed_2d.GetSpacing()[0] for f in scale_factors])
+    rigid_smoothing_sigmas = [4.0 * sigma_base * f * fixed_2d.GetSpacing()[0] for f in scale_factors]
+    R.SetSmoothingSigmasPerLevel(rigid_smoothing_sigmas)
 
     R.SetInitialTransform(initial_rigid)
     R.SetInterpolator(sitk.sitkLinear)
@@ -232,12 +432,19 @@ def register_as_2d_affine(
         _logger.info("Setting moving mask")
         R.SetMetricMovingMask(moving_mask_2d)
 
-    R_callbacks = RegistrationCallbackManager(R)
-    R_callbacks.add_command_callbacks(print_position=True, verbose=verbose)
-
     # R.DebugOn()
 
-    rigid_result_2d = R.Execute(fixed_2d, moving_2d)
+    with _telemetry_phase(
+        telemetry,
+        "rigid_2d",
+        shrink_factors_per_level=[1 for f in scale_factors],
+        smoothing_sigmas_per_level=rigid_smoothing_sigmas,
+        sampling_percentage_per_level=rigid_sampling_percentage_per_level,
+    ) as telemetry_record:
+        R_callbacks = RegistrationCallbackManager(R, telemetry_record=telemetry_record)
+        R_callbacks.add_command_callbacks(print_position=True, verbose=verbose)
+
+        rigid_result_2d = R.Execute(fixed_2d, moving_2d)
 
     # Perform a deep copy of the transform to convert a sitk.Transform to the actual Euler type
     rigid_result_2d = sitk.Euler2DTransform(rigid_result_2d)
@@ -255,37 +462,37 @@ def register_as_2d_affine(
     R2.SetMetricAsCorrelation()
     R2.MetricUseMovingImageGradientFilterOff()
     R2.MetricUseFixedImageGradientFilterOff()
-    R2.SetOptimizerAsGradientDescentLineSearch(
-        learningRate=1.0,
-        numberOfIterations=100,
-        convergenceMinimumValue=1e-6,
-        convergenceWindowSize=10,
-        lineSearchLowerLimit=0,
-        lineSearchUpperLimit=2.0,
-        lineSearchMaximumIterations=5,
-        maximumStepSizeInPhysicalUnits=2,
-    )
+    R2.SetOptimizerAsGradientDescentLineSearch(**profile.optimizer_affine_2d)
 
     R2.SetOptimizerScalesFromIndexShift()
 
-    scale_factors = [8, 4, 2]
+    scale_factors = profile.shrink_factors_affine_2d
     sampling_percentage = len(affine.GetParameters()) * number_of_samples_per_parameter / fixed_2d.GetNumberOfPixels()
-    R2.SetMetricSamplingPercentagePerLevel(
-        [min(0.10, sampling_percentage * f) for f in scale_factors], sitkibex.globals.default_random_seed
-    )
+    affine_sampling_percentage_per_level = [
+        min(profile.max_sampling_percentage, sampling_percentage * f) for f in scale_factors
+    ]
+    R2.SetMetricSamplingPercentagePerLevel(affine_sampling_percentage_per_level, sitkibex.globals.default_random_seed)
     R2.SetMetricSamplingStrategy(R.RANDOM)
     R2.SetShrinkFactorsPerLevel([f for f in scale_factors])
     R2.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-    R2.SetSmoothingSigmasPerLevel([sigma_base * f * fixed_2d.GetSpacing()[0] for f in scale_factors])
+    affine_smoothing_sigmas = [sigma_base * f * fixed_2d.GetSpacing()[0] for f in scale_factors]
+    R2.SetSmoothingSigmasPerLevel(affine_smoothing_sigmas)
 
     R2.SetInitialTransform(affine)
     R2.SetInterpolator(sitk.sitkLinear)
 
-    R2_callbacks = RegistrationCallbackManager(R2)
-    R2_callbacks.add_command_callbacks(print_position=True, verbose=verbose)
-
     if do_affine:
-        affine_result = R2.Execute(fixed_2d, moving_2d)
+        with _telemetry_phase(
+            telemetry,
+            "affine_2d",
+            shrink_factors_per_level=scale_factors,
+            smoothing_sigmas_per_level=affine_smoothing_sigmas,
+            sampling_percentage_per_level=affine_sampling_percentage_per_level,
+        ) as telemetry_record:
+            R2_callbacks = RegistrationCallbackManager(R2, telemetry_record=telemetry_record)
+            R2_callbacks.add_command_callbacks(print_position=True, verbose=verbose)
+
+            affine_result = R2.Execute(fixed_2d, moving_2d)
     else:
         affine_result = affine
 
@@ -313,8 +520,242 @@ def register_as_2d_affine(
     return result_3d
 
 
+def _evaluate_fft_candidate(
+    fixed_2d,
+    moving_2d,
+    translation,
+    fixed_mask_2d=None,
+    moving_mask_2d=None,
+    sigma_base=1.0,
+    number_of_samples_per_parameter=5000,
+    number_of_iterations=50,
+    number_of_threads=None,
+):
+    """The correlation metric value and the refined translation after a short rigid registration of the z-projections
+    at a coarse level, initialized with the translation of a FFT candidate. The learning rate is estimated each
+    iteration to limit the steps, as the candidates may already be near the optimum."""
+
+    initial_rigid = sitk.CenteredTransformInitializer(
+        fixed_2d, moving_2d, sitk.Euler2DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
+    )
+    initial_rigid = sitk.Euler2DTransform(initial_rigid)
+    initial_rigid.SetTranslation(translation[:2])
+
+    R = sitk.ImageRegistrationMethod()
+    R.SetMetricAsCorrelation()
+    R.MetricUseMovingImageGradientFilterOff()
+    R.MetricUseFixedImageGradientFilterOff()
+    R.SetOptimizerAsGradientDescent(
+        learningRate=1.0,
+        numberOfIterations=number_of_iterations,
+        convergenceMinimumValue=1e-6,
+        convergenceWindowSize=10,
+        estimateLearningRate=sitk.ImageRegistrationMethod.EachIteration,
+        maximumStepSizeInPhysicalUnits=2.0,
+    )
+    R.SetOptimizerScalesFromIndexShift()
+
+    shrink_factor = 4
+    sampling_percentage = (
+        initial_rigid.GetNumberOfParameters() * number_of_samples_per_parameter / fixed_2d.GetNumberOfPixels()
+    )
+    R.SetMetricSamplingPercentagePerLevel(
+        [min(0.10, sampling_percentage * shrink_factor**2)], sitkibex.globals.default_random_seed
+    )
+    R.SetMetricSamplingStrategy(R.REGULAR)
+    R.SetShrinkFactorsPerLevel([shrink_factor])
+    R.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+    R.SetSmoothingSigmasPerLevel([2.0 * sigma_base * shrink_factor * fixed_2d.GetSpacing()[0]])
+    R.SetInitialTransform(initial_rigid)
+    R.SetInterpolator(sitk.sitkLinear)
+    if number_of_threads is not None:
+        R.SetNumberOfThreads(number_of_threads)
+
+    if fixed_mask_2d:
+        R.SetMetricFixedMask(fixed_mask_2d)
+    if moving_mask_2d:
+        R.SetMetricMovingMask(moving_mask_2d)
+
+    refined_rigid = sitk.Euler2DTransform(R.Execute(fixed_2d, moving_2d))
+    return R.GetMetricValue(), list(refined_rigid.GetTranslation()) + list(translation[2:])
+
+
+def _select_fft_candidate(
+    prepared_fixed, moving_image, moving_mask, candidates, sigma_base, number_of_samples_per_parameter, telemetry
+):
+    """Select the FFT translation candidate with the best correlation after a short coarse rigid registration, and
+    return its refined translation. The candidates are evaluated concurrently, sharing the SimpleITK thread budget."""
+
+    if len(candidates) == 1:
+        return candidates[0][0]
+
+    fixed_2d = prepared_fixed.projection()
+    fixed_mask_2d = prepared_fixed.mask_projection()
+    moving_2d = imgf.project(moving_image)
+    moving_mask_2d = imgf.project(moving_mask, projection_func=sitk.MedianProjection) if moving_mask else None
+    number_of_threads = max(1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // len(candidates))
+
+    def evaluate(candidate):
+        return _evaluate_fft_candidate(
+            fixed_2d,
+            moving_2d,
+            candidate[0],
+            fixed_mask_2d,
+            moving_mask_2d,
+            sigma_base=sigma_base,
+            number_of_samples_per_parameter=number_of_samples_per_parameter,
+            number_of_threads=number_of_threads,
+        )
+
+    with _telemetry_phase(telemetry, "fft_candidate_selection") as telemetry_record:
+        _logger.info(
+            "Evaluating {0} FFT candidates with {1} threads each...".format(len(candidates), number_of_threads)
+        )
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            metric_values, refined_translations = zip(*executor.map(evaluate, candidates))
+
+        best = int(np.argmin(metric_values))
+        if telemetry_record is not None:
+            telemetry_record["candidates"] = [
+                {
+                    "translation": list(translation),
+                    "correlation": correlation,
+                    "metric_value": metric_value,
+                    "refined_translation": refined_translation,
+                }
+                for (translation, correlation), metric_value, refined_translation in zip(
+                    candidates, metric_values, refined_translations
+                )
+            ]
+            telemetry_record["selected"] = best
+
+    _logger.info(
+        "Selected FFT candidate {0} with metric value {1} at refined translation of {2}".format(
+            best, metric_values[best], refined_translations[best]
+        )
+    )
+    return refined_translations[best]
+
+
+def _auto_mask(image, low_memory):
+    """The automatic mask of the image, computed at a quarter of the resolution in X and Y in low memory mode."""
+    return imgf.make_auto_mask(image, shrink_factors=[4, 4, 1] if low_memory else None)
+
+
+def _normalize_spacing(image, spacing_magnitude, name):
+    """Divide the spacing and origin of image in-place by spacing_magnitude."""
+
+    new_spacing = [s / spacing_magnitude for s in image.GetSpacing()]
+    _logger.info("\t{0} Image Spacing: {1}->{2}".format(name, image.GetSpacing(), new_spacing))
+    image.SetSpacing(new_spacing)
+    image.SetOrigin([o / spacing_magnitude for o in image.GetOrigin()])
+
+
+class PreparedFixedImage:
+    """A fixed image preprocessed once for repeated registration of moving images to the same reference.
+
+    The Float32 casting, expansion of under sized dimensions, spacing normalization and automatic mask computation
+    done by `registration` are performed on construction. The z-projections and the FFT correlation operands are
+    computed on first use and kept in a least recently used cache. Registering another moving image to the same
+    prepared fixed image only performs the processing of the moving image.
+
+    The arguments of `registration` with the same names must match the values used to construct the object.
+
+    :param fixed_image: a scalar SimpleITK 3D Image
+    :param ignore_spacing: internally adjust spacing magnitude to be near 1 to avoid numeric stability issues with \
+    micro sized spacing
+    :param auto_mask: ignore zero valued pixels connected to the image boarder
+    :param expand: Perform super-sampling to increase number of z-slices by an integer factor. Super-sampling is \
+    automatically performed when the number of z-slices is less than 5.
+    :param low_memory: compute the automatic mask at a reduced resolution
+    :param cache_size: The maximum number of derived images kept in the cache.
+    """
+
+    def __init__(
+        self,
+        fixed_image: sitk.Image,
+        *,
+        ignore_spacing=True,
+        auto_mask=False,
+        expand=None,
+        low_memory=False,
+        cache_size=8,
+    ):
+        self.ignore_spacing = ignore_spacing
+        self.auto_mask = auto_mask
+        self.expand = expand
+        self.low_memory = low_memory
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        # The spacing of the image may be modified below, so a shallow copy is made to not alter the caller's image.
+        # Modifying the copy duplicates the pixel buffer only when the caller still holds a reference to the image.
+        if fixed_image.GetPixelID() != sitk.sitkFloat32:
+            fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+        else:
+            fixed_image = sitk.Image(fixed_image)
+
+        # expand the image if at least 5 in any dimension
+        if expand:
+            expand_factors = [1, 1, expand]
+        else:
+            expand_factors = [-(-5 // s) for s in fixed_image.GetSize()]
+
+        if any([e != 1 for e in expand_factors]):
+            _logger.warning(
+                "Fixed image under sized in at lease one dimension!"
+                "\tApplying expand factors {0} to image size.".format(expand_factors)
+            )
+            fixed_image = sitk.Expand(fixed_image, expandFactors=expand_factors)
+
+        self.spacing_magnitude = 1.0
+        if ignore_spacing:
+            #
+            # FORCE THE SPACING magnitude to be normalized near 1.0
+            #
+            self.spacing_magnitude = imgf.spacing_average_magnitude(fixed_image)
+
+            _logger.info("Adjusting image spacing by {0}...".format(1.0 / self.spacing_magnitude))
+            _normalize_spacing(fixed_image, self.spacing_magnitude, "Fixed")
+
+        self.image = fixed_image
+        self.mask = _auto_mask(fixed_image, low_memory) if auto_mask else None
+
+    def _cached(self, key, func):
+        """Return the cached value for key, or compute it with func and add it to the cache."""
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = func()
+        self._cache[key] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def projection(self) -> sitk.Image:
+        """The z-projection of the fixed image."""
+        return self._cached(("projection",), lambda: imgf.project(self.image))
+
+    def mask_projection(self):
+        """The z-projection of the fixed image mask, or None without a mask."""
+        if self.mask is None:
+            return None
+        return self._cached(
+            ("mask_projection",), lambda: imgf.project(self.mask, projection_func=sitk.MedianProjection)
+        )
+
+    def fft_operand(self, bin_shrink=8, projection=False) -> sitk.Image:
+        """The binned and smoothed fixed image correlated by `image_utilities.fft_initialization`."""
+        image = self.projection() if projection else self.image
+        return self._cached(
+            ("fft_operand", bin_shrink, projection), lambda: imgf.fft_operand(image, bin_shrink, projection=False)
+        )
+
+
 def registration(
-    fixed_image: sitk.Image,  # noqa: C901
+    fixed_image: Union[sitk.Image, PreparedFixedImage],  # noqa: C901
     moving_image: sitk.Image,
     *,
     do_fft_initialization=True,
@@ -323,8 +764,14 @@ def registration(
     ignore_spacing=True,
     sigma=1.0,
     auto_mask=False,
-    samples_per_parameter=5000,
-    expand=None
+    samples_per_parameter=None,
+    expand=None,
+    adaptive=False,
+    number_of_fft_candidates=1,
+    log_polar_initialization=False,
+    low_memory=False,
+    profile=None,
+    return_telemetry=False,
 ) -> sitk.Transform:
     """Robust multi-phase registration for multi-panel confocal microscopy images.
 
@@ -336,8 +783,15 @@ def registration(
        2D similarity transform followed by 2D affine
       - 3D affine robust mulit-level registration
 
+    The input images are cast to Float32, and the registration keeps one Float32 copy of each. The 3D affine phase
+    additionally allocates the smoothed and shrunk images of the current resolution level, which are full sized for the
+    last level. In low memory mode the automatic masks are computed at a reduced resolution, instead of full resolution
+    binary images. The "peak_allocation_bytes" of each phase in the telemetry reports the memory allocated by the phase,
+    and the `LowMemoryRegistration` benchmark tracks the peak allocation per pixel. The caller's Float32 images are not
+    duplicated when they are passed as temporaries without other references, e.g. directly from a reading function.
 
-    :param fixed_image: a scalar SimpleITK 3D Image
+    :param fixed_image: a scalar SimpleITK 3D Image, or a PreparedFixedImage to reuse the preprocessing of the fixed \
+    image between registrations
     :param moving_image: a scalar SimpleITK 3D Image
     :param do_fft_initialization: perform FFT based cross correlation for initialize translation
     :param do_affine2d: perform registration on 2D images from z-projection
@@ -346,10 +800,26 @@ def registration(
     micro sized spacing
     :param sigma: scalar to change the amount of Gaussian smoothing performed
     :param auto_mask: ignore zero valued pixels connected to the image boarder
-    :param samples_per_parameter: the number of image samples to used per transform parameter at full resolution
+    :param samples_per_parameter: the number of image samples to used per transform parameter at full resolution, by \
+    default the samples_per_parameter of the profile
     :param expand: Perform super-sampling to increase number of z-slices by an integer factor. Super-sampling is \
     automatically performed when the number of z-slices is less than 5.
-    :return: A SimpleITK transform mapping points from the fixed image to the moving. This may be a CompositeTransform.
+    :param adaptive: adapt the iterations of each level of the 3D affine registration to the change of the transform \
+    at the previous level, and skip the full resolution level when the coarser levels have converged
+    :param number_of_fft_candidates: the number of peaks of the FFT correlation kept as candidate translations. With \
+    more than one, each candidate is refined by a short coarse 2D rigid registration, and the candidate with the best \
+    correlation initializes the following phases.
+    :param log_polar_initialization: initialize the 2D rigid registration with the rotation and translation estimated \
+    from the log-polar phase correlation of the z-projections, instead of the FFT translation
+    :param low_memory: compute the automatic masks at a quarter of the resolution in X and Y, instead of full \
+    resolution binary images and their hole filling
+    :param profile: (optional) a RegistrationProfile of the speed and accuracy tradeoff, or the name of a profile \
+    written by `sitkibex tune` or the path of a profile file, see `profiles.get_profile`
+    :param return_telemetry: also return a RegistrationTelemetry with the durations, iterations and metric values of \
+    the "preprocessing", "fft_initialization", "fft_candidate_selection", "log_polar_initialization", "rigid_2d", \
+    "affine_2d" and "affine_3d" phases performed
+    :return: A SimpleITK transform mapping points from the fixed image to the moving. This may be a CompositeTransform.\
+    With return_telemetry, a tuple of the transform and the RegistrationTelemetry.
 
     """
     # Identity transform will be returned if all registration steps are disabled by
@@ -359,71 +829,53 @@ def registration(
     initial_translation_3d = True
 
     moving_mask = None
-    fixed_mask = None
-
-    number_of_samples_per_parameter = samples_per_parameter
-
-    expand_factors = None
-
-    if expand:
-        expand_factors = [1, 1, expand]
-
-    if fixed_image.GetPixelID() != sitk.sitkFloat32:
-        fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
-
-    # expand the image if at least 5 in any dimension
-    if not expand_factors:
-        expand_factors = [-(-5 // s) for s in fixed_image.GetSize()]
-
-    if any([e != 1 for e in expand_factors]):
-        _logger.warning(
-            "Fixed image under sized in at lease one dimension!"
-            "\tApplying expand factors {0} to image size.".format(expand_factors)
-        )
-        fixed_image = sitk.Expand(fixed_image, expandFactors=expand_factors)
-
-    if moving_image.GetPixelID() != sitk.sitkFloat32:
-        moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
-
-    expand_factors = [-(-5 // s) for s in moving_image.GetSize()]
-    if any([e != 1 for e in expand_factors]):
-        _logger.warning(
-            "WARNING: Moving image under sized in at lease one dimension!"
-            "\tApplying expand factors {0} to image size.".format(expand_factors)
-        )
-        moving_image = sitk.Expand(moving_image, expandFactors=expand_factors)
-
-    if auto_mask:
-        fixed_mask = imgf.make_auto_mask(fixed_image)
-        moving_mask = imgf.make_auto_mask(moving_image)
-
-    if ignore_spacing:
 
-        #
-        # FORCE THE SPACING magnitude to be normalized near 1.0
-        #
-
-        spacing_magnitude = imgf.spacing_average_magnitude(fixed_image)
+    profile = get_profile(profile)
+    number_of_samples_per_parameter = samples_per_parameter or profile.samples_per_parameter
+
+    telemetry = RegistrationTelemetry() if return_telemetry else None
+
+    with _telemetry_phase(telemetry, "preprocessing"):
+        if isinstance(fixed_image, PreparedFixedImage):
+            prepared_fixed = fixed_image
+            if (
+                prepared_fixed.ignore_spacing,
+                prepared_fixed.auto_mask,
+                prepared_fixed.expand,
+                prepared_fixed.low_memory,
+            ) != (ignore_spacing, auto_mask, expand, low_memory):
+                raise ValueError(
+                    "The ignore_spacing, auto_mask, expand and low_memory arguments must match the PreparedFixedImage."
+                )
+        else:
+            prepared_fixed = PreparedFixedImage(
+                fixed_image, ignore_spacing=ignore_spacing, auto_mask=auto_mask, expand=expand, low_memory=low_memory
+            )
+            del fixed_image
 
-        _logger.info("Adjusting image spacing by {0}...".format(1.0 / spacing_magnitude))
+        fixed_image = prepared_fixed.image
+        fixed_mask = prepared_fixed.mask
+        spacing_magnitude = prepared_fixed.spacing_magnitude
 
-        new_spacing = [s / spacing_magnitude for s in fixed_image.GetSpacing()]
-        _logger.info("\tFixed Image Spacing: {0}->{1}".format(fixed_image.GetSpacing(), new_spacing))
-        fixed_image.SetSpacing(new_spacing)
-        fixed_image.SetOrigin([o / spacing_magnitude for o in fixed_image.GetOrigin()])
+        # The spacing of the image may be modified below, so a shallow copy is made to not alter the caller's image.
+        if moving_image.GetPixelID() != sitk.sitkFloat32:
+            moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+        else:
+            moving_image = sitk.Image(moving_image)
 
-        new_spacing = [s / spacing_magnitude for s in moving_image.GetSpacing()]
-        _logger.info("\tMoving Image Spacing: {0}->{1}".format(moving_image.GetSpacing(), new_spacing))
-        moving_image.SetSpacing(new_spacing)
-        moving_image.SetOrigin([o / spacing_magnitude for o in moving_image.GetOrigin()])
+        expand_factors = [-(-5 // s) for s in moving_image.GetSize()]
+        if any([e != 1 for e in expand_factors]):
+            _logger.warning(
+                "WARNING: Moving image under sized in at lease one dimension!"
+                "\tApplying expand factors {0} to image size.".format(expand_factors)
+            )
+            moving_image = sitk.Expand(moving_image, expandFactors=expand_factors)
 
-        if moving_mask:
-            moving_mask.SetSpacing(new_spacing)
-            moving_mask.SetOrigin([o / spacing_magnitude for o in moving_mask.GetOrigin()])
+        if ignore_spacing:
+            _normalize_spacing(moving_image, spacing_magnitude, "Moving")
 
-        if fixed_mask:
-            fixed_mask.SetSpacing(new_spacing)
-            fixed_mask.SetOrigin([o / spacing_magnitude for o in fixed_mask.GetOrigin()])
+        if auto_mask:
+            moving_mask = _auto_mask(moving_image, low_memory)
 
     #
     #
@@ -432,8 +884,18 @@ def registration(
     #
     initial_translation = None
     if do_fft_initialization:
-        initial_translation = imgf.fft_initialization(
-            moving_image, fixed_image, bin_shrink=8, projection=(not initial_translation_3d)
+        fft_projection = not initial_translation_3d
+        with _telemetry_phase(telemetry, "fft_initialization", bin_shrink=8, projection=fft_projection):
+            candidates = imgf.fft_candidates(
+                moving_image,
+                prepared_fixed.projection() if fft_projection else fixed_image,
+                bin_shrink=8,
+                projection=fft_projection,
+                fixed_operand=prepared_fixed.fft_operand(bin_shrink=8, projection=fft_projection),
+                number_of_candidates=number_of_fft_candidates,
+            )
+        initial_translation = _select_fft_candidate(
+            prepared_fixed, moving_image, moving_mask, candidates, sigma, number_of_samples_per_parameter, telemetry
         )
         result = sitk.TranslationTransform(len(initial_translation), initial_translation)
 
@@ -442,12 +904,15 @@ def registration(
     #
     if do_affine2d:
         result = register_as_2d_affine(
-            fixed_image,
+            prepared_fixed.projection(),
             moving_image,
             sigma_base=sigma,
             initial_translation=initial_translation,
-            fixed_image_mask=fixed_mask,
+            fixed_image_mask=prepared_fixed.mask_projection(),
             moving_image_mask=moving_mask,
+            log_polar_initialization=log_polar_initialization,
+            telemetry=telemetry,
+            profile=profile,
         )
 
     if do_affine3d:
@@ -492,6 +957,9 @@ def registration(
             fixed_image_mask=fixed_mask,
             moving_image_mask=moving_mask,
             number_of_samples_per_parameter=number_of_samples_per_parameter,
+            telemetry=telemetry,
+            adaptive=adaptive,
+            profile=profile,
         )
 
         result = affine_result
@@ -517,4 +985,373 @@ def registration(
 
         _logger.info(result)
 
+    if return_telemetry:
+        return result, telemetry
+    return result
+
+
+_batch_fixed_image = None
+_batch_registration_kwargs = None
+
+
+def _fixed_image_for_kwargs(fixed_image, kwargs):
+    """The fixed image as a PreparedFixedImage with the preprocessing options of the registration keyword arguments."""
+
+    if isinstance(fixed_image, PreparedFixedImage):
+        return fixed_image
+    return PreparedFixedImage(
+        fixed_image,
+        ignore_spacing=kwargs.get("ignore_spacing", True),
+        auto_mask=kwargs.get("auto_mask", False),
+        expand=kwargs.get("expand", None),
+        low_memory=kwargs.get("low_memory", False),
+    )
+
+
+def _registration_batch_initializer(fixed_image, number_of_threads, random_seed, registration_kwargs):
+    """Initialize a worker process of registration_batch with the shared fixed image and settings."""
+    global _batch_fixed_image, _batch_registration_kwargs
+
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(number_of_threads)
+    sitkibex.globals.default_random_seed = random_seed
+
+    # The derived images of the prepared fixed image are computed once in each worker
+    _batch_fixed_image = fixed_image
+    _batch_registration_kwargs = registration_kwargs
+
+
+def _registration_batch_worker(moving_image):
+    """Register one moving image to the fixed image of the worker process."""
+
+    # The image read by a callable is passed without another reference, so it is not duplicated by registration
+    if callable(moving_image):
+        return registration(_batch_fixed_image, moving_image(), **_batch_registration_kwargs)
+
+    return registration(_batch_fixed_image, moving_image, **_batch_registration_kwargs)
+
+
+def registration_batch(
+    fixed_image: Union[sitk.Image, PreparedFixedImage],
+    moving_images,
+    *,
+    max_workers=None,
+    number_of_threads=None,
+    **kwargs,
+) -> list:
+    """Register many moving images to one fixed image concurrently.
+
+    The fixed image is prepared once as a PreparedFixedImage and transferred to each worker process of a process pool,
+    then the moving images are registered in parallel with the same options. Each worker process limits the number of
+    threads used by SimpleITK, so that the workers share the cores of the system.
+
+    :param fixed_image: a scalar SimpleITK 3D Image or a PreparedFixedImage
+    :param moving_images: a sequence of scalar SimpleITK 3D Images. An element may also be a callable, which is \
+    executed in the worker process to load the moving image, it must be picklable e.g. a `functools.partial` of a \
+    module function.
+    :param max_workers: the number of worker processes, by default the number of moving images up to the number of CPUs
+    :param number_of_threads: the number of threads used by SimpleITK in each worker process, by default the CPUs are \
+    divided evenly between the workers
+    :param kwargs: additional keyword arguments passed to `registration`
+    :return: A list of SimpleITK transforms, in the order of moving_images, mapping points from the fixed image to \
+    each moving image.
+    """
+
+    moving_images = list(moving_images)
+    if not moving_images:
+        return []
+
+    fixed_image = _fixed_image_for_kwargs(fixed_image, kwargs)
+
+    number_of_cpus = os.cpu_count() or 1
+
+    if max_workers is None:
+        max_workers = min(len(moving_images), number_of_cpus)
+
+    if number_of_threads is None:
+        number_of_threads = max(1, number_of_cpus // max_workers)
+
+    _logger.info(
+        "Registering {0} images with {1} workers of {2} threads.".format(
+            len(moving_images), max_workers, number_of_threads
+        )
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_registration_batch_initializer,
+        initargs=(fixed_image, number_of_threads, sitkibex.globals.default_random_seed, kwargs),
+    ) as executor:
+        return list(executor.map(_registration_batch_worker, moving_images))
+
+
+def registration_pipeline(
+    fixed_image: Union[sitk.Image, PreparedFixedImage],
+    moving_readers,
+    *,
+    writer=None,
+    prefetch=1,
+    max_pending_writes=1,
+    **kwargs,
+) -> list:
+    """Register moving images to one fixed image in sequence, overlapping the reading and writing with registration.
+
+    While a moving image is registered with all the threads of SimpleITK, the next moving images are read by a
+    background thread, and the results of the previous registrations are written by another background thread. The
+    number of images read ahead and of writes pending are bounded, which bounds the memory used. SimpleITK releases the
+    global interpreter lock while reading, writing and registering, so the threads run concurrently.
+
+    :param fixed_image: a scalar SimpleITK 3D Image or a PreparedFixedImage
+    :param moving_readers: a sequence of callables each returning a scalar SimpleITK 3D Image to register, such as a \
+    `functools.partial` of `sitkibex.io.im_read_channel`.
+    :param writer: (optional) a callable of the index of the moving image and the result of `registration`, which is \
+    executed in the background thread, for example to write the transform or resample an image.
+    :param prefetch: the number of moving images read ahead of the image registered
+    :param max_pending_writes: the number of writes which may be pending before the registration of the next image
+    :param kwargs: additional keyword arguments passed to `registration`
+    :return: A list of the results of `registration`, in the order of moving_readers.
+    """
+
+    fixed_image = _fixed_image_for_kwargs(fixed_image, kwargs)
+    moving_readers = iter(moving_readers)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as read_executor, ThreadPoolExecutor(max_workers=1) as write_executor:
+        pending_reads = deque()
+        pending_writes = deque()
+
+        def read_ahead():
+            for reader in itertools.islice(moving_readers, prefetch + 1 - len(pending_reads)):
+                pending_reads.append(read_executor.submit(reader))
+
+        read_ahead()
+        while pending_reads:
+            _logger.info("Registering moving image {0}...".format(len(results)))
+            # The image is passed without keeping a reference, so it is not duplicated by registration. The next
+            # images are already being read.
+            result = registration(fixed_image, pending_reads.popleft().result(), **kwargs)
+            results.append(result)
+            read_ahead()
+
+            if writer is not None:
+                while len(pending_writes) >= max_pending_writes:
+                    pending_writes.popleft().result()
+                pending_writes.append(write_executor.submit(writer, len(results) - 1, result))
+
+        for future in pending_writes:
+            future.result()
+
+    return results
+
+
+def _tile_starts(size, tile_size, step):
+    """The start indices of the tiles along an axis, the last tile ending at the end of the axis."""
+
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, step))
+    return starts + [size - tile_size]
+
+
+def _register_tile(
+    fixed_tile,
+    moving_image,
+    initial_transform,
+    margin,
+    sigma,
+    number_of_samples_per_parameter,
+    number_of_iterations,
+    number_of_threads,
+):
+    """
+    Register a tile of the fixed image with a translation, after the initial transform.
+
+    The moving image is resampled with the initial transform onto the grid of the tile padded by margin pixels in X and
+    Y, so the memory and the work of the registration are bounded by the size of the tile.
+
+    :return: The translation in physical units of the fixed tile and the correlation after the registration, or None
+     when the tile is uniform.
+    """
+
+    stats = sitk.StatisticsImageFilter()
+    stats.SetNumberOfThreads(number_of_threads)
+    stats.Execute(fixed_tile)
+    if stats.GetVariance() <= 0.0:
+        return None
+
+    padded_size = [s + 2 * m for s, m in zip(fixed_tile.GetSize(), margin)]
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetNumberOfThreads(number_of_threads)
+    resampler.SetSize(padded_size)
+    resampler.SetOutputSpacing(fixed_tile.GetSpacing())
+    resampler.SetOutputDirection(fixed_tile.GetDirection())
+    resampler.SetOutputOrigin(fixed_tile.TransformContinuousIndexToPhysicalPoint([-m for m in margin]))
+    resampler.SetOutputPixelType(sitk.sitkFloat32)
+    resampler.SetTransform(initial_transform)
+    moving_tile = resampler.Execute(moving_image)
+
+    scale_factors = [2, 1]
+    reg = sitk.ImageRegistrationMethod()
+    reg.SetNumberOfThreads(number_of_threads)
+    reg.SetMetricAsCorrelation()
+    reg.SetMetricSamplingStrategy(reg.REGULAR)
+    sampling_percentage = 3 * number_of_samples_per_parameter / fixed_tile.GetNumberOfPixels()
+    reg.SetMetricSamplingPercentagePerLevel(
+        [min(0.10, sampling_percentage * f * f) for f in scale_factors], sitkibex.globals.default_random_seed
+    )
+    reg.SetShrinkFactorsPerLevel(scale_factors)
+    reg.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+    reg.SetSmoothingSigmasPerLevel([2.0 * sigma * f * fixed_tile.GetSpacing()[0] for f in scale_factors])
+    reg.SetInterpolator(sitk.sitkLinear)
+    reg.MetricUseMovingImageGradientFilterOff()
+    reg.MetricUseFixedImageGradientFilterOff()
+    # The step of the regular step optimizer is halved when the direction changes, so the few parameters of the
+    # translation converge in a few tens of iterations.
+    reg.SetOptimizerAsRegularStepGradientDescent(
+        learningRate=1.0,
+        minStep=1e-3,
+        numberOfIterations=number_of_iterations,
+        relaxationFactor=0.5,
+    )
+    reg.SetOptimizerScalesFromIndexShift()
+    reg.SetInitialTransform(sitk.TranslationTransform(3))
+
+    translation = sitk.TranslationTransform(reg.Execute(fixed_tile, moving_tile))
+    return translation.GetOffset(), -reg.GetMetricValue()
+
+
+def _tile_landmarks(fixed_image, tile_indexes, tile_size, results, max_displacement, min_correlation):
+    """
+    The fixed and moving landmarks, and their weights, of the tile centers displaced by the translations of the tiles.
+
+    The uniform tiles, the tiles with a correlation less than min_correlation and the tiles displaced by more than
+    max_displacement pixels are rejected. The displacement of a tile is constant along Z, so the landmarks are repeated
+    at the first, middle and last slice.
+    """
+
+    size = fixed_image.GetSize()
+    # the tiles are displaced in XY, the Z spacing is usually larger
+    max_offset = max_displacement * max(fixed_image.GetSpacing()[:2])
+    fixed_landmarks, moving_landmarks, weights = [], [], []
+    for index, result in zip(tile_indexes, results):
+        if result is None:
+            continue
+        offset, correlation = result
+        if correlation < min_correlation or np.linalg.norm(offset) > max_offset:
+            _logger.debug(
+                "Rejecting the tile at {0} with offset {1} and correlation {2}.".format(index, offset, correlation)
+            )
+            continue
+        for z in [0, (size[2] - 1) / 2.0, size[2] - 1]:
+            center = fixed_image.TransformContinuousIndexToPhysicalPoint(
+                [i + (t - 1) / 2.0 for i, t in zip(index, tile_size)] + [z]
+            )
+            fixed_landmarks.extend(center)
+            moving_landmarks.extend(np.add(center, offset))
+            weights.append(correlation)
+    return fixed_landmarks, moving_landmarks, weights
+
+
+def registration_tiled(
+    fixed_image: sitk.Image,
+    moving_image: sitk.Image,
+    initial_transform: sitk.Transform,
+    *,
+    tile_size=256,
+    overlap=0.25,
+    max_displacement=16,
+    number_of_control_points=4,
+    min_correlation=0.5,
+    sigma=1.0,
+    samples_per_parameter=5000,
+    number_of_iterations=100,
+    max_workers=None,
+    telemetry=None,
+) -> sitk.Transform:
+    """Refine a global registration with a smooth deformation fitted to the registration of local tiles.
+
+    The fixed image is split in X and Y into overlapping tiles of the full Z extent. Starting from the initial
+    transform, e.g. the result of `registration`, the translation of each tile is registered independently by a pool of
+    threads. The translations of the tiles with a correlation of at least min_correlation are the displacements of the
+    tile centers, which are approximated by a BSplineTransform with number_of_control_points along each axis. Fewer
+    control points give a smoother deformation.
+
+    Each tile registration only uses the tile and the moving image resampled onto the tile padded by max_displacement,
+    so the memory and the work of a tile are bounded by tile_size. The threads of SimpleITK are divided evenly between
+    the workers.
+
+    :param fixed_image: a scalar SimpleITK 3D Image
+    :param moving_image: a scalar SimpleITK 3D Image
+    :param initial_transform: a SimpleITK transform mapping points from the fixed image to the moving image
+    :param tile_size: the size in pixels of the tiles in X and Y
+    :param overlap: the fraction of the tile_size overlapping the neighboring tiles
+    :param max_displacement: the maximum displacement in pixels of a tile, larger displacements are rejected
+    :param number_of_control_points: the number of control points of the BSplineTransform along each axis
+    :param min_correlation: the minimum correlation of a registered tile for its displacement to be used
+    :param sigma: scalar to change the amount of Gaussian smoothing performed
+    :param samples_per_parameter: the number of image samples to used per transform parameter at full resolution
+    :param number_of_iterations: the maximum number of iterations of each level of a tile registration
+    :param max_workers: the number of tiles registered concurrently, by default the number of CPUs
+    :param telemetry: (optional) a RegistrationTelemetry the "tiled" phase is recorded into
+    :return: A SimpleITK CompositeTransform of the initial transform and the BSplineTransform, mapping points from the
+     fixed image to the moving image. The initial transform when no tile is registered.
+    """
+
+    if fixed_image.GetPixelID() != sitk.sitkFloat32:
+        fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+
+    size = fixed_image.GetSize()
+    tile_size = [min(tile_size, s) for s in size[:2]]
+    step = [max(1, int(t * (1.0 - overlap))) for t in tile_size]
+    margin = [max_displacement, max_displacement, 0]
+    tile_indexes = list(itertools.product(*[_tile_starts(s, t, st) for s, t, st in zip(size[:2], tile_size, step)]))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    number_of_threads = max(1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // max_workers)
+
+    _logger.info(
+        "Registering {0} tiles of {1} with {2} workers of {3} threads.".format(
+            len(tile_indexes), tile_size, max_workers, number_of_threads
+        )
+    )
+
+    def register_tile(index):
+        fixed_tile = sitk.RegionOfInterest(fixed_image, tile_size + [size[2]], list(index) + [0])
+        return _register_tile(
+            fixed_tile,
+            moving_image,
+            initial_transform,
+            margin,
+            sigma,
+            samples_per_parameter,
+            number_of_iterations,
+            number_of_threads,
+        )
+
+    with _telemetry_phase(
+        telemetry, "tiled", tile_size=tile_size, number_of_tiles=len(tile_indexes)
+    ) as telemetry_record, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(register_tile, tile_indexes))
+        fixed_landmarks, moving_landmarks, weights = _tile_landmarks(
+            fixed_image, tile_indexes, tile_size, results, max_displacement, min_correlation
+        )
+        if telemetry_record is not None:
+            telemetry_record["number_of_fitted_tiles"] = len(weights) // 3
+
+    _logger.info("Fitting the displacements of {0} of {1} tiles.".format(len(weights) // 3, len(tile_indexes)))
+    if not weights:
+        _logger.warning("No tile was registered, returning the initial transform.")
+        return initial_transform
+
+    bspline = sitk.LandmarkBasedTransformInitializer(
+        sitk.BSplineTransform(3),
+        fixed_landmarks,
+        moving_landmarks,
+        weights,
+        fixed_image,
+        number_of_control_points,
+    )
+
+    result = sitk.CompositeTransform([initial_transform, bspline])
+    result.FlattenTransform()
     return result
@@ -15,40 +15,219 @@
 #
 import SimpleITK as sitk
 import time
+from contextlib import contextmanager
 from functools import reduce
 import itertools
 from functools import wraps
+import json
 import logging
+import os
+import threading
 
 _logger = logging.getLogger(__name__)
 
 
+def _rss_bytes():
+    """The current resident set size of the process in bytes, or None when not available on the platform."""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler:
+    """
+    Samples the resident memory of the process in a background thread, to measure the peak memory allocated during a
+    phase. Unlike the high-water mark of the process, the peak is relative to the memory in use when the phase starts.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = _rss_bytes()
+        self.peak_rss = self.start_rss
+        self._stop = threading.Event()
+        self._thread = None
+        if self.start_rss is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, _rss_bytes())
+
+    def stop(self):
+        """Stop sampling, and return the peak memory allocated since the start in bytes, or None if not available."""
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, _rss_bytes())
+        return self.peak_rss - self.start_rss
+
+
+class RegistrationTelemetry:
+    """
+    Machine-readable timing and metric records of the phases of a registration.
+
+    Each element of `phases` is a dictionary with the "phase" name, its "duration" in seconds and its
+    "peak_allocation_bytes", the peak increase of the resident memory of the process during the phase sampled every few
+    milliseconds, or None when not available on the platform. The phases optimized
+    by a SimpleITK ImageRegistrationMethod also record the total "iterations", the "final_metric_value", the
+    "stop_condition" and the "levels" of the multi-resolution. Each level records its "duration", "iterations",
+    "stop_condition" and the "metric_values" and "number_of_valid_points" of each iteration. The registration
+    functions add the parameters of the phase, such as the "sampling_percentage_per_level", and the adaptive 3D
+    registration adds the "iteration_budget", "transform_change" and "skipped" state of each level.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, **values):
+        """A context manager timing a phase, yielding the record of the phase to add values to."""
+
+        record = dict(phase=name, **values)
+        self.phases.append(record)
+        rss_sampler = _RSSSampler()
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["duration"] = time.perf_counter() - start_time
+            record["peak_allocation_bytes"] = rss_sampler.stop()
+
+    def to_json_lines(self, **fields) -> str:
+        """The phases as JSON lines, one object per phase, with the additional fields added to each object."""
+        return "".join(json.dumps(dict(fields, **record)) + "\n" for record in self.phases)
+
+    def to_openmetrics(self, labels=None) -> str:
+        """The phases as OpenMetrics text, with the additional labels added to each sample."""
+        return telemetry_to_openmetrics([(self, labels)])
+
+
+def _openmetrics_labels(labels):
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+
+
+def _add_level_samples(families, level_labels, level):
+    """Add the samples of a level of a registration phase to the OpenMetrics families."""
+    families["level_duration_seconds"][1].append((level_labels, level["duration"]))
+    families["level_iterations"][1].append((level_labels, level["iterations"]))
+    families["level_skipped"][1].append((level_labels, int(level.get("skipped", False))))
+    if level["metric_values"]:
+        families["level_final_metric_value"][1].append((level_labels, level["metric_values"][-1]))
+    if level["number_of_valid_points"]:
+        families["level_number_of_valid_points"][1].append((level_labels, level["number_of_valid_points"][-1]))
+
+
+def telemetry_to_openmetrics(telemetry_labels) -> str:
+    """
+    Format the phases of several registrations as OpenMetrics text.
+
+    :param telemetry_labels: A sequence of pairs of a RegistrationTelemetry and a dictionary of labels identifying the
+     registration, or None.
+    :return: The text exposition, with one gauge metric family per measurement.
+    """
+
+    families = {
+        "phase_duration_seconds": ("seconds", []),
+        "phase_iterations": (None, []),
+        "phase_final_metric_value": (None, []),
+        "phase_peak_allocation_bytes": ("bytes", []),
+        "level_duration_seconds": ("seconds", []),
+        "level_iterations": (None, []),
+        "level_final_metric_value": (None, []),
+        "level_number_of_valid_points": (None, []),
+        "level_skipped": (None, []),
+    }
+
+    for telemetry, labels in telemetry_labels:
+        for record in telemetry.phases:
+            phase_labels = dict(labels or {}, phase=record["phase"])
+            families["phase_duration_seconds"][1].append((phase_labels, record["duration"]))
+            if record.get("peak_allocation_bytes") is not None:
+                families["phase_peak_allocation_bytes"][1].append((phase_labels, record["peak_allocation_bytes"]))
+            if "levels" not in record:
+                continue
+            families["phase_iterations"][1].append((phase_labels, record["iterations"]))
+            families["phase_final_metric_value"][1].append((phase_labels, record["final_metric_value"]))
+            for level in record["levels"]:
+                _add_level_samples(families, dict(phase_labels, level=level["level"]), level)
+
+    lines = []
+    for name, (unit, samples) in families.items():
+        if not samples:
+            continue
+        name = "sitkibex_registration_" + name
+        lines.append("# TYPE {} gauge".format(name))
+        if unit:
+            lines.append("# UNIT {} {}".format(name, unit))
+        lines += ["{}{{{}}} {}".format(name, _openmetrics_labels(labels), value) for labels, value in samples]
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
 class RegistrationCallbackManager:
-    """An object with member functions for the callbacks of a sitk RegistrationMethod"""
+    """An object with member functions for the callbacks of a sitk RegistrationMethod
+
+    When a telemetry_record, the record of a phase of a RegistrationTelemetry, is provided the levels, iterations and
+    metric values of the registration are recorded into it.
+    """
 
-    def __init__(self, registration_method):
+    def __init__(self, registration_method, telemetry_record=None):
         self.R = registration_method
         self.start_time = None
         self.prev_time = None
+        self.telemetry_record = telemetry_record
 
     def add_command_callbacks(self, print_position=False, verbose=True):
         """Registers all callbacks with registration method"""
 
         if verbose:
             self.R.AddCommand(sitk.sitkIterationEvent, lambda: self.iteration_callback1(print_position=print_position))
+        if self.telemetry_record is not None:
+            self.R.AddCommand(sitk.sitkIterationEvent, lambda: self.telemetry_iteration_callback())
         self.R.AddCommand(sitk.sitkEndEvent, lambda: self.end_callback())
         self.R.AddCommand(sitk.sitkStartEvent, lambda: self.start_callback())
         self.R.AddCommand(sitk.sitkMultiResolutionIterationEvent, lambda: self.multi_resolution_callback())
 
+    def _number_of_valid_points(self):
+        try:
+            return self.R.GetMetricNumberOfValidPoints()
+        except AttributeError:
+            # Ignore self.R not existing
+            return None
+
+    def _end_telemetry_level(self, end_time):
+        """Complete the telemetry record of the current level."""
+        if self.telemetry_record is None or not self.telemetry_record["levels"]:
+            return
+        level = self.telemetry_record["levels"][-1]
+        level["duration"] = end_time - self.prev_time
+        level["iterations"] = self.R.GetOptimizerIteration()
+        level["stop_condition"] = self.R.GetOptimizerStopConditionDescription()
+
     def start_callback(self):
         _logger.info("===Registration Start===")
         self.start_time = time.time()
+        if self.telemetry_record is not None:
+            self.telemetry_record["levels"] = []
 
     def end_callback(self, message=None):
         end_time = time.time()
         if message is not None:
             _logger.info(message)
 
+        if self.telemetry_record is not None:
+            self._end_telemetry_level(end_time)
+            self.telemetry_record["iterations"] = sum(level["iterations"] for level in self.telemetry_record["levels"])
+            self.telemetry_record["final_metric_value"] = self.R.GetMetricValue()
+            self.telemetry_record["stop_condition"] = self.R.GetOptimizerStopConditionDescription()
+
         _logger.info("Total elapsed time: {0:.4f}s".format(end_time - self.start_time))
         _logger.info("Optimizer stop condition: {0}".format(self.R.GetOptimizerStopConditionDescription()))
         _logger.info(" Iteration: {0}".format(self.R.GetOptimizerIteration()))
@@ -76,12 +255,9 @@ class RegistrationCallbackManager:
                 pass
                 # _logger.info("Estimated Scales: {0}".format(self.R.GetOptimizerScales()[0]))
 
-        number_of_valid_points = "?"
-        try:
-            number_of_valid_points = self.R.GetMetricNumberOfValidPoints()
-        except AttributeError:
-            # Ignore self.R not existing
-            pass
+        number_of_valid_points = self._number_of_valid_points()
+        if number_of_valid_points is None:
+            number_of_valid_points = "?"
 
         if print_position:
             _logger.info(
@@ -113,10 +289,22 @@ class RegistrationCallbackManager:
             _logger.info(" Total Iteration: {0}".format(self.R.GetOptimizerIteration()))
             _logger.info(" Metric value: {0}".format(self.R.GetMetricValue()))
             _logger.info(" Convergence value: {0}".format(self.R.GetOptimizerConvergenceValue()))
+            self._end_telemetry_level(multi_time)
 
         self.prev_time = multi_time
         _logger.info("---Level {0} Start---".format(self.R.GetCurrentLevel()))
 
+        if self.telemetry_record is not None:
+            self.telemetry_record["levels"].append(
+                {"level": self.R.GetCurrentLevel(), "metric_values": [], "number_of_valid_points": []}
+            )
+
+    def telemetry_iteration_callback(self):
+        """Record the metric value and the number of valid points of an iteration into the telemetry record."""
+        level = self.telemetry_record["levels"][-1]
+        level["metric_values"].append(self.R.GetMetricValue())
+        level["number_of_valid_points"].append(self._number_of_valid_points())
+
 
 def sub_volume_execute(inplace=True):
     """
@@ -15,7 +15,12 @@
 #
 
 import SimpleITK as sitk
+import numpy as np
+import itertools
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .io import ImageRegionReader, im_block_writer, _vector_to_scalar
 
 _logger = logging.getLogger(__name__)
 
@@ -52,6 +57,85 @@ def _combine_images(fixed_image, moving_image, transform, virtual_image=None, tx
     return sitk.Compose([fixed_resampled, moving_resampled])
 
 
+def _resample_channels(execute, image, transform):
+    """Resample the channels along the 4th dimension of image with execute, returning a list of 3D images.
+
+    The points of a linear transform are cheaply computed incrementally by the resampler, so each channel is resampled
+    on its own. Otherwise, the channels are composed into a multi-component image, so the non-linear transform is
+    evaluated once for each output pixel for all the channels, without a displacement field of the output grid.
+    """
+
+    channels = [image[:, :, :, c] for c in range(image.GetSize()[3])]
+    if transform.IsLinear():
+        return [execute(channel) for channel in channels]
+
+    resampled_image = execute(sitk.Compose(channels))
+    return [sitk.VectorIndexSelectionCast(resampled_image, c) for c in range(len(channels))]
+
+
+def _project(image):
+    """The mean z-projection of a 3D image as a 2D image of the same pixel type."""
+
+    proj_size = image.GetSize()[:2] + (0,)
+    projection_image = sitk.Cast(sitk.MeanProjection(image, projectionDimension=2), image.GetPixelID())
+    return sitk.Extract(
+        projection_image,
+        size=proj_size,
+        directionCollapseToStrategy=sitk.ExtractImageFilter.DIRECTIONCOLLAPSETOIDENTITY,
+    )
+
+
+def _affine_transform(transform):
+    """The AffineTransform equal to a linear transform, from the images of the origin and of the unit vectors."""
+
+    dimension = transform.GetDimension()
+    translation = np.array(transform.TransformPoint([0.0] * dimension))
+    matrix = np.array([np.subtract(transform.TransformPoint(e), translation) for e in np.eye(dimension)]).T
+    return sitk.AffineTransform(matrix.ravel().tolist(), translation.tolist())
+
+
+def collapse_transform(transform: sitk.Transform, reference_image=None, grid_shrink=4) -> sitk.Transform:
+    """Collapse a transform, such as a CompositeTransform from registration, into one transform cheaper to evaluate.
+
+    A linear transform is collapsed into one equivalent AffineTransform. A non-linear transform is sampled into a
+    DisplacementFieldTransform on a grid covering the reference image with about grid_shrink times its spacing, which
+    is linearly interpolated. Evaluating the displacement field costs the same for any transform, e.g. a B-spline
+    deformation composed with an affine transform, so it is computed once and reused to resample many channels.
+
+    :param transform: A 3D SimpleITK Transform mapping points from the fixed image to the moving image.
+    :param reference_image: A SimpleITK Image or an ImageGeometry of the output grid, the fixed image. Required for a
+     non-linear transform.
+    :param grid_shrink: The factor of the spacing of the displacement field grid to the spacing of the reference image.
+    :return: An AffineTransform or a DisplacementFieldTransform.
+    """
+
+    if transform.IsLinear():
+        return _affine_transform(transform)
+
+    if reference_image is None:
+        raise ValueError("A reference image is required to collapse a non-linear transform.")
+
+    # The first and last points of the grid are the first and last pixels of the reference image, so the displacements
+    # are interpolated over the image without sampling the transform outside of it.
+    size = [-(-(s - 1) // grid_shrink) + 1 for s in reference_image.GetSize()]
+    spacing = [
+        sp * max(1, s - 1) / max(1, n - 1)
+        for sp, s, n in zip(reference_image.GetSpacing(), reference_image.GetSize(), size)
+    ]
+    _logger.info("Sampling the transform into a displacement field of size {}...".format(size))
+    displacement_field = sitk.TransformToDisplacementField(
+        transform,
+        sitk.sitkVectorFloat64,
+        size,
+        reference_image.GetOrigin(),
+        spacing,
+        reference_image.GetDirection(),
+    )
+    displacement_transform = sitk.DisplacementFieldTransform(displacement_field)
+    displacement_transform.SetInterpolator(sitk.sitkLinear)
+    return displacement_transform
+
+
 def resample(
     fixed_image: sitk.Image,
     moving_image: sitk.Image,
@@ -60,7 +144,8 @@ def resample(
     fusion=False,
     projection=False,
     combine=False,
-    invert=False
+    invert=False,
+    collapse=False
 ) -> sitk.Image:
     """Resample fixed_image onto the coordinates of moving_image with transform results from registration.
 
@@ -71,15 +156,18 @@ def resample(
     If no transform is provided, then an identity transform is assumed and the moving_image is still resampled onto the
     fixed_image. This operation is useful to see alignment of images before registration.
 
-
+    A 4D moving_image is resampled as a 3D image for each channel. With a non-linear transform, the channels are
+    resampled together as a multi-component image, so the transform is evaluated once for each output pixel.
 
     :param fixed_image: A 3D SimpleITK Image whose pixel values are resampled
-    :param moving_image: A 3D SimpleITK Image whose coordinates are used for the output image
+    :param moving_image: A 3D or 4D SimpleITK Image whose coordinates are used for the output image
     :param transform: (optional) A 3D SimpleITK Transform mapping from points from the fixed_image to the moving_image.
     :param fusion: Enable fusing the resampled moving_image and the fixed_image into a RGB image.
     :param projection: Enable perform a z-projection to reduce the dimensionality to 2D.
     :param combine: Enable combining the resampled moving_image and the fixed_image into a 2-channel vector image.
     :param invert: Invert the input transform.
+    :param collapse: Collapse the transform with `collapse_transform` before resampling, a non-linear transform is \
+    sampled into a displacement field once for all the channels.
     :return: The processed SimpleITK Image.
     """
 
@@ -89,6 +177,18 @@ def resample(
     if invert:
         transform = transform.GetInverse()
 
+    if collapse:
+        transform = collapse_transform(transform, fixed_image)
+
+    if moving_image.GetDimension() == 4 and not (fusion or combine):
+        number_of_channels = moving_image.GetSize()[3]
+        _logger.info("Resampling {} channels...".format(number_of_channels))
+        channels = _resample_channels(lambda image: resample(fixed_image, image, transform), moving_image, transform)
+        if projection:
+            _logger.info("Projecting image...")
+            channels = [_project(channel) for channel in channels]
+        return sitk.JoinSeries(channels, moving_image.GetOrigin()[3], moving_image.GetSpacing()[3])
+
     if fusion or combine:
 
         _logger.info("Fusing images...")
@@ -113,13 +213,180 @@ def resample(
 
     if projection:
         _logger.info("Projecting image...")
-        proj_size = resampled_image.GetSize()[:2] + (0,)
-        output_pixel_type = resampled_image.GetPixelID()
-        projection_image = sitk.Cast(sitk.MeanProjection(resampled_image, projectionDimension=2), output_pixel_type)
-        resampled_image = sitk.Extract(
-            projection_image,
-            size=proj_size,
-            directionCollapseToStrategy=sitk.ExtractImageFilter.DIRECTIONCOLLAPSETOIDENTITY,
-        )
+        resampled_image = _project(resampled_image)
 
     return resampled_image
+
+
+def _moving_bounding_box(fixed_image, moving_image, transform, block_index, block_size, padding=2):
+    """
+    Compute the region of the moving image which the transform maps the block of the fixed image onto.
+
+    A lattice of points over the block, including the corners, is transformed so that smooth non-linear transforms are
+    also bounded. The region is padded for the interpolation support and clipped to the moving image.
+
+    :return: The index and size of the region, or None if the block maps outside of the moving image.
+    """
+
+    axes_points = [np.linspace(i - 0.5, i + s - 0.5, min(s + 1, 5)) for i, s in zip(block_index, block_size)]
+    moving_points = np.array(
+        [
+            transform.TransformPoint(fixed_image.TransformContinuousIndexToPhysicalPoint(idx))
+            for idx in itertools.product(*axes_points)
+        ]
+    )
+
+    # the spatial dimensions of a moving image with channels as the 4th dimension
+    dim = moving_image.GetDimension()
+    index_to_physical = np.array(moving_image.GetDirection()).reshape(dim, dim)[:3, :3] * moving_image.GetSpacing()[:3]
+    moving_indexes = (moving_points - moving_image.GetOrigin()[:3]) @ np.linalg.inv(index_to_physical).T
+
+    lower = np.maximum(np.floor(moving_indexes.min(axis=0)).astype(int) - padding, 0)
+    upper = np.minimum(np.ceil(moving_indexes.max(axis=0)).astype(int) + padding, moving_image.GetSize()[:3])
+    if np.any(upper <= lower):
+        return None
+    return lower.tolist(), (upper - lower).tolist()
+
+
+def _resample_block(fixed_image, moving_image, transform, block_index, block_size, number_of_threads):
+    """Resample the moving image onto one block of the fixed image grid.
+
+    With an ImageRegionReader, only the bounding box of the block is read from the moving image file. The channels of
+    a 4D moving image are resampled with the same bounding box and composed into a multi-component block.
+    """
+
+    if isinstance(moving_image, ImageRegionReader):
+        bounding_box = _moving_bounding_box(fixed_image, moving_image.geometry, transform, block_index, block_size)
+    else:
+        bounding_box = _moving_bounding_box(fixed_image, moving_image, transform, block_index, block_size)
+    if bounding_box is None:
+        return None
+
+    lower, size = bounding_box
+    if isinstance(moving_image, ImageRegionReader):
+        moving_block = moving_image.read(lower, size)
+    else:
+        moving_block = moving_image[
+            tuple(slice(i, i + s) for i, s in zip(lower, size)) + (slice(None),) * (moving_image.GetDimension() - 3)
+        ]
+
+    block_origin = fixed_image.TransformIndexToPhysicalPoint(block_index)
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetNumberOfThreads(number_of_threads)
+    resampler.SetOutputDirection(fixed_image.GetDirection())
+    resampler.SetOutputOrigin(block_origin)
+    resampler.SetOutputSpacing(fixed_image.GetSpacing())
+    resampler.SetSize(block_size)
+    resampler.SetDefaultPixelValue(0)
+    resampler.SetInterpolator(sitk.sitkLinear)
+    resampler.SetTransform(transform)
+
+    if moving_block.GetDimension() == 3:
+        return resampler.Execute(moving_block)
+    return sitk.Compose(_resample_channels(resampler.Execute, moving_block, transform))
+
+
+def resample_tiled(  # noqa: C901
+    fixed_image: sitk.Image,
+    moving_image: sitk.Image,
+    transform: sitk.Transform = None,
+    *,
+    output_filename,
+    invert=False,
+    block_size=(512, 512, 64),
+    max_workers=None,
+    channel_names=None,
+    collapse=False
+):
+    """Resample moving_image onto the coordinates of fixed_image in blocks, writing the output to a file.
+
+    The grid of the fixed_image is split into blocks, and for each block only the bounding box of the moving_image
+    mapped by the transform is resampled. The blocks are resampled concurrently by a pool of threads and written into
+    the output file as they are completed, so the whole output image is never in memory. When the moving_image is an
+    ImageRegionReader, the bounding box of each block is read from the file, so the whole moving image is not in memory
+    either. When writing OME-Zarr, the down-sampled levels of the multiscale pyramid are generated from the blocks in
+    the same pass.
+
+    For a 4D moving_image, the bounding box is computed once for each block and used to resample all the channels. The
+    channels are written to the channel axis of an OME-Zarr output, or as the pixel components of a MetaImage output.
+
+    :param fixed_image: A 3D SimpleITK Image or an ImageGeometry whose coordinates are used for the output image
+    :param moving_image: A 3D or 4D SimpleITK Image, or an ImageRegionReader, whose pixel values are resampled
+    :param transform: (optional) A 3D SimpleITK Transform mapping from points from the fixed_image to the moving_image.
+    :param output_filename: The path of the output, an uncompressed MetaImage ".mha" file or an OME-Zarr ".zarr"
+     directory.
+    :param invert: Invert the input transform.
+    :param block_size: The size in pixels of the blocks of the output image.
+    :param max_workers: The number of blocks resampled concurrently, by default the number of CPUs.
+    :param channel_names: (optional) The names of the channels written to the OME-Zarr metadata.
+    :param collapse: Collapse the transform with `collapse_transform` before resampling, a non-linear transform is \
+    sampled into a displacement field once for all the blocks.
+    """
+
+    if not transform:
+        transform = sitk.Transform(3, sitk.sitkIdentity)
+
+    if invert:
+        transform = transform.GetInverse()
+
+    if collapse:
+        transform = collapse_transform(transform, fixed_image)
+
+    if isinstance(moving_image, ImageRegionReader):
+        dimension, pixel_id = moving_image.dimension, moving_image.pixel_id
+        number_of_components = moving_image.number_of_components
+    else:
+        dimension, pixel_id = moving_image.GetDimension(), moving_image.GetPixelID()
+        number_of_components = moving_image.GetNumberOfComponentsPerPixel()
+        if dimension == 4 and number_of_components == 1:
+            number_of_components = moving_image.GetSize()[3]
+    if dimension not in (3, 4) or (dimension == 4 and pixel_id in _vector_to_scalar):
+        raise ValueError("Tiled resampling requires a 3D or a scalar 4D moving image.")
+
+    number_of_cpus = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = number_of_cpus
+    number_of_threads = max(1, number_of_cpus // max_workers)
+
+    writer = im_block_writer(
+        output_filename,
+        fixed_image,
+        pixel_id,
+        number_of_components,
+        channel_names=channel_names,
+    )
+
+    # The blocks are aligned as required by the writer, e.g. for the down-sampled levels of a pyramid
+    block_size = [-(-b // a) * a for b, a in zip(block_size, writer.block_alignment)]
+
+    output_size = fixed_image.GetSize()
+    blocks = [
+        (block_index, [min(b, s - i) for i, b, s in zip(block_index, block_size, output_size)])
+        for block_index in itertools.product(*[range(0, s, b) for s, b in zip(output_size, block_size)])
+    ]
+
+    _logger.info("Resampling image in {} blocks with {} workers...".format(len(blocks), max_workers))
+
+    with writer, ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def write_completed(futures):
+            for future in futures:
+                block_image, block_index = future.result(), futures[future]
+                if block_image is not None:
+                    writer.write(block_image, block_index)
+
+        # The number of blocks in memory is bounded by limiting the submitted blocks not yet written
+        pending = {}
+        for block_index, size in blocks:
+            if len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                write_completed({f: pending.pop(f) for f in done})
+
+            future = executor.submit(
+                _resample_block, fixed_image, moving_image, transform, list(block_index), size, number_of_threads
+            )
+            pending[future] = list(block_index)
+
+        wait(pending)
+        write_completed(pending)
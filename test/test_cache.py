@@ -0,0 +1,73 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import SimpleITK as sitk
+import os
+
+from sitkibex.cache import TransformCache
+import sitkibex.registration_utilities as utils
+
+
+def test_cache_key(tmp_path):
+    filename = tmp_path / "image.nrrd"
+    filename.write_bytes(b"1234")
+    store = tmp_path / "image.zarr"
+    store.mkdir()
+    (store / ".zattrs").write_text("{}")
+
+    key = TransformCache.key([(filename, "CD4"), (store, None)], sigma=1.0)
+    assert key == TransformCache.key([(filename, "CD4"), (store, None)], sigma=1.0)
+    assert key != TransformCache.key([(filename, "CD3"), (store, None)], sigma=1.0)
+    assert key != TransformCache.key([(filename, "CD4"), (store, None)], sigma=2.0)
+
+    os.utime(filename, ns=(0, 0))
+    assert key != TransformCache.key([(filename, "CD4"), (store, None)], sigma=1.0)
+
+    key = TransformCache.key([(filename, "CD4"), (store, None)], sigma=1.0)
+    (store / "0").write_bytes(b"chunk")
+    assert key != TransformCache.key([(filename, "CD4"), (store, None)], sigma=1.0)
+
+
+def test_cache_get_put(tmp_path):
+    cache = TransformCache(tmp_path / "cache")
+    assert cache.get("missing") is None
+
+    telemetry = utils.RegistrationTelemetry()
+    with telemetry.phase("fft_initialization", bin_shrink=8):
+        pass
+
+    cache.put("key", sitk.TranslationTransform(3, [1.0, 2.0, 3.0]), telemetry)
+    tx, cached_telemetry = cache.get("key")
+    assert (1.0, 2.0, 3.0) == tx.GetParameters()
+    assert telemetry.phases == cached_telemetry.phases
+
+    cache.put("key", sitk.TranslationTransform(3, [1.0, 2.0, 3.0]))
+    assert ["key"] == os.listdir(cache.directory)
+
+
+def test_cache_eviction(tmp_path):
+    cache = TransformCache(tmp_path / "cache")
+    cache.put("a", sitk.TranslationTransform(3))
+    entry_size = sum(f.stat().st_size for f in (cache.directory / "a").iterdir())
+
+    cache = TransformCache(tmp_path / "cache", max_size=2 * entry_size)
+    os.utime(cache.directory / "a", (0, 0))
+    cache.put("b", sitk.TranslationTransform(3))
+    os.utime(cache.directory / "b", (1, 1))
+    # reading an entry makes it the most recently used
+    assert cache.get("a") is not None
+
+    cache.put("c", sitk.TranslationTransform(3))
+    assert {"a", "c"} == set(os.listdir(cache.directory))
@@ -15,6 +15,7 @@
 #
 from click.testing import CliRunner
 from sitkibex.cli import cli
+import json
 import os.path
 import pytest
 
@@ -56,6 +57,56 @@ reg_args = [
     ["registration", data_files["panel1.nrrd"] + "@Ch5", data_files["panel2.nrrd"] + "@CH5", "out.txt"],
     ["registration", data_files["vpanel1.nrrd"] + "@JOJO", data_files["panel2.nrrd"] + "@CH5", "out.txt"],
     ["registration", data_files["vpanel1.nrrd"] + "@4", data_files["panel2.nrrd"] + "@CH5", "out.txt"],
+    [
+        "registration",
+        "--affine",
+        "--adaptive",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.txt",
+    ],
+    [
+        "registration",
+        "--log-polar",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.txt",
+    ],
+    [
+        "registration",
+        "--profile",
+        "fast",
+        "--affine",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.txt",
+    ],
+    [
+        "registration",
+        "--tile-size",
+        "64",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.h5",
+    ],
+    [
+        "registration",
+        "--fft-candidates",
+        "3",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.txt",
+    ],
+    [
+        "registration",
+        "--bin",
+        "2",
+        "--automask",
+        "--low-memory",
+        data_files["panel1.nrrd"] + "@JOJO",
+        data_files["panel2.nrrd"] + "@JOJO",
+        "out.txt",
+    ],
 ]
 
 
@@ -68,6 +119,96 @@ def test_cli_reg(cli_args):
     assert not result.exception
 
 
+@pytest.mark.parametrize("telemetry_format", ["jsonl", "openmetrics"])
+def test_cli_reg_telemetry(telemetry_format):
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            cli,
+            [
+                "registration",
+                "--telemetry",
+                "telemetry.txt",
+                "--telemetry-format",
+                telemetry_format,
+                data_files["panel1.nrrd"] + "@JOJO",
+                data_files["panel2.nrrd"] + "@JOJO",
+                "out.txt",
+            ],
+        )
+        assert not result.exception
+        assert os.path.isfile("out.txt")
+        with open("telemetry.txt") as fp:
+            assert "fft_initialization" in fp.read()
+
+
+def test_cli_reg_batch():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            cli,
+            [
+                "register-batch",
+                "-j",
+                "2",
+                data_files["panel1.nrrd"] + "@JOJO",
+                data_files["panel2.nrrd"] + "@JOJO",
+                data_files["vpanel1.nrrd"] + "@JOJO",
+            ],
+        )
+        assert not result.exception
+        assert os.path.isfile("tx_panel1_to_panel2.txt")
+        assert os.path.isfile("tx_panel1_to_vpanel1.txt")
+
+        result = runner.invoke(
+            cli,
+            [
+                "register-batch",
+                "--pipeline",
+                "--telemetry",
+                "telemetry.jsonl",
+                data_files["panel1.nrrd"] + "@JOJO",
+                data_files["panel2.nrrd"] + "@JOJO",
+                data_files["vpanel1.nrrd"] + "@JOJO",
+            ],
+        )
+        assert not result.exception
+        with open("telemetry.jsonl") as fp:
+            assert {"panel2.nrrd", "vpanel1.nrrd"} == {json.loads(line)["moving"] for line in fp}
+
+
+def test_cli_reg_cache(monkeypatch):
+    import sys
+
+    # the sitkibex.registration attribute is the function, not the module
+    registration_module = sys.modules["sitkibex.registration"]
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        reg_args = ["registration", "--cache-directory", "cache", "--telemetry", "telemetry.jsonl"]
+        images = [data_files["panel1.nrrd"] + "@JOJO", data_files["panel2.nrrd"] + "@JOJO"]
+        result = runner.invoke(cli, reg_args + images + ["out1.txt"])
+        assert not result.exception
+        assert 1 == len(os.listdir("cache"))
+
+        # The cached result is used without registering again
+        def fail(*args, **kwargs):
+            raise AssertionError("registration is not cached")
+
+        monkeypatch.setattr(registration_module, "registration", fail)
+        monkeypatch.setattr(registration_module, "registration_batch", fail)
+        result = runner.invoke(cli, reg_args + images + ["out2.txt"])
+        assert not result.exception
+        with open("out1.txt") as fp1, open("out2.txt") as fp2:
+            assert fp1.read() == fp2.read()
+        with open("telemetry.jsonl") as fp:
+            assert "fft_initialization" in fp.read()
+
+        result = runner.invoke(cli, ["register-batch", "--cache-directory", "cache"] + images)
+        assert not result.exception
+        assert os.path.isfile("tx_panel1_to_panel2.txt")
+
+
 resample_args = [
     "resample {} {} -o test.nrrd".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
     "resample {} {}@Ch1 -o test.nrrd".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
@@ -75,6 +216,22 @@ resample_args = [
     "resample  --bin 2 --fusion --projection {}@1 {}@Ch1 -o test.png".format(
         data_files["panel1.nrrd"], data_files["panel2.nrrd"]
     ),
+    "resample --block-size 32 32 8 -j 2 {}@JOJO {}@JOJO -o test.mha".format(
+        data_files["panel1.nrrd"], data_files["vpanel1.nrrd"]
+    ),
+    "resample --block-size 32 32 8 {}@JOJO {}@JOJO -o test.zarr".format(
+        data_files["panel1.nrrd"], data_files["vpanel1.nrrd"]
+    ),
+    "resample {} {} -o test.zarr".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
+    "resample --projection {} {} -o test.nrrd".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
+    "resample --collapse {} {} -o test.nrrd".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
+    "resample --block-size 32 32 8 {}@JOJO {} -o test.zarr".format(
+        data_files["panel1.nrrd"], data_files["panel2.nrrd"]
+    ),
+    "resample {}@JOJO {}@JOJO,Ch1 -o test.zarr".format(data_files["panel1.nrrd"], data_files["panel2.nrrd"]),
+    "resample --block-size 32 32 8 {}@JOJO {}@JOJO,0 -o test.mha".format(
+        data_files["panel1.nrrd"], data_files["panel2.nrrd"]
+    ),
 ]
 
 
@@ -86,6 +243,41 @@ def test_cli_resample(cli_args):
     assert not result.exception
 
 
+def test_cli_reg_profile_missing():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            cli,
+            ["registration", "--profile", "missing", data_files["panel1.nrrd"], data_files["panel2.nrrd"], "out.txt"],
+        )
+    assert 2 == result.exit_code
+    assert "missing" in result.output
+
+
+def test_cli_tune(monkeypatch):
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        monkeypatch.setenv("SITKIBEX_PROFILE_DIR", os.path.abspath("profiles"))
+        images = [data_files["panel1.nrrd"] + "@JOJO", data_files["panel2.nrrd"] + "@JOJO"]
+        result = runner.invoke(
+            cli,
+            ["tune", "--samples-per-parameter", "1000", "--shrink-factors", "4,2", "--shrink-factors", "4,2,1"]
+            + ["--name", "panel", "-o", "profile.json"]
+            + images,
+        )
+        assert not result.exception
+        with open("profile.json") as fp1, open(os.path.join("profiles", "panel.json")) as fp2:
+            assert json.load(fp1) == json.load(fp2)
+
+        result = runner.invoke(cli, ["registration", "--profile", "panel"] + images + ["out.txt"])
+        assert not result.exception
+
+        result = runner.invoke(cli, ["tune", "--shrink-factors", "4,a"] + images)
+        assert result.exit_code == 2
+        result = runner.invoke(cli, ["tune"] + images)
+        assert result.exit_code == 2
+
+
 def test_cli_resample_help():
     runner = CliRunner()
     result = runner.invoke(cli, ["resample", "--help"])
@@ -0,0 +1,411 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import SimpleITK as sitk
+import sitkibex.io
+import sitkibex.globals
+from sitkibex.io import (
+    ImageRegionReader,
+    MappedImage,
+    im_channel_index,
+    im_read_channel,
+    im_read_channels,
+    im_read_geometry,
+    im_write_zarr,
+)
+import sitkibex.registration_utilities as utils
+import os.path
+import logging
+import numpy as np
+import pytest
+
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def assert_image_equal(img1, img2, tolerance=0):
+    assert img1.GetSize() == img2.GetSize()
+    assert img1.GetPixelID() == img2.GetPixelID()
+    assert img1.GetSpacing() == pytest.approx(img2.GetSpacing())
+    assert img1.GetOrigin() == pytest.approx(img2.GetOrigin())
+    difference = sitk.GetArrayFromImage(img1).astype(float) - sitk.GetArrayFromImage(img2)
+    assert np.abs(difference).max() <= tolerance
+
+
+@pytest.mark.parametrize("filename", ["panel1.nrrd", "vpanel1.nrrd"])
+@pytest.mark.parametrize("shrink_factors", [2, [3, 2, 1], [2, 2, 4]])
+def test_read_channel_binned(filename, shrink_factors):
+    filename = os.path.join(data_dir, filename)
+    expected_factors = shrink_factors if isinstance(shrink_factors, list) else [shrink_factors, shrink_factors, 1]
+
+    img = im_read_channel(filename, "JOJO", shrink_factors=shrink_factors)
+    assert_image_equal(sitk.BinShrink(im_read_channel(filename, "JOJO"), expected_factors), img)
+
+    img = im_read_channel(filename, 4, shrink_factors=shrink_factors, output_pixel_type=sitk.sitkFloat32)
+    expected = sitk.BinShrink(sitk.Cast(im_read_channel(filename, 4), sitk.sitkFloat32), expected_factors)
+    assert_image_equal(expected, img)
+
+
+@pytest.mark.parametrize("shrink_factors", [2, [2, 2, 3]])
+def test_read_channel_binned_streaming(tmp_path, monkeypatch, shrink_factors):
+    filename = str(tmp_path / "panel1.mha")
+    full_img = sitk.ReadImage(os.path.join(data_dir, "panel1.nrrd"))
+    sitk.WriteImage(full_img, filename)
+    expected_factors = shrink_factors if isinstance(shrink_factors, list) else [shrink_factors, shrink_factors, 1]
+
+    # read in several slabs, with the last slab thinner
+    monkeypatch.setattr(sitkibex.io, "_binned_read_slab_pixels", 4 * 100 * 100 * expected_factors[2])
+
+    img = im_read_channel(filename, 4, shrink_factors=shrink_factors)
+    assert_image_equal(sitk.BinShrink(im_read_channel(filename, 4), expected_factors), img)
+
+
+def test_read_all_channels_binned():
+    filename = os.path.join(data_dir, "panel1.nrrd")
+
+    @utils.sub_volume_execute(inplace=False)
+    def binner(image):
+        return sitk.BinShrink(image, [2, 2, 1])
+
+    img = im_read_channel(filename, shrink_factors=2)
+    assert img.GetDimension() == 4
+    assert_image_equal(binner(sitk.ReadImage(filename)), img)
+
+
+def test_channel_index(tmp_path, monkeypatch):
+    filename = tmp_path / "panel1.nrrd"
+    filename.write_bytes(open(os.path.join(data_dir, "panel1.nrrd"), "rb").read())
+
+    parsed = []
+    read_channel_index = sitkibex.io._read_channel_index
+    monkeypatch.setattr(sitkibex.io, "_read_channel_index", lambda f: parsed.append(f) or read_channel_index(f))
+
+    index = im_channel_index(filename)
+    assert 1 == len(parsed)
+    assert "JOJO" == index.channel_names[4]
+    assert 4 == index.channel_number("JOJO")
+    assert [100, 100, 19, 6] == index.size
+    assert "NrrdImageIO" == index.image_io
+    with pytest.raises(Exception, match="not in filename marker list"):
+        index.channel_number("missing")
+
+    # the header is parsed once for all the channels
+    im_read_channel(filename, "JOJO", region=([0, 0, 0], [10, 10, 2]))
+    im_read_channel(filename, "B200 PE", shrink_factors=2)
+    im_read_geometry(filename)
+    assert 1 == len(parsed)
+
+    # the sidecar is used by a new process, while the file is not modified
+    sitkibex.io._cached_channel_index.cache_clear()
+    assert index.to_dict() == im_channel_index(filename, sidecar=True).to_dict()
+    assert 2 == len(parsed)
+    assert (tmp_path / "panel1.nrrd.sitkibex.json").exists()
+    sitkibex.io._cached_channel_index.cache_clear()
+    assert index.to_dict() == im_channel_index(filename, sidecar=True).to_dict()
+    assert 2 == len(parsed)
+
+    # a modified file is parsed again
+    os.utime(filename, ns=(0, 0))
+    assert index.to_dict() == im_channel_index(filename, sidecar=True).to_dict()
+    assert 3 == len(parsed)
+
+
+@pytest.mark.parametrize("filename", ["panel1.nrrd", "vpanel1.nrrd"])
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"shrink_factors": 2, "output_pixel_type": sitk.sitkFloat32}, {"region": ([10, 20, 3], [50, 40, 10])}],
+)
+def test_read_channels(filename, kwargs, monkeypatch):
+    filename = os.path.join(data_dir, filename)
+    channels = ["JOJO", 1, "B200 PE"]
+    expected = [im_read_channel(filename, c, **kwargs) for c in channels]
+
+    executions = []
+    execute = sitk.ImageFileReader.Execute
+    monkeypatch.setattr(sitk.ImageFileReader, "Execute", lambda self: executions.append(self) or execute(self))
+
+    images = im_read_channels(filename, channels, **kwargs)
+    assert 1 == len(executions)
+    assert len(channels) == len(images)
+    for e, img in zip(expected, images):
+        assert_image_equal(e, img)
+        assert e.GetDirection() == img.GetDirection()
+
+    img = im_read_channels(filename, channels, output_vector=True, **kwargs)
+    assert len(channels) == img.GetNumberOfComponentsPerPixel()
+    assert_image_equal(expected[2], sitk.VectorIndexSelectionCast(img, 2))
+
+
+@pytest.mark.parametrize("filename", ["panel1.nrrd", "vpanel1.nrrd"])
+@pytest.mark.parametrize("ext", [".nrrd", ".mha", ".mhd", ".nhdr"])
+def test_mapped_image(tmp_path, filename, ext):
+    original = os.path.join(data_dir, filename)
+    # the test data is gzip compressed, and is written uncompressed
+    uncompressed = str(tmp_path / (os.path.splitext(filename)[0] + ext))
+    img = sitk.ReadImage(original)
+    for key in img.GetMetaDataKeys():
+        if key != "imaris_channels_information":
+            img.EraseMetaData(key)
+    sitk.WriteImage(img, uncompressed)
+
+    with pytest.raises(ValueError):
+        MappedImage(original)
+
+    mapped = MappedImage(uncompressed)
+    expected = im_read_channel(original, "JOJO")
+    channel = mapped.channel("JOJO")
+    assert np.shares_memory(channel, mapped.array)
+    assert np.array_equal(sitk.GetArrayViewFromImage(expected), channel)
+    assert np.array_equal(sitk.GetArrayViewFromImage(expected)[::2, ::4, ::4], mapped.channel(4, step=[4, 4, 2]))
+
+    for kwargs in [
+        {},
+        {"region": ([10, 20, 3], [50, 40, 10])},
+        {"region": ([10, 20, 3], [50, 40, 10]), "shrink_factors": [2, 2, 3], "output_pixel_type": sitk.sitkFloat32},
+    ]:
+        img = im_read_channel(uncompressed, "JOJO", **kwargs)
+        assert_image_equal(im_read_channel(original, "JOJO", **kwargs), img)
+        assert im_read_channel(original, "JOJO", **kwargs).GetDirection() == img.GetDirection()
+
+    for e, img in zip(im_read_channels(original, [1, "JOJO"]), im_read_channels(uncompressed, [1, "JOJO"])):
+        assert_image_equal(e, img)
+
+
+@pytest.mark.parametrize(
+    "sizes, kinds", [("2 5 4 3", "vector domain domain domain"), ("5 4 3 2", "domain domain domain vector")]
+)
+def test_mapped_image_component_axis(tmp_path, sizes, kinds):
+    filename = str(tmp_path / "vector.nrrd")
+    with open(filename, "wb") as fp:
+        fp.write("NRRD0004\ntype: uint16\ndimension: 4\nsizes: {}\nkinds: {}\n".format(sizes, kinds).encode())
+        fp.write(b"endian: little\nencoding: raw\n\n")
+        fp.write(np.arange(120, dtype="<u2").tobytes())
+
+    expected = sitk.ReadImage(filename)
+    assert 2 == expected.GetNumberOfComponentsPerPixel()
+    for channel in [0, 1]:
+        assert_image_equal(sitk.VectorIndexSelectionCast(expected, channel), im_read_channel(filename, channel))
+    if kinds.startswith("vector"):
+        assert np.array_equal(sitk.GetArrayViewFromImage(expected), MappedImage(filename).array)
+    else:
+        # SimpleITK reorders the axes when the components are not the first axis, which is not mapped
+        with pytest.raises(ValueError):
+            MappedImage(filename)
+
+    # MetaImage files have the components interleaved
+    filename = str(tmp_path / "vector.mha")
+    sitk.WriteImage(expected, filename)
+    expected = sitk.ReadImage(filename)
+    assert np.array_equal(sitk.GetArrayViewFromImage(expected), MappedImage(filename).array)
+    assert_image_equal(sitk.VectorIndexSelectionCast(expected, 1), im_read_channel(filename, 1))
+
+
+@pytest.mark.parametrize("filename", ["panel1.nrrd", "vpanel1.nrrd"])
+def test_read_channel_region(filename):
+    filename = os.path.join(data_dir, filename)
+    full_img = im_read_channel(filename, "JOJO")
+
+    img = im_read_channel(filename, "JOJO", region=([10, 20, 3], [50, 40, 10]))
+    assert_image_equal(full_img[10:60, 20:60, 3:13], img)
+
+    img = im_read_channel(filename, "JOJO", region=([10, 20, 3], [50, 40, 10]), shrink_factors=[2, 2, 2])
+    assert_image_equal(sitk.BinShrink(full_img[10:60, 20:60, 3:13], [2, 2, 2]), img)
+
+    with pytest.raises(ValueError):
+        im_read_channel(filename, "JOJO", region=([90, 0, 0], [20, 10, 10]))
+
+
+@pytest.mark.parametrize("filename", ["panel1.nrrd", "vpanel1.nrrd"])
+@pytest.mark.parametrize("shrink_factors", [None, [2, 2, 1], [3, 2, 2]])
+def test_read_geometry(filename, shrink_factors):
+    filename = os.path.join(data_dir, filename)
+    img = im_read_channel(filename, "JOJO", shrink_factors=shrink_factors)
+
+    geometry = im_read_geometry(filename, shrink_factors=shrink_factors)
+    assert img.GetSize() == geometry.GetSize()
+    assert img.GetSpacing() == pytest.approx(geometry.GetSpacing())
+    assert img.GetOrigin() == pytest.approx(geometry.GetOrigin())
+    assert img.GetDirection() == pytest.approx(geometry.GetDirection())
+    assert img.TransformIndexToPhysicalPoint([3, 4, 5]) == pytest.approx(
+        geometry.TransformIndexToPhysicalPoint([3, 4, 5])
+    )
+
+
+@pytest.mark.parametrize("shrink_factors", [None, [2, 2, 1]])
+def test_region_reader(tmp_path, shrink_factors):
+    filename = str(tmp_path / "panel1.mha")
+    sitk.WriteImage(sitk.ReadImage(os.path.join(data_dir, "panel1.nrrd")), filename)
+    full_img = im_read_channel(filename, 4, shrink_factors=shrink_factors)
+
+    reader = ImageRegionReader(filename, 4, shrink_factors=shrink_factors)
+    assert reader.streaming
+    assert 3 == reader.dimension
+    assert full_img.GetPixelID() == reader.pixel_id
+    assert full_img.GetSize() == reader.geometry.GetSize()
+    assert_image_equal(full_img[5:25, 10:30, 2:8], reader.read([5, 10, 2], [20, 20, 6]))
+
+    assert not ImageRegionReader(os.path.join(data_dir, "panel1.nrrd"), 4).streaming
+
+
+def _write_ome_zarr(path, arr, scale_xyz, number_of_levels=2):
+    """Write a TCZYX array into an OME-Zarr pyramid down-sampled in X and Y by BinShrink."""
+    zarr = pytest.importorskip("zarr")
+
+    group = zarr.open_group(str(path), mode="w")
+    datasets = []
+    for level in range(number_of_levels):
+        factor = 2**level
+        if level:
+            images = [
+                sitk.BinShrink(sitk.GetImageFromArray(arr[0, c]), [factor, factor, 1]) for c in range(arr.shape[1])
+            ]
+            level_arr = np.stack([sitk.GetArrayFromImage(img) for img in images])[np.newaxis]
+        else:
+            level_arr = arr
+        group.create_dataset(str(level), data=level_arr, chunks=(1, 1, 4, 32, 32))
+        scale = [1.0, 1.0, scale_xyz[2], scale_xyz[1] * factor, scale_xyz[0] * factor]
+        translation = [0.0, 0.0, 0.0, scale_xyz[1] * (factor - 1) / 2, scale_xyz[0] * (factor - 1) / 2]
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": scale},
+                    {"type": "translation", "translation": translation},
+                ],
+            }
+        )
+    axes = [{"name": n} for n in "tczyx"]
+    group.attrs["multiscales"] = [{"version": "0.4", "axes": axes, "datasets": datasets}]
+    group.attrs["omero"] = {"channels": [{"label": "c{}".format(c)} for c in range(arr.shape[1])]}
+
+
+@pytest.fixture
+def ome_zarr_path(tmp_path):
+    arr = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(data_dir, "panel1.nrrd")))[np.newaxis]
+    path = tmp_path / "panel1.zarr"
+    _write_ome_zarr(path, arr, [0.5, 0.5, 2.0])
+    return path
+
+
+@pytest.mark.parametrize("shrink_factors", [None, 2, [4, 4, 1], [3, 3, 1], [2, 2, 2]])
+def test_read_zarr_level(ome_zarr_path, shrink_factors, caplog):
+    full_img = im_read_channel(ome_zarr_path, "c4")
+    assert full_img.GetSpacing() == (0.5, 0.5, 2.0)
+
+    with caplog.at_level(logging.INFO):
+        img = im_read_channel(ome_zarr_path, "c4", shrink_factors=shrink_factors)
+    if shrink_factors in (2, [4, 4, 1], [2, 2, 2]):
+        assert "Reading multiscale level 1" in caplog.text
+    else:
+        assert "Reading multiscale level" not in caplog.text
+    if shrink_factors is None:
+        expected = full_img
+    else:
+        if isinstance(shrink_factors, int):
+            shrink_factors = [shrink_factors, shrink_factors, 1]
+        expected = sitk.BinShrink(full_img, shrink_factors)
+    # binning the down-sampled level accumulates rounding of the integer pixels
+    assert_image_equal(expected, img, tolerance=1)
+
+    img = im_read_channel(ome_zarr_path, "c4", region=([8, 16, 2], [64, 48, 12]), shrink_factors=shrink_factors)
+    if shrink_factors is None:
+        expected = full_img[8:72, 16:64, 2:14]
+    else:
+        expected = sitk.BinShrink(full_img[8:72, 16:64, 2:14], shrink_factors)
+    assert_image_equal(expected, img, tolerance=1)
+
+
+@pytest.mark.parametrize("dtype", ["<u2", ">u2"])
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"shrink_factors": [3, 3, 2]}, {"shrink_factors": [5, 2, 3], "region": ([8, 16, 2], [64, 48, 12])}],
+)
+def test_read_zarr_blocks(tmp_path, monkeypatch, dtype, kwargs):
+    full_img = sitk.ReadImage(os.path.join(data_dir, "panel1.nrrd"))
+    arr = sitk.GetArrayFromImage(full_img)[np.newaxis].astype(dtype)
+    path = tmp_path / "panel1.zarr"
+    _write_ome_zarr(path, arr, [1.0, 1.0, 1.0], number_of_levels=1)
+
+    shrink_factors = kwargs.get("shrink_factors", [1, 1, 1])
+    index, size = kwargs.get("region", ([0, 0, 0], [100, 100, 19]))
+
+    @utils.sub_volume_execute(inplace=False)
+    def expected_image(image):
+        image = sitk.Cast(image, sitk.sitkUInt16)
+        image = sitk.RegionOfInterest(image, size, index)
+        image.SetSpacing([1.0, 1.0, 1.0])
+        image.SetOrigin([float(i) for i in index])
+        return sitk.BinShrink(image, shrink_factors)
+
+    expected = expected_image(full_img)
+    # each block is read by a thread
+    monkeypatch.setattr(sitkibex.globals, "zarr_read_workers", 3)
+    for c in [0, 4]:
+        img = im_read_channel(path, c, **kwargs)
+        assert_image_equal(expected[..., c], img)
+
+    img = im_read_channel(path, **kwargs)
+    assert 6 == img.GetNumberOfComponentsPerPixel()
+    # BinShrink truncates the bins of a vector image, and rounds the bins of a scalar image
+    assert_image_equal(expected[..., 4], sitk.VectorIndexSelectionCast(img, 4), tolerance=1)
+
+
+@pytest.mark.parametrize("read_ahead, dimension_separator", [(0, "."), (2, "/"), (64, ".")])
+def test_read_zarr_read_ahead(tmp_path, monkeypatch, caplog, read_ahead, dimension_separator):
+    zarr = pytest.importorskip("zarr")
+
+    arr = np.zeros((1, 2, 19, 100, 100), dtype=np.uint16)
+    arr[0, 1, 2:14, 30:90, 10:50] = 7
+    path = tmp_path / "sparse.zarr"
+    _write_ome_zarr(path, arr, [1.0, 1.0, 1.0], number_of_levels=1)
+    # the chunks of zeros are missing, and have the fill value
+    group = zarr.open_group(str(path), mode="a")
+    dataset = group.create_dataset(
+        "0",
+        shape=arr.shape,
+        chunks=(1, 1, 4, 32, 32),
+        dtype=arr.dtype,
+        write_empty_chunks=False,
+        overwrite=True,
+        dimension_separator=dimension_separator,
+    )
+    dataset[:] = arr
+
+    monkeypatch.setattr(sitkibex.globals, "zarr_read_workers", 2)
+    monkeypatch.setattr(sitkibex.globals, "zarr_read_ahead", read_ahead)
+    with caplog.at_level(logging.INFO):
+        img = im_read_channel(path, 1, region=([0, 16, 0], [100, 80, 19]), shrink_factors=[1, 2, 1])
+    assert np.array_equal(arr[0, 1, :, 16:96].reshape(19, 40, 2, 100).mean(axis=2), sitk.GetArrayViewFromImage(img))
+    # 4 x 3 x 2 chunks of the region are not empty, and each chunk is read once
+    assert "Read 24 chunks" in caplog.text
+    assert "chunks/s" in caplog.text
+
+
+def test_write_zarr(tmp_path):
+    zarr = pytest.importorskip("zarr")
+
+    img = sitk.ReadImage(os.path.join(data_dir, "panel1.nrrd"))
+    img.SetSpacing([0.5, 0.5, 2.0, 1.0])
+    channel_names = ["c{}".format(c) for c in range(img.GetSize()[3])]
+    filename = str(tmp_path / "out.zarr")
+
+    im_write_zarr(img, filename, channel_names=channel_names)
+
+    group = zarr.open_group(filename, mode="r")
+    assert [c["label"] for c in group.attrs["omero"]["channels"]] == channel_names
+    assert len(group.attrs["multiscales"][0]["datasets"]) == 1
+
+    assert_image_equal(img[:, :, :, 3], im_read_channel(filename, "c3"))
+    assert im_read_channel(filename).GetNumberOfComponentsPerPixel() == len(channel_names)
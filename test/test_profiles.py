@@ -0,0 +1,100 @@
+#
+#  Copyright Bradley Lowekamp
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import SimpleITK as sitk
+import pytest
+
+from sitkibex import registration
+from sitkibex.profiles import RegistrationProfile, get_profile, profiles, tune_profile
+
+
+def test_profile_save_load(tmp_path, monkeypatch):
+    profile = RegistrationProfile(samples_per_parameter=1000, shrink_factors_3d=[8, 4])
+    assert profile != RegistrationProfile()
+    assert [8, 4] == profile.shrink_factors_3d
+    assert [16, 8, 4] == profile.shrink_factors_rigid_2d
+
+    profile.save(tmp_path / "coarse.json")
+    assert profile == RegistrationProfile.load(tmp_path / "coarse.json")
+    assert profile == get_profile(str(tmp_path / "coarse.json"))
+
+    monkeypatch.setenv("SITKIBEX_PROFILE_DIR", str(tmp_path))
+    assert profile == get_profile("coarse")
+    assert profile is get_profile(profile)
+    assert RegistrationProfile() == get_profile(None)
+
+    with pytest.raises(ValueError):
+        get_profile("missing")
+
+
+def test_profile_presets():
+    assert {"fast", "balanced", "accurate"} == set(profiles)
+    assert RegistrationProfile() == get_profile("balanced")
+    assert profiles["fast"] == get_profile("fast")
+    # the presets are not modified by modifying the resolved profile
+    get_profile("fast").samples_per_parameter = 1
+    assert 1 != profiles["fast"].samples_per_parameter
+
+    fast = profiles["fast"]
+    balanced = profiles["balanced"]
+    assert len(fast.shrink_factors_3d) == len(balanced.shrink_factors_3d)
+    assert min(fast.shrink_factors_3d) > min(balanced.shrink_factors_3d)
+    assert fast.samples_per_parameter < balanced.samples_per_parameter
+
+    # the optimizer arguments not given have the default values
+    profile = RegistrationProfile.from_dict({"optimizer_3d": {"numberOfIterations": 10}})
+    assert 10 == profile.optimizer_3d["numberOfIterations"]
+    assert balanced.optimizer_3d["convergenceWindowSize"] == profile.optimizer_3d["convergenceWindowSize"]
+
+
+def _blobs(centers, size):
+    img = sitk.Image(size, sitk.sitkFloat32)
+    for center in centers:
+        img += sitk.GaussianSource(sitk.sitkFloat32, size, [8, 8, 2], center, 1000)
+    return img
+
+
+def test_tune_profile():
+    size = [64, 60, 10]
+    fixed = _blobs([[20, 25, 5], [45, 35, 4], [30, 50, 6]], size)
+    moving = _blobs([[22, 24, 5], [47, 34, 4], [32, 49, 6]], size)
+
+    profile, results = tune_profile(
+        fixed, moving, samples_per_parameter_grid=[500, 2000], shrink_factors_3d_grid=[(2,), (2, 1)]
+    )
+
+    assert 4 == len(results)
+    assert all(r["duration"] > 0 for r in results)
+    accepted = [r for r in results if r["disagreement"] <= 0.5]
+    assert accepted
+    fastest = min(accepted, key=lambda r: r["duration"])
+    assert fastest["samples_per_parameter"] == profile.samples_per_parameter
+    assert fastest["shrink_factors_3d"] == profile.shrink_factors_3d
+
+    tx = registration(fixed, moving, profile=profile)
+    assert all(abs(a - b) < 0.5 for a, b in zip([22, 24, 5], tx.TransformPoint([20, 25, 5])))
+
+
+def test_registration_profile():
+    size = [64, 60, 10]
+    fixed = _blobs([[20, 25, 5], [45, 35, 4], [30, 50, 6]], size)
+    moving = _blobs([[22, 24, 5], [47, 34, 4], [32, 49, 6]], size)
+
+    for profile in profiles:
+        tx, telemetry = registration(fixed, moving, profile=profile, do_affine2d=True, return_telemetry=True)
+        assert all(abs(a - b) < 0.5 for a, b in zip([22, 24, 5], tx.TransformPoint([20, 25, 5])))
+        phases = {record["phase"]: record for record in telemetry.phases}
+        assert profiles[profile].shrink_factors_3d == phases["affine_3d"]["shrink_factors_per_level"]
+        assert len(profiles[profile].shrink_factors_affine_2d) == len(phases["affine_2d"]["shrink_factors_per_level"])
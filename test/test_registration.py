@@ -16,9 +16,12 @@
 from unittest import TestCase
 
 import SimpleITK as sitk
-from sitkibex import registration
+from sitkibex import registration, registration_batch, registration_pipeline, registration_tiled, PreparedFixedImage
+from sitkibex.registration_utilities import RegistrationTelemetry
+import numpy as np
 import logging
 import math
+from functools import partial
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -129,3 +132,279 @@ class TestReg(TestCase):
             auto_mask=True,
             samples_per_parameter=500,
         )
+
+    def test_reg_adaptive(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts = [[240, 288, 8], [48, 96, 7]]
+        moving = self.generate_double_blobs(point1=moving_pts[0], point2=moving_pts[1], size=[512, 511, 16])
+
+        tx, telemetry = registration(
+            fixed, moving, do_affine3d=True, adaptive=True, samples_per_parameter=100, return_telemetry=True
+        )
+
+        self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]), tolerance=0.5)
+        self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]), tolerance=0.5)
+
+        record = telemetry.phases[-1]
+        self.assertEqual("affine_3d", record["phase"])
+        self.assertTrue(record["adaptive"])
+        self.assertEqual([0, 1, 2], [level["level"] for level in record["levels"]])
+        self.assertEqual([False, False, True], [level["skipped"] for level in record["levels"]])
+        self.assertLessEqual(record["levels"][1]["iterations"], record["levels"][1]["iteration_budget"])
+        self.assertIn('level="2"} 1', telemetry.to_openmetrics())
+
+    def test_reg_fft_candidates(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts = [[240, 288, 8], [48, 96, 7]]
+        moving = self.generate_double_blobs(point1=moving_pts[0], point2=moving_pts[1], size=[512, 511, 16])
+
+        tx, telemetry = registration(
+            fixed,
+            moving,
+            do_affine3d=True,
+            number_of_fft_candidates=3,
+            samples_per_parameter=100,
+            return_telemetry=True,
+        )
+
+        self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]), tolerance=0.5)
+        self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]), tolerance=0.5)
+
+        phases = {record["phase"]: record for record in telemetry.phases}
+        record = phases["fft_candidate_selection"]
+        self.assertGreater(len(record["candidates"]), 1)
+        self.assertLessEqual(len(record["candidates"]), 3)
+        metric_values = [candidate["metric_value"] for candidate in record["candidates"]]
+        self.assertEqual(min(metric_values), metric_values[record["selected"]])
+
+    def test_select_fft_candidate(self):
+        from sitkibex.registration import _select_fft_candidate
+
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts = [[240, 288, 8], [48, 96, 7]]
+        moving = self.generate_double_blobs(point1=moving_pts[0], point2=moving_pts[1], size=[512, 511, 16])
+
+        # The highest correlation peak is wrong, and the second is a bin of the correlation off the true translation
+        candidates = [([-140.0, -120.0, 0.0], 0.9), ([-13.0, 29.0, 0.0], 0.8)]
+        translation = _select_fft_candidate(
+            PreparedFixedImage(fixed), moving, None, candidates, 1.0, 5000, telemetry=None
+        )
+
+        self.assertEqual(3, len(translation))
+        # The coarse rigid registration refines the candidate toward the true translation
+        self.check_near([-16.0, 32.0, 0.0], translation, tolerance=1.5)
+        self.assertLess(math.dist([-16.0, 32.0], translation[:2]), math.dist([-16.0, 32.0], candidates[1][0][:2]))
+
+    def test_reg_log_polar(self):
+        fixed_pts = [[256, 256, 8], [64, 100, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        # the moving image is rotated about z by more than the capture range of the 2D rigid registration
+        center = fixed.TransformContinuousIndexToPhysicalPoint([256, 255, 8])
+        tx_moving = sitk.Euler3DTransform(center, 0, 0, 0.8, [10, -20, 0])
+        moving = sitk.Resample(fixed, tx_moving)
+        moving_pts = [tx_moving.GetInverse().TransformPoint(pt) for pt in fixed_pts]
+
+        tx, telemetry = registration(
+            fixed,
+            moving,
+            do_affine2d=True,
+            do_affine3d=False,
+            log_polar_initialization=True,
+            return_telemetry=True,
+        )
+
+        self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]), tolerance=1.0)
+        self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]), tolerance=1.0)
+
+        # the two round blobs constrain the rotation weakly, the initialization needs only be within the capture range
+        phases = {record["phase"]: record for record in telemetry.phases}
+        angle = phases["log_polar_initialization"]["angle"]
+        self.assertAlmostEqual(-0.8, (angle + math.pi) % (2 * math.pi) - math.pi, delta=0.2)
+
+    def test_registration_tiled(self):
+        size = [384, 320, 8]
+        fixed = sitk.Image(size, sitk.sitkFloat32)
+        rng = np.random.default_rng(0)
+        for _ in range(60):
+            center = [rng.uniform(0, size[0]), rng.uniform(0, size[1]), rng.uniform(2, 6)]
+            fixed += sitk.GaussianSource(sitk.sitkFloat32, size, [rng.uniform(3, 8)] * 2 + [2], center, 100)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+
+        # the moving image is warped by a smooth displacement, after the translation found by the global registration
+        y, x = np.indices([size[1], size[0]])
+        displacement = np.zeros(size[::-1] + [3])
+        displacement[..., 0] = 2.0 * np.sin(x / size[0] * np.pi) * np.cos(y / size[1] * np.pi)
+        displacement[..., 1] = 1.5 * np.cos(x / size[0] * 2 * np.pi)
+        displacement_image = sitk.GetImageFromArray(displacement, isVector=True)
+        displacement_image.CopyInformation(fixed)
+        warp = sitk.CompositeTransform(
+            [sitk.DisplacementFieldTransform(displacement_image), sitk.TranslationTransform(3, [-3.0, 2.0, 0.0])]
+        )
+        moving = sitk.Resample(fixed, warp)
+
+        telemetry = RegistrationTelemetry()
+        tx = registration_tiled(
+            fixed,
+            moving,
+            sitk.TranslationTransform(3, [3.0, -2.0, 0.0]),
+            tile_size=96,
+            number_of_control_points=5,
+            telemetry=telemetry,
+        )
+
+        pts = [
+            fixed.TransformContinuousIndexToPhysicalPoint(idx) for idx in [[80, 80, 4], [300, 100, 2], [200, 250, 6]]
+        ]
+        for pt in pts:
+            self.check_near(pt, warp.TransformPoint(tx.TransformPoint(pt)), tolerance=0.5)
+        self.assertEqual(25, telemetry.phases[0]["number_of_tiles"])
+        self.assertLess(0, telemetry.phases[0]["number_of_fitted_tiles"])
+
+    def test_tile_landmarks(self):
+        from sitkibex.registration import _tile_landmarks
+
+        fixed = sitk.Image([64, 64, 5], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 4.0])
+        results = [([1.0, -2.0, 0.0], 0.9), ([12.0, 0.0, 0.0], 0.9), ([0.5, 0.5, 0.0], 0.1), None]
+        fixed_landmarks, moving_landmarks, weights = _tile_landmarks(
+            fixed, [[0, 0], [32, 0], [0, 32], [32, 32]], [32, 32], results, max_displacement=16, min_correlation=0.5
+        )
+
+        # the offset of 24 pixels in X is rejected, within 16 times the Z spacing but not the XY spacing
+        self.assertEqual([0.9] * 3, weights)
+        self.assertEqual([1.0, -2.0, 0.0] * 3, np.subtract(moving_landmarks, fixed_landmarks).tolist())
+
+    def test_registration_telemetry(self):
+        fixed = self.generate_double_blobs(point1=[256, 256, 8], point2=[64, 64, 7], size=[512, 511, 16])
+        moving = self.generate_double_blobs(point1=[240, 288, 8], point2=[48, 96, 7], size=[512, 511, 16])
+
+        tx, telemetry = registration(
+            fixed, moving, do_affine3d=True, do_affine2d=True, samples_per_parameter=100, return_telemetry=True
+        )
+        self.assertIsInstance(tx, sitk.Transform)
+
+        phases = {record["phase"]: record for record in telemetry.phases}
+        self.assertEqual(["preprocessing", "fft_initialization", "rigid_2d", "affine_2d", "affine_3d"], list(phases))
+        for record in telemetry.phases:
+            self.assertGreaterEqual(record["duration"], 0.0)
+
+        record = phases["affine_3d"]
+        self.assertEqual(3, len(record["levels"]))
+        self.assertEqual(3, len(record["sampling_percentage_per_level"]))
+        self.assertEqual(sum(level["iterations"] for level in record["levels"]), record["iterations"])
+        for level in record["levels"]:
+            self.assertEqual(level["iterations"], len(level["metric_values"]))
+            self.assertEqual(level["iterations"], len(level["number_of_valid_points"]))
+        self.assertEqual(record["levels"][-1]["metric_values"][-1], record["final_metric_value"])
+
+        self.assertEqual(len(telemetry.phases), len(telemetry.to_json_lines().splitlines()))
+        self.assertTrue(telemetry.to_openmetrics().endswith("# EOF\n"))
+
+    def test_registration_batch(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts_list = [[[240, 288, 8], [48, 96, 7]], [[264, 248, 8], [72, 56, 7]]]
+        moving_list = [
+            self.generate_double_blobs(point1=pts[0], point2=pts[1], size=[512, 511, 16]) for pts in moving_pts_list
+        ]
+
+        tx_list = registration_batch(
+            fixed, moving_list, max_workers=2, number_of_threads=1, do_affine3d=False, do_fft_initialization=True
+        )
+
+        self.assertEqual(len(moving_list), len(tx_list))
+        for tx, moving_pts in zip(tx_list, moving_pts_list):
+            self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]))
+            self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]))
+
+        self.assertEqual([], registration_batch(fixed, []))
+
+    def test_registration_pipeline(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts_list = [[[240, 288, 8], [48, 96, 7]], [[264, 248, 8], [72, 56, 7]], [[256, 256, 8], [64, 64, 7]]]
+        moving_list = [
+            self.generate_double_blobs(point1=pts[0], point2=pts[1], size=[512, 511, 16]) for pts in moving_pts_list
+        ]
+
+        written = {}
+
+        def writer(index, tx):
+            written[index] = tx
+
+        tx_list = registration_pipeline(
+            fixed,
+            [partial(sitk.Image, moving) for moving in moving_list],
+            writer=writer,
+            do_affine3d=False,
+            do_fft_initialization=True,
+        )
+
+        self.assertEqual(len(moving_list), len(tx_list))
+        self.assertEqual(list(range(len(moving_list))), sorted(written))
+        for i, (tx, moving_pts) in enumerate(zip(tx_list, moving_pts_list)):
+            self.assertIs(tx, written[i])
+            self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]))
+            self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]))
+
+        self.assertEqual([], registration_pipeline(fixed, []))
+
+    def test_prepared_fixed_image(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+
+        prepared = PreparedFixedImage(fixed, auto_mask=True)
+        # the caller's image is not modified
+        self.assertEqual((0.5, 0.5, 2.0), fixed.GetSpacing())
+        self.assertEqual(prepared.image.GetSpacing(), prepared.mask.GetSpacing())
+
+        for moving_pts in [[[240, 288, 8], [48, 96, 7]], [[264, 248, 8], [72, 56, 7]]]:
+            moving = self.generate_double_blobs(point1=moving_pts[0], point2=moving_pts[1], size=[512, 511, 16])
+            moving.SetSpacing(fixed.GetSpacing())
+
+            tx = registration(prepared, moving, do_affine3d=False, do_affine2d=True, auto_mask=True)
+            expected_tx = registration(fixed, moving, do_affine3d=False, do_affine2d=True, auto_mask=True)
+
+            for pt in fixed_pts:
+                pt = fixed.TransformIndexToPhysicalPoint(pt)
+                self.check_near(expected_tx.TransformPoint(pt), tx.TransformPoint(pt))
+
+        with self.assertRaises(ValueError):
+            registration(prepared, moving, auto_mask=False)
+
+        with self.assertRaises(ValueError):
+            registration(prepared, moving, auto_mask=True, low_memory=True)
+
+    def test_reg_low_memory(self):
+        fixed_pts = [[256, 256, 8], [64, 64, 7]]
+        fixed = self.generate_double_blobs(point1=fixed_pts[0], point2=fixed_pts[1], size=[512, 511, 16])
+
+        moving_pts = [[240, 288, 8], [48, 96, 7]]
+        moving = self.generate_double_blobs(point1=moving_pts[0], point2=moving_pts[1], size=[512, 511, 16])
+
+        prepared = PreparedFixedImage(fixed, auto_mask=True, low_memory=True)
+        self.assertEqual((128, 127, 16), prepared.mask.GetSize())
+
+        tx, telemetry = registration(
+            prepared,
+            moving,
+            auto_mask=True,
+            low_memory=True,
+            samples_per_parameter=500,
+            return_telemetry=True,
+        )
+
+        self.check_near(moving_pts[0], tx.TransformPoint(fixed_pts[0]), tolerance=0.5)
+        self.check_near(moving_pts[1], tx.TransformPoint(fixed_pts[1]), tolerance=0.5)
+        for record in telemetry.phases:
+            self.assertIn("peak_allocation_bytes", record)
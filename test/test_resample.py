@@ -15,8 +15,12 @@
 #
 from unittest import TestCase
 from sitkibex import resample
+from sitkibex.resample import collapse_transform, resample_tiled
 import SimpleITK as sitk
 import logging
+import math
+import os.path
+import tempfile
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -54,3 +58,207 @@ class TestResample(TestCase):
         out = resample(image1, image2, tx, combine=True, projection=True)
         self.assertEqual(0, out[32, 16][0])
         self.assertEqual(int(254.0 / 11.0), out[32, 16][1])
+
+    def test_resample_tiled(self):
+        fixed = sitk.Image([70, 50, 11], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+        fixed.SetOrigin([1, 2, 3])
+        fixed.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+
+        moving = sitk.GaussianSource(sitk.sitkUInt16, [64, 64, 12], [10, 10, 3], [32, 32, 6], 255)
+        moving.SetOrigin([5, -30, -1])
+        moving.SetSpacing([0.6, 0.4, 2.1])
+
+        tx = sitk.AffineTransform(3)
+        tx.SetTranslation([5, 2, -1])
+        tx.Rotate(0, 1, 0.2)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filename = os.path.join(tmp_dir, "out.mha")
+            for img in [moving, sitk.Compose([moving, moving // 2])]:
+                for invert in [False, True]:
+                    expected = resample(fixed, img, tx, invert=invert)
+                    resample_tiled(
+                        fixed, img, tx, output_filename=output_filename, invert=invert, block_size=[16, 16, 4]
+                    )
+                    out = sitk.ReadImage(output_filename)
+
+                    self.assertEqual(expected.GetSize(), out.GetSize())
+                    self.assertEqual(expected.GetPixelID(), out.GetPixelID())
+                    for a, b in zip(
+                        expected.GetOrigin() + expected.GetDirection(), out.GetOrigin() + out.GetDirection()
+                    ):
+                        self.assertAlmostEqual(a, b)
+                    self.assertTrue((sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)).all())
+
+    def test_resample_tiled_from_file(self):
+        from sitkibex.io import ImageGeometry, ImageRegionReader
+
+        fixed = sitk.Image([70, 50, 11], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+        fixed.SetOrigin([1, 2, 3])
+        fixed.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+        fixed_geometry = ImageGeometry(fixed.GetSize(), fixed.GetSpacing(), fixed.GetOrigin(), fixed.GetDirection())
+
+        moving = sitk.GaussianSource(sitk.sitkUInt16, [64, 64, 12], [10, 10, 3], [32, 32, 6], 255)
+        moving.SetOrigin([5, -30, -1])
+        moving.SetSpacing([0.6, 0.4, 2.1])
+
+        tx = sitk.AffineTransform(3)
+        tx.SetTranslation([5, 2, -1])
+        tx.Rotate(0, 1, 0.2)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            moving_filename = os.path.join(tmp_dir, "moving.mha")
+            sitk.WriteImage(moving, moving_filename)
+            output_filename = os.path.join(tmp_dir, "out.mha")
+
+            expected = resample(fixed, moving, tx)
+            resample_tiled(
+                fixed_geometry,
+                ImageRegionReader(moving_filename),
+                tx,
+                output_filename=output_filename,
+                block_size=[16, 16, 4],
+            )
+            out = sitk.ReadImage(output_filename)
+
+            self.assertEqual(expected.GetSize(), out.GetSize())
+            self.assertEqual(expected.GetPixelID(), out.GetPixelID())
+            self.assertTrue((sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)).all())
+
+    def test_resample_channels(self):
+        """Test a 4D moving image is resampled as the channels resampled independently"""
+
+        fixed = sitk.Image([40, 30, 9], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+        fixed.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+
+        channels = [
+            sitk.GaussianSource(sitk.sitkUInt16, [32, 32, 10], [4 + c, 6, 2], [16, 16 - c, 5], 1000 * (c + 1))
+            for c in range(3)
+        ]
+        moving = sitk.JoinSeries(channels, 0.0, 2.5)
+
+        tx = sitk.AffineTransform(3)
+        tx.SetTranslation([3, 2, -1])
+        tx.Rotate(0, 1, 0.1)
+
+        for projection in [False, True]:
+            out = resample(fixed, moving, tx, projection=projection)
+            self.assertEqual(moving.GetDimension() - projection, out.GetDimension())
+            self.assertEqual(moving.GetPixelID(), out.GetPixelID())
+            self.assertEqual(2.5, out.GetSpacing()[-1])
+            for c, channel in enumerate(channels):
+                expected = resample(fixed, channel, tx, projection=projection)
+                self.assertTrue(
+                    (sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)[c]).all(),
+                    "channel {} projection {}".format(c, projection),
+                )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filename = os.path.join(tmp_dir, "out.mha")
+            resample_tiled(fixed, moving, tx, output_filename=output_filename, block_size=[16, 16, 4])
+            out = sitk.ReadImage(output_filename)
+            self.assertEqual(len(channels), out.GetNumberOfComponentsPerPixel())
+            for c, channel in enumerate(channels):
+                expected = resample(fixed, channel, tx)
+                self.assertTrue((sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)[..., c]).all())
+
+    def test_resample_channels_nonlinear(self):
+        """Test the channels of a 4D moving image resampled together with a non-linear transform"""
+
+        fixed = sitk.Image([40, 30, 9], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+
+        channels = [
+            sitk.GaussianSource(sitk.sitkUInt16, [32, 32, 10], [4 + c, 6, 2], [16, 16 - c, 5], 1000 * (c + 1))
+            for c in range(3)
+        ]
+        moving = sitk.JoinSeries(channels, 0.0, 2.5)
+
+        tx = sitk.BSplineTransformInitializer(fixed, [2, 2, 2])
+        tx.SetParameters([0.3 * ((i % 7) - 3) for i in range(tx.GetNumberOfParameters())])
+
+        out = resample(fixed, moving, tx)
+        self.assertEqual(moving.GetPixelID(), out.GetPixelID())
+        for c, channel in enumerate(channels):
+            expected = resample(fixed, channel, tx)
+            self.assertTrue((sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)[c]).all())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filename = os.path.join(tmp_dir, "out.mha")
+            resample_tiled(fixed, moving, tx, output_filename=output_filename, block_size=[16, 16, 4])
+            out = sitk.ReadImage(output_filename)
+            for c, channel in enumerate(channels):
+                expected = resample(fixed, channel, tx)
+                self.assertTrue((sitk.GetArrayViewFromImage(expected) == sitk.GetArrayViewFromImage(out)[..., c]).all())
+
+    def test_collapse_transform(self):
+        """Test collapsing linear and non-linear composite transforms"""
+
+        fixed = sitk.Image([40, 30, 9], sitk.sitkFloat32)
+        fixed.SetSpacing([0.5, 0.5, 2.0])
+        fixed.SetOrigin([1.0, -2.0, 0.5])
+        pts = [fixed.TransformContinuousIndexToPhysicalPoint(idx) for idx in [[0, 0, 0], [10.5, 20, 3], [39, 29, 8]]]
+
+        scale = sitk.ScaleTransform(3, [0.7] * 3)
+        affine = sitk.AffineTransform([1.0, 0.05, 0.0, -0.05, 0.99, 0.0, 0.0, 0.01, 1.02], [3.0, -2.0, 1.0], [5, 5, 2])
+        tx = sitk.CompositeTransform([sitk.Transform(scale), affine, scale.GetInverse()])
+
+        collapsed = collapse_transform(tx)
+        self.assertEqual("AffineTransform", collapsed.GetName())
+        for pt in pts:
+            self.assertAlmostEqual(0.0, math.dist(tx.TransformPoint(pt), collapsed.TransformPoint(pt)), places=10)
+
+        bspline = sitk.BSplineTransformInitializer(fixed, [2, 2, 2])
+        bspline.SetParameters([0.3 * ((i % 7) - 3) for i in range(bspline.GetNumberOfParameters())])
+        tx.AddTransform(bspline)
+        with self.assertRaises(ValueError):
+            collapse_transform(tx)
+
+        collapsed = collapse_transform(tx, fixed, grid_shrink=2)
+        self.assertEqual("DisplacementFieldTransform", collapsed.GetName())
+        for pt in pts:
+            self.assertLess(math.dist(tx.TransformPoint(pt), collapsed.TransformPoint(pt)), 0.05)
+
+        moving = sitk.GaussianSource(sitk.sitkFloat32, [32, 32, 10], [4, 6, 2], [16, 16, 5], 1000)
+        out = resample(fixed, moving, tx, collapse=True)
+        expected = resample(fixed, moving, tx)
+        # within 5% of the maximum of the Gaussian, the view is of an image which is kept alive
+        difference = sitk.Abs(out - expected)
+        self.assertLess(sitk.GetArrayViewFromImage(difference).max(), 50.0)
+
+    def test_resample_tiled_zarr(self):
+        try:
+            import zarr
+        except ImportError:
+            self.skipTest("zarr is not installed")
+        from sitkibex.io import im_read_channel
+
+        fixed = sitk.Image([600, 540, 5], sitk.sitkFloat32)
+        moving = sitk.GaussianSource(sitk.sitkFloat32, [600, 600, 5], [80, 80, 3], [300, 300, 2], 255)
+        tx = sitk.TranslationTransform(3, [5, -2, 0.5])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filename = os.path.join(tmp_dir, "out.zarr")
+            resample_tiled(
+                fixed, moving, tx, output_filename=output_filename, channel_names=["CD4"], block_size=[100, 100, 5]
+            )
+
+            group = zarr.open_group(output_filename, mode="r")
+            self.assertEqual(3, len(group.attrs["multiscales"][0]["datasets"]))
+            self.assertEqual("CD4", group.attrs["omero"]["channels"][0]["label"])
+
+            expected = resample(fixed, moving, tx)
+            out = im_read_channel(output_filename, "CD4")
+            difference = sitk.GetArrayFromImage(expected) - sitk.GetArrayFromImage(out)
+            self.assertLess(abs(difference).max(), 1e-3)
+
+            # the down-sampled level is the binned output
+            expected = sitk.BinShrink(expected, [2, 2, 1])
+            out = im_read_channel(output_filename, "CD4", shrink_factors=2)
+            self.assertEqual(expected.GetSize(), out.GetSize())
+            self.assertEqual(expected.GetOrigin(), out.GetOrigin())
+            difference = sitk.GetArrayFromImage(expected) - sitk.GetArrayFromImage(out)
+            self.assertLess(abs(difference).max(), 1e-3)
@@ -14,8 +14,13 @@
 #  limitations under the License.
 #
 import SimpleITK as sitk
+import numpy as np
+import pytest
 
+import sitkibex.image_utilities
 import sitkibex.registration_utilities as utils
+from sitkibex.image_utilities import find_peaks, log_polar_rotation, make_auto_mask, _same_physical_space
+import json
 import logging
 
 
@@ -94,3 +99,123 @@ def test_sve_decorator_5d():
 
     assert all([v1 + 1 == v2 for v1, v2 in zip(img, img_out)])
     assert img.GetSize() == img_out.GetSize()
+
+
+def test_telemetry():
+    telemetry = utils.RegistrationTelemetry()
+    with telemetry.phase("fft_initialization", bin_shrink=8):
+        pass
+    with telemetry.phase("affine_3d") as record:
+        record.update(iterations=3, final_metric_value=-0.5)
+        record["levels"] = [
+            {"level": 0, "duration": 0.5, "iterations": 3, "metric_values": [-0.1, -0.4, -0.5]},
+        ]
+        record["levels"][0]["number_of_valid_points"] = [100, 100, 99]
+
+    lines = [json.loads(line) for line in telemetry.to_json_lines(moving="panel2.nrrd").splitlines()]
+    assert ["fft_initialization", "affine_3d"] == [line["phase"] for line in lines]
+    assert all(line["moving"] == "panel2.nrrd" for line in lines)
+    assert 8 == lines[0]["bin_shrink"]
+    assert lines[1]["duration"] >= 0
+    assert all(line["peak_allocation_bytes"] is None or line["peak_allocation_bytes"] >= 0 for line in lines)
+
+    text = utils.telemetry_to_openmetrics([(telemetry, {"moving": 'a "b"'})])
+    assert text.endswith("# EOF\n")
+    assert "# UNIT sitkibex_registration_phase_duration_seconds seconds" in text
+    assert 'sitkibex_registration_level_iterations{moving="a \\"b\\"",phase="affine_3d",level="0"} 3' in text
+    assert (
+        'sitkibex_registration_level_number_of_valid_points{moving="a \\"b\\"",phase="affine_3d",level="0"} 99' in text
+    )
+
+
+def test_peak_allocation():
+    telemetry = utils.RegistrationTelemetry()
+    with telemetry.phase("allocation") as record:
+        # larger than the allocations served from memory already resident in the heap
+        img = sitk.Image([512, 512, 64], sitk.sitkFloat32) + 1.0
+    del img
+
+    if record["peak_allocation_bytes"] is None:
+        pytest.skip("The resident memory is not available on this platform.")
+    assert record["peak_allocation_bytes"] >= 0.5 * 512 * 512 * 64 * 4
+    assert "sitkibex_registration_phase_peak_allocation_bytes" in telemetry.to_openmetrics()
+
+
+def test_make_auto_mask():
+    img = sitk.Image([64, 48, 10], sitk.sitkUInt16)
+    img[9:55, 9:39, :] = 100
+    img[20:30, 20:30, 2:8] = 0
+
+    mask = make_auto_mask(img)
+    assert img.GetSize() == mask.GetSize()
+    assert 46 * 30 * 10 == np.count_nonzero(sitk.GetArrayViewFromImage(mask))
+
+    mask = make_auto_mask(img, shrink_factors=[4, 4, 1])
+    assert (16, 12, 10) == mask.GetSize()
+    assert (4.0, 4.0, 1.0) == mask.GetSpacing()
+    # the hole is filled, and the bins partially covering the border are in the mask
+    assert 12 * 8 * 10 == np.count_nonzero(sitk.GetArrayViewFromImage(mask))
+
+
+def test_same_physical_space():
+    img1 = sitk.Image([16, 16, 4], sitk.sitkFloat32)
+    img2 = sitk.Image([16, 16, 4], sitk.sitkUInt8)
+    assert _same_physical_space(img1, img2)
+
+    img2.SetOrigin([1e-9, 0, 0])
+    assert _same_physical_space(img1, img2)
+
+    img2.SetOrigin([0.5, 0, 0])
+    assert not _same_physical_space(img1, img2)
+    assert not _same_physical_space(img1, sitk.Image([16, 16, 5], sitk.sitkFloat32))
+
+
+def test_find_peaks():
+    size = [64, 48, 20]
+    img = sitk.GaussianSource(sitk.sitkFloat32, size, [3, 3, 2], [20.3, 30.7, 9.2], 10)
+    img += sitk.GaussianSource(sitk.sitkFloat32, size, [3, 3, 2], [50, 10, 4], 5)
+
+    peaks = find_peaks(img, 2)
+    assert 2 == len(peaks)
+    (idx1, value1), (idx2, value2) = peaks
+    assert value1 > value2
+    assert all(abs(i - p) < 0.1 for i, p in zip(idx1, [20.3, 30.7, 9.2]))
+    assert [50, 10, 4] == idx2
+
+    assert 1 == len(find_peaks(img, 1))
+    # the slope of the highest peak does not contain other peaks
+    assert 1 == len(find_peaks(img, 2, min_distance=50))
+
+
+@pytest.mark.parametrize("angle", [0.0, 0.2, -1.0, 2.5])
+def test_log_polar_rotation(angle):
+    size = [256, 240]
+    fixed = sitk.Image(size, sitk.sitkFloat32)
+    for mean, sigma in [([80, 60], [10, 20]), ([180, 150], [25, 8]), ([120, 200], [6, 6]), ([60, 170], [15, 5])]:
+        fixed += sitk.GaussianSource(sitk.sitkFloat32, size, sigma, mean, 100)
+    fixed.SetSpacing([0.5, 0.5])
+
+    # the moving image is the fixed image resampled with the inverse of the expected transform
+    center = fixed.TransformContinuousIndexToPhysicalPoint([128, 120])
+    moving = sitk.Resample(fixed, sitk.Euler2DTransform(center, angle, [4.0, -6.0]))
+    expected = sitk.Euler2DTransform(center, angle, [4.0, -6.0]).GetInverse()
+
+    tx, correlation = log_polar_rotation(moving, fixed)
+    assert correlation > 0.9
+    for pt in [[40, 70], [100, 30]]:
+        assert np.linalg.norm(np.subtract(expected.TransformPoint(pt), tx.TransformPoint(pt))) < 2.0
+
+
+@pytest.mark.parametrize("no_candidates", [False, True])
+def test_log_polar_rotation_no_peak(monkeypatch, no_candidates):
+    fixed = sitk.GaussianSource(sitk.sitkFloat32, [256, 240], [10, 20], [80, 60], 100)
+    moving = fixed + float("nan")
+    if no_candidates:
+        # e.g. the correlation of a fully masked projection
+        monkeypatch.setattr(sitkibex.image_utilities, "fft_candidates", lambda *args, **kwargs: [])
+        moving = fixed
+
+    tx, correlation = log_polar_rotation(moving, fixed)
+    assert 0.0 == tx.GetAngle()
+    assert (0.0, 0.0) == tx.GetTranslation()
+    assert 0.0 == correlation